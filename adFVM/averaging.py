@@ -0,0 +1,131 @@
+import numpy as np
+from scipy.special import ndtri
+
+# truncation in batches minimizing the MSER statistic over the first half
+# of the batches from the prefix sums of the batch means and their squares,
+# the latest truncation of all columns
+def truncation(sums, squares):
+    nBatches = len(sums) - 1
+    counts = np.arange(nBatches, 0, -1).reshape(-1, 1)
+    mean = (sums[-1] - sums[:-1])/counts
+    statistic = ((squares[-1] - squares[:-1])/counts - mean**2)/counts
+    return int(statistic[:nBatches//2+1].argmin(axis=0).max())
+
+# start of the stationary part of a series by MSER on batch means, the
+# truncation minimizing the variance of the mean of the remaining batches
+# over the first half of the series, the latest start of all columns
+def mser(series, batchSize=5):
+    series = series.reshape(len(series), -1)
+    nBatches = len(series)//batchSize
+    if nBatches < 2:
+        return 0
+    batches = series[:nBatches*batchSize].reshape(nBatches, batchSize, -1).mean(axis=1)
+    zero = np.zeros((1, batches.shape[1]))
+    sums = np.concatenate((zero, np.cumsum(batches, axis=0)))
+    squares = np.concatenate((zero, np.cumsum(batches**2, axis=0)))
+    return truncation(sums, squares)*batchSize
+
+# autoregressive model of order up to maxOrder from the autocovariances of
+# n samples by levinson durbin, the order is selected by AIC, returns the
+# coefficients and the innovation variance
+def levinson(acov, n, maxOrder):
+    if acov[0] <= 0.:
+        return np.zeros(0), 0.
+    coeffs, variance = np.zeros(0), acov[0]
+    best = (n*np.log(variance), coeffs, variance)
+    for order in range(1, maxOrder + 1):
+        reflection = (acov[order] - np.dot(coeffs, acov[order-1:0:-1]))/variance
+        coeffs = np.concatenate((coeffs - reflection*coeffs[::-1], [reflection]))
+        variance *= (1 - reflection**2)
+        if variance <= 0.:
+            break
+        aic = n*np.log(variance) + 2*order
+        if aic < best[0]:
+            best = (aic, coeffs, variance)
+    return best[1], best[2]
+
+# autoregressive model of a series from the yule walker equations
+def arFit(x, maxOrder=20):
+    x = x - x.mean()
+    n = len(x)
+    maxOrder = max(0, min(maxOrder, n//10))
+    acov = np.array([np.dot(x[:n-k], x[k:])/n for k in range(0, maxOrder + 1)])
+    return levinson(acov, n, maxOrder)
+
+# variance of the sample mean of an AR process, from its spectral density at zero
+def meanVariance(x, maxOrder=20):
+    coeffs, variance = arFit(x, maxOrder)
+    return variance/(len(x)*(1 - coeffs.sum())**2)
+
+# online estimate of the time average of a series and its confidence
+# interval, converged when the half width of the interval of every column is
+# below tolerance. append keeps prefix sums of the samples, of the lagged
+# products up to maxOrder and of the batch means, so update finds the
+# transient and the autocovariances of the samples after it without going
+# over the series, samples are shifted by the first one against cancellation
+class RunLengthMonitor(object):
+    def __init__(self, tolerance, confidence=0.95, maxOrder=20, batchSize=5, minSamples=100):
+        self.tolerance = tolerance
+        self.z = ndtri(0.5 + confidence/2)
+        self.maxOrder = maxOrder
+        self.batchSize = batchSize
+        self.minSamples = minSamples
+        self.series = []
+        self.start = 0
+        self.mean = self.variance = self.halfWidth = None
+        self.shift = None
+        self.sums, self.products = [], []
+        self.batchSums, self.batchSquares = [], []
+
+    def append(self, value):
+        value = np.atleast_1d(value).astype(np.float64)
+        if self.shift is None:
+            self.shift = value.copy()
+            zero = np.zeros_like(value)
+            self.sums, self.products = [zero], [np.zeros((self.maxOrder + 1,) + value.shape)]
+            self.batchSums, self.batchSquares = [zero], [zero]
+        self.series.append(value)
+        x = value - self.shift
+        n = len(self.series)
+        products = np.zeros_like(self.products[0])
+        for k in range(0, min(n, self.maxOrder + 1)):
+            products[k] = x*(self.series[n-1-k] - self.shift)
+        self.sums.append(self.sums[-1] + x)
+        self.products.append(self.products[-1] + products)
+        if n % self.batchSize == 0:
+            batch = (self.sums[n] - self.sums[n-self.batchSize])/self.batchSize
+            self.batchSums.append(self.batchSums[-1] + batch)
+            self.batchSquares.append(self.batchSquares[-1] + batch**2)
+
+    def getSamples(self):
+        return np.array(self.series)[self.start:]
+
+    # autocovariances of the shifted samples from start to the end
+    def getAutocovariance(self, start, maxOrder):
+        n = len(self.series)
+        N = n - start
+        S, P = self.sums, self.products
+        mean = (S[n] - S[start])/N
+        acov = []
+        for k in range(0, maxOrder + 1):
+            head, tail = S[n-k] - S[start], S[n] - S[start+k]
+            acov.append((P[n][k] - P[start+k][k] - mean*(head + tail) + (N - k)*mean**2)/N)
+        return np.array(acov), mean
+
+    def update(self):
+        nBatches = len(self.batchSums) - 1
+        self.start = 0
+        if nBatches >= 2:
+            self.start = truncation(np.array(self.batchSums), np.array(self.batchSquares))*self.batchSize
+        N = len(self.series) - self.start
+        if N < self.minSamples:
+            return False
+        maxOrder = max(0, min(self.maxOrder, N//10))
+        acov, mean = self.getAutocovariance(self.start, maxOrder)
+        self.mean = mean + self.shift
+        self.variance = np.zeros_like(mean)
+        for index in range(0, len(mean)):
+            coeffs, variance = levinson(acov[:,index], N, maxOrder)
+            self.variance[index] = variance/(N*(1 - coeffs.sum())**2)
+        self.halfWidth = self.z*np.sqrt(self.variance)
+        return bool((self.halfWidth <= self.tolerance).all())
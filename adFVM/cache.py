@@ -0,0 +1,192 @@
+import os
+import sys
+import shutil
+import hashlib
+import inspect
+from contextlib import contextmanager
+
+import numpy as np
+
+from . import config
+
+logger = config.Logger(__name__)
+
+# compiled kernels shared by the cases of a user, an entry is the code
+# directory built for a key hashed from everything the generated code and
+# the library depend on: the python sources generating it, the solver state
+# from Solver.getCodeConfig, the boundary conditions, the compiler and its
+# arguments and the precision. An entry is loaded only if it and the cache are owned by the
+# user and not writable by others, and its generated sources match the
+# manifest written when it was stored
+class KernelCache(object):
+    manifest = 'sources.sha1'
+
+    def __init__(self, root=None):
+        if root is None:
+            cacheHome = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+            root = os.environ.get('ADFVM_KERNEL_CACHE', os.path.join(cacheHome, 'adFVM', 'kernels'))
+        self.root = os.path.join(root, '')
+        if not os.path.exists(self.root):
+            try:
+                os.makedirs(self.root, 0o700)
+            except OSError:
+                assert os.path.isdir(self.root)
+
+    # owned by the user and not writable by the group or others
+    def isPrivate(self, path):
+        stat = os.lstat(path)
+        return stat.st_uid == os.getuid() and not (stat.st_mode & 0o022)
+
+    def describe(self, value):
+        if isinstance(value, dict):
+            return '{' + ','.join([repr(key) + ':' + self.describe(value[key]) for key in sorted(value.keys(), key=str)]) + '}'
+        if isinstance(value, (list, tuple)):
+            return '[' + ','.join([self.describe(x) for x in value]) + ']'
+        if isinstance(value, np.ndarray):
+            return 'array{}{}'.format(value.shape, value.dtype)
+        if callable(value):
+            try:
+                return inspect.getsource(value)
+            except (TypeError, IOError):
+                return getattr(value, '__module__', '') + '.' + getattr(value, '__name__', repr(type(value)))
+        return repr(value)
+
+    def getSources(self):
+        # modules generating code, changes in them change the kernels
+        files = []
+        for name in ['adFVM', 'adpy']:
+            module = sys.modules.get(name)
+            if module is None or not hasattr(module, '__file__'):
+                continue
+            for dirPath, dirNames, fileNames in os.walk(os.path.dirname(module.__file__)):
+                dirNames.sort()
+                files.extend([os.path.join(dirPath, x) for x in sorted(fileNames) if x.endswith('.py')])
+        return files
+
+    def getKey(self, solver, compiler_args):
+        sha = hashlib.sha1()
+        def update(string):
+            sha.update(string.encode('utf-8'))
+        update(self.describe(compiler_args))
+        # the compiler binary and the flags it reads from the environment
+        for name in ['CC', 'CXX', 'CFLAGS', 'CXXFLAGS', 'CPPFLAGS', 'LDFLAGS']:
+            update(name + '=' + os.environ.get(name, ''))
+        for name in [compiler_args.get('compiler'), compiler_args.get('linker')]:
+            path = shutil.which(name) if isinstance(name, str) else None
+            if path is not None:
+                stat = os.stat(path)
+                update('{}:{}:{}'.format(os.path.realpath(path), stat.st_size, stat.st_mtime))
+        args = compiler_args.get('sources', [])
+        for incdir in compiler_args.get('incdirs', []):
+            if os.path.isdir(incdir):
+                args = args + sorted([os.path.join(incdir, x) for x in os.listdir(incdir)])
+        for fileName in self.getSources() + args:
+            if os.path.isfile(fileName):
+                with open(fileName, 'rb') as f:
+                    sha.update(f.read())
+        update(str(np.dtype(config.precision)))
+        update(config.codeExt)
+        update(solver.__class__.__module__ + '.' + solver.__class__.__name__)
+        update(self.describe(solver.getCodeConfig()))
+        boundary = [(patchID, patch['type']) for patchID, patch in solver.mesh.boundary.items()]
+        update(self.describe(sorted(boundary, key=str)))
+        return sha.hexdigest()
+
+    def getEntry(self, key):
+        return self.root + key
+
+    # hash of the generated sources of a code directory
+    def getSourceHash(self, codeDir):
+        sha = hashlib.sha1()
+        for dirPath, dirNames, fileNames in os.walk(codeDir):
+            dirNames[:] = sorted([x for x in dirNames if x != 'build'])
+            for fileName in sorted(fileNames):
+                if fileName == KernelCache.manifest or fileName.endswith(('.so', '.o', '.pyc')):
+                    continue
+                path = os.path.join(dirPath, fileName)
+                sha.update(os.path.relpath(path, codeDir).encode('utf-8'))
+                with open(path, 'rb') as f:
+                    sha.update(f.read())
+        return sha.hexdigest()
+
+    def isValid(self, entry):
+        if not (self.isPrivate(self.root) and self.isPrivate(entry)):
+            return False
+        for dirPath, dirNames, fileNames in os.walk(entry):
+            for name in dirNames + fileNames:
+                if not self.isPrivate(os.path.join(dirPath, name)):
+                    return False
+        manifest = os.path.join(entry, KernelCache.manifest)
+        if not os.path.isfile(manifest):
+            return False
+        with open(manifest) as f:
+            return f.read().strip() == self.getSourceHash(entry)
+
+    def load(self, key, codeDir):
+        entry = self.getEntry(key)
+        if not os.path.exists(entry):
+            return False
+        if not self.isValid(entry):
+            logger.warning('ignoring kernel cache entry {}'.format(entry))
+            return False
+        if os.path.exists(codeDir):
+            shutil.rmtree(codeDir)
+        shutil.copytree(entry, codeDir)
+        return True
+
+    def store(self, key, codeDir):
+        entry = self.getEntry(key)
+        if os.path.exists(entry):
+            return
+        tempEntry = '{}.{}.tmp'.format(entry, os.getpid())
+        shutil.copytree(codeDir, tempEntry, ignore=shutil.ignore_patterns('build'))
+        with open(os.path.join(tempEntry, KernelCache.manifest), 'w') as f:
+            f.write(self.getSourceHash(tempEntry))
+        # the umask may leave the copy writable by others
+        for dirPath, dirNames, fileNames in os.walk(tempEntry):
+            for name in dirNames + fileNames:
+                path = os.path.join(dirPath, name)
+                os.chmod(path, os.stat(path).st_mode & ~0o022)
+        os.chmod(tempEntry, 0o700)
+        try:
+            os.rename(tempEntry, entry)
+        except OSError:
+            # stored concurrently by another case
+            shutil.rmtree(tempEntry)
+
+# translation units of a distutils build compiled on nJobs threads, the
+# private CCompiler methods used are checked first and the build is left
+# serial without them (distutils is gone from python 3.12)
+@contextmanager
+def parallelCompile(nJobs=None):
+    try:
+        from distutils import ccompiler
+    except ImportError:
+        yield
+        return
+    if not all([hasattr(ccompiler.CCompiler, name) for name in ['_setup_compile', '_get_cc_args', '_compile']]):
+        yield
+        return
+    from multiprocessing.pool import ThreadPool
+    if nJobs is None:
+        nJobs = int(os.environ.get('ADFVM_COMPILE_JOBS', os.cpu_count() if hasattr(os, 'cpu_count') else 1))
+    serialCompile = ccompiler.CCompiler.compile
+    def compile(self, sources, output_dir=None, macros=None, include_dirs=None, debug=0, extra_preargs=None, extra_postargs=None, depends=None):
+        macros, objects, extra_postargs, pp_opts, build = self._setup_compile(output_dir, macros, include_dirs, sources, depends, extra_postargs)
+        cc_args = self._get_cc_args(pp_opts, debug, extra_preargs)
+        def compileObject(obj):
+            if obj not in build:
+                return
+            src, ext = build[obj]
+            self._compile(obj, src, ext, cc_args, extra_postargs, pp_opts)
+        pool = ThreadPool(max(nJobs, 1))
+        try:
+            pool.map(compileObject, objects)
+        finally:
+            pool.close()
+        return objects
+    ccompiler.CCompiler.compile = compile
+    try:
+        yield
+    finally:
+        ccompiler.CCompiler.compile = serialCompile
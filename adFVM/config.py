@@ -20,14 +20,16 @@ parser.add_argument('--gpu_double', action='store_true', dest='use_gpu_double')
 parser.add_argument('-m', '--omp', action='store_true', dest='use_openmp')
 parser.add_argument('-p', '--matop_petsc', action='store_true', dest='use_matop_petsc')
 parser.add_argument('--matop_cuda', action='store_true', dest='use_matop_cuda')
+parser.add_argument('--matop_native', action='store_true', dest='use_matop_native')
 parser.add_argument('-d', '--hdf5', action='store_true')
 parser.add_argument('-o', '--profile', action='store_true', dest='profile')
 parser.add_argument('-k', '--gc', action='store_true', dest='use_gc')
-parser.add_argument('--temp', action='store_true', dest='use_temp')
+parser.add_argument('--temp', '--stage', action='store_true', dest='use_temp')
 
 parser.add_argument('-c', '--compile', action='store_true')
 parser.add_argument('-e', '--compile_exit', action='store_true')
 parser.add_argument('-l', '--no_compile', action='store_true')
+parser.add_argument('--no_kernel_cache', action='store_true')
 
 user, args = parser.parse_known_args()
 
@@ -107,6 +109,9 @@ def get_compiler_args():
         sources += [os.path.join(cppDir, 'matop_cuda.cpp')]
         extra_compile_args += ['-DMATOP_CUDA']
         libs += ['cusparse']
+    if matop_native:
+        sources += [os.path.join(cppDir, 'matop_native.cpp')]
+        extra_compile_args += ['-DMATOP_NATIVE']
 
     return {'compiler': compiler,
             'linker': linker,
@@ -121,8 +126,12 @@ adpy.config.set_config(sys.modules[__name__])
 
 matop_petsc = user.use_matop_petsc
 matop_cuda = user.use_matop_cuda
+matop_native = user.use_matop_native
 hdf5 = user.hdf5
 compile_exit = user.compile_exit
+kernel_cache = not user.no_kernel_cache
+# mesh and compiled library read from node local copies
+stage = user.use_temp
 
 # LOGGING
 
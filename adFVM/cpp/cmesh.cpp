@@ -339,6 +339,69 @@ PyObject* computeSensitivity(PyObject* self, PyObject* args) {
     return Py_BuildValue("d", sensitivity);
 }
 
+// batched sensitivities of stacked perturbations stored on their support,
+// values[i] is (nPerturb, nSupport, d) for the rows indices[i] of gradients[i]
+PyObject* computeSensitivities(PyObject* self, PyObject* args) {
+    PyObject* gradients;
+    PyObject* indices;
+    PyObject* values;
+    if (!PyArg_ParseTuple(args, "OOO", &gradients, &indices, &values)) {
+        cout << "parsing arguments failed" << endl;
+        return NULL;
+    }
+    if (!PyList_Check(gradients) || !PyList_Check(indices) || !PyList_Check(values)) {
+        cout << "arguments not lists" << endl;
+        return NULL;
+    }
+    int i, j, k, l;
+    int n = PyList_Size(gradients);
+    assert(PyList_Size(indices) == n);
+    assert(PyList_Size(values) == n);
+    int nPerturb = 0;
+    if (n > 0) {
+        nPerturb = PyArray_DIM((PyArrayObject*) PyList_GetItem(values, 0), 0);
+    }
+    vector<scalar> sensitivities(nPerturb, 0);
+    for (i = 0; i < n; i++) {
+        PyArrayObject* grad = (PyArrayObject*) PyList_GetItem(gradients, i);
+        PyArrayObject* ind = (PyArrayObject*) PyList_GetItem(indices, i);
+        PyArrayObject* val = (PyArrayObject*) PyList_GetItem(values, i);
+        assert(PyArray_IS_C_CONTIGUOUS(grad));
+        assert(PyArray_IS_C_CONTIGUOUS(ind));
+        assert(PyArray_IS_C_CONTIGUOUS(val));
+        assert(PyArray_ITEMSIZE(grad) == sizeof(scalar));
+        assert(PyArray_ITEMSIZE(ind) == sizeof(integer));
+        assert(PyArray_ITEMSIZE(val) == sizeof(scalar));
+        assert(PyArray_DIM(val, 0) == nPerturb);
+        int nSupport = PyArray_SIZE(ind);
+        int d = 1;
+        if (PyArray_NDIM(grad) > 1) {
+            d = PyArray_SIZE(grad)/PyArray_DIM(grad, 0);
+        }
+        assert(PyArray_SIZE(val) == nPerturb*nSupport*d);
+        scalar* grad_data = (scalar*)PyArray_DATA(grad);
+        integer* ind_data = (integer*)PyArray_DATA(ind);
+        scalar* val_data = (scalar*)PyArray_DATA(val);
+        #pragma omp parallel for private(j, k, l)
+        for (j = 0; j < nPerturb; j++) {
+            scalar* row = &val_data[j*nSupport*d];
+            scalar sensitivity = 0;
+            for (k = 0; k < nSupport; k++) {
+                scalar* g = &grad_data[ind_data[k]*d];
+                for (l = 0; l < d; l++) {
+                    sensitivity += g[l]*row[k*d + l];
+                }
+            }
+            sensitivities[j] += sensitivity;
+        }
+    }
+    PyObject* ret = PyList_New(nPerturb);
+    for (j = 0; j < nPerturb; j++) {
+        PyList_SetItem(ret, j, PyFloat_FromDouble(sensitivities[j]));
+    }
+    return ret;
+}
+
 PyObject* computeEnergy(PyObject* self, PyObject* args) {
     int i;
     PyObject* solver;
@@ -428,6 +491,7 @@ PyMethodDef Methods[] = {
     {"build",  buildMesh, METH_VARARGS, "Execute a shell command."},
     {"buildBeforeWrite",  buildMeshBeforeWrite, METH_VARARGS, "Execute a shell command."},
     {"computeSensitivity",  computeSensitivity, METH_VARARGS, "Execute a shell command."},
+    {"computeSensitivities",  computeSensitivities, METH_VARARGS, "Execute a shell command."},
     {"computeEnergy",  computeEnergy, METH_VARARGS, "Execute a shell command."},
     {NULL, NULL, 0, NULL}        /* Sentinel */
 };
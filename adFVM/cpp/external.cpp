@@ -17,6 +17,10 @@ Mesh *meshp = NULL;
     #include "matop_cuda.hpp"
     Matop *matop;
 #endif
+#ifdef MATOP_NATIVE
+    #include "matop_native.hpp"
+    Matop *matop;
+#endif
 
 void external_init (PyObject* args) {
     int rank = PyInt_AsLong(PyTuple_GetItem(args, 0));
@@ -36,7 +40,7 @@ void external_init (PyObject* args) {
         assert(status2 == CUBLAS_STATUS_SUCCESS);
     #endif
 
-    #if defined(MATOP_PETSC) || defined(MATOP_CUDA)
+    #if defined(MATOP_PETSC) || defined(MATOP_CUDA) || defined(MATOP_NATIVE)
         matop = new Matop();
     #endif
 }
@@ -45,7 +49,7 @@ void external_exit () {
     parallel_exit();
     Py_DECREF(meshp->mesh);
     delete meshp;
-    #if defined(MATOP_PETSC) || defined(MATOP_CUDA)
+    #if defined(MATOP_PETSC) || defined(MATOP_CUDA) || defined(MATOP_NATIVE)
         delete matop;
     #endif
 }
@@ -0,0 +1,64 @@
+#ifndef MATOP_HPP
+#define MATOP_HPP
+
+#include "mesh.hpp"
+#include "parallel.hpp"
+#define DENSITY_DEFAULT true
+#define nrhs 5
+
+// iterations and tolerance of the block conjugate gradient solve
+#define NATIVE_RTOL 1e-5
+#define NATIVE_MAXIT 500
+// degree of the chebyshev polynomial preconditioner, 1 is plain jacobi
+#define NATIVE_DEGREE 3
+// number of solves after which the spectrum estimate is recomputed,
+// roughly one checkpoint of the adjoint
+#define NATIVE_REBUILD 20
+#define NATIVE_POWER_ITERS 10
+#define NATIVE_EIG_RATIO 30.
+// print the iterations and time of every solve
+//#define NATIVE_DEBUG
+
+struct RemotePatch {
+    integer startFace, nFaces, proc, tag;
+};
+
+class Matop {
+    // sparsity pattern of the volume scaled operator V + dt*L, columns
+    // beyond nInternalCells are the remote cells of processor patches
+    integer n, nRemote, nnz;
+    vector<integer> indptr;
+    vector<integer> indices;
+    vector<integer> faces;
+    vector<scalar> data;
+    vector<scalar> diag;
+    vector<scalar> invDiag;
+    vector<RemotePatch> patches;
+    vector<scalar> sendBuf;
+    vector<MPI_Request> requests;
+
+    // preconditioner reused across solves and warm start of every
+    // column of the adjoint batch
+    scalar lmin = -1, lmax = -1;
+    integer nSolves = 0;
+    vector<vector<scalar>> corrections;
+
+    // block work vectors, nrhs values per cell
+    vector<scalar> x, r, z, p, q, d;
+
+    void updateValues(const scalar* faceData, const scalar dt);
+    void exchange(scalar* v);
+    void multiply(scalar* v, scalar* out);
+    void dot(const scalar* a, const scalar* b, scalar* out);
+    void estimateSpectrum();
+    void precondition(const scalar* rhs, scalar* out);
+
+    public:
+
+    Matop();
+    ~Matop();
+    int heat_equation(vector<ext_vec*> w, vector<ext_vec*> u, const ext_vec& DT, const ext_vec& dt, vector<ext_vec*> un, integer column=0, bool density=DENSITY_DEFAULT);
+};
+
+extern Matop *matop;
+#endif
@@ -0,0 +1,289 @@
+#define NO_IMPORT_ARRAY
+#include "matop_native.hpp"
+
+#ifdef GPU
+    #error "native matop is only available on the CPU"
+#endif
+
+// matrix free solver for (V + dt*L) un = V u on stacked adjoint fields, where
+// L is the face laplacian with coefficients DTF, the sparsity pattern and
+// halo exchange are set up once, the chebyshev-jacobi preconditioner spectrum
+// is reused over NATIVE_REBUILD solves and every solve is warm started with the
+// correction of the previous solve of the same adjoint column
+
+Matop::Matop() {
+    const Mesh& mesh = *meshp;
+    n = mesh.nInternalCells;
+    nRemote = mesh.nFaces - mesh.nLocalFaces;
+
+    indptr.resize(n+1);
+    indptr[0] = 0;
+    for (integer i = 0; i < n; i++) {
+        for (integer k = 0; k < 6; k++) {
+            integer f = mesh.cellFaces(i, k);
+            integer col = mesh.cellNeighbours(i, k);
+            if (col == -1 && f >= mesh.nLocalFaces) {
+                col = n + f - mesh.nLocalFaces;
+            }
+            // physical boundaries carry no dissipative flux
+            if (col > -1) {
+                indices.push_back(col);
+                faces.push_back(f);
+            }
+        }
+        indptr[i+1] = indices.size();
+    }
+    nnz = indices.size();
+    data.resize(nnz);
+    diag.resize(n);
+    invDiag.resize(n);
+
+    for (auto& patch: mesh.boundary) {
+        auto& patchInfo = patch.second;
+        string patchType = patchInfo.at("type");
+        if (patchType == "processor" || patchType == "processorCyclic") {
+            RemotePatch remote;
+            tie(remote.startFace, remote.nFaces) = mesh.boundaryFaces.at(patch.first);
+            remote.proc = stoi(patchInfo.at("neighbProcNo"));
+            remote.tag = 30000 + mesh.tags.at(patch.first);
+            patches.push_back(remote);
+        }
+    }
+    sendBuf.resize(nRemote*nrhs);
+    requests.resize(2*patches.size());
+
+    x.resize((n+nRemote)*nrhs);
+    z.resize((n+nRemote)*nrhs);
+    p.resize((n+nRemote)*nrhs);
+    r.resize(n*nrhs);
+    q.resize(n*nrhs);
+    d.resize(n*nrhs);
+}
+
+Matop::~Matop () {
+}
+
+void Matop::updateValues(const scalar* faceData, const scalar dt) {
+    const Mesh& mesh = *meshp;
+    for (integer i = 0; i < n; i++) {
+        scalar cellData = mesh.volumes(i);
+        for (integer j = indptr[i]; j < indptr[i+1]; j++) {
+            data[j] = -faceData[faces[j]]*dt;
+            cellData -= data[j];
+            assert(std::isfinite(data[j]));
+        }
+        diag[i] = cellData;
+        invDiag[i] = 1./cellData;
+    }
+}
+
+void Matop::exchange(scalar* v) {
+    const Mesh& mesh = *meshp;
+    if (mesh.nProcs == 1) return;
+    integer index = 0;
+    for (auto& patch: patches) {
+        integer bufStart = (patch.startFace - mesh.nLocalFaces)*nrhs;
+        for (integer j = 0; j < patch.nFaces; j++) {
+            integer p = mesh.owner(patch.startFace + j);
+            for (integer c = 0; c < nrhs; c++) {
+                sendBuf[bufStart + j*nrhs + c] = v[p*nrhs + c];
+            }
+        }
+        integer size = patch.nFaces*nrhs;
+        MPI_Isend(&sendBuf[bufStart], size, mpi_type<scalar>(), patch.proc, patch.tag, MPI_COMM_WORLD, &requests[index]);
+        MPI_Irecv(&v[n*nrhs + bufStart], size, mpi_type<scalar>(), patch.proc, patch.tag, MPI_COMM_WORLD, &requests[index+1]);
+        index += 2;
+    }
+    MPI_Waitall(index, requests.data(), MPI_STATUSES_IGNORE);
+}
+
+void Matop::multiply(scalar* v, scalar* out) {
+    exchange(v);
+    for (integer i = 0; i < n; i++) {
+        scalar sum[nrhs];
+        for (integer c = 0; c < nrhs; c++) {
+            sum[c] = diag[i]*v[i*nrhs + c];
+        }
+        for (integer j = indptr[i]; j < indptr[i+1]; j++) {
+            const scalar* vj = &v[indices[j]*nrhs];
+            for (integer c = 0; c < nrhs; c++) {
+                sum[c] += data[j]*vj[c];
+            }
+        }
+        for (integer c = 0; c < nrhs; c++) {
+            out[i*nrhs + c] = sum[c];
+        }
+    }
+}
+
+void Matop::dot(const scalar* a, const scalar* b, scalar* out) {
+    const Mesh& mesh = *meshp;
+    scalar local[nrhs] = {0,0,0,0,0};
+    for (integer i = 0; i < n; i++) {
+        for (integer c = 0; c < nrhs; c++) {
+            local[c] += a[i*nrhs + c]*b[i*nrhs + c];
+        }
+    }
+    if (mesh.nProcs > 1) {
+        MPI_Allreduce(local, out, nrhs, mpi_type<scalar>(), MPI_SUM, MPI_COMM_WORLD);
+    } else {
+        for (integer c = 0; c < nrhs; c++) {
+            out[c] = local[c];
+        }
+    }
+}
+
+void Matop::estimateSpectrum() {
+    // power iteration on the jacobi scaled operator, its spectrum
+    // is bounded by 2 from gershgorin as the operator is diagonally dominant
+    scalar norm[nrhs];
+    for (integer i = 0; i < n; i++) {
+        for (integer c = 0; c < nrhs; c++) {
+            z[i*nrhs + c] = 1 + 0.5*sin(i + c);
+        }
+    }
+    scalar lambda = 1.;
+    for (integer iter = 0; iter < NATIVE_POWER_ITERS; iter++) {
+        dot(z.data(), z.data(), norm);
+        scalar scale = 1./sqrt(norm[0]);
+        for (integer i = 0; i < n*nrhs; i++) {
+            z[i] *= scale;
+        }
+        multiply(z.data(), q.data());
+        for (integer i = 0; i < n; i++) {
+            for (integer c = 0; c < nrhs; c++) {
+                q[i*nrhs + c] *= invDiag[i];
+            }
+        }
+        dot(z.data(), q.data(), norm);
+        lambda = norm[0];
+        copy(q.begin(), q.end(), z.begin());
+    }
+    lmax = min(1.1*lambda, 2.);
+    lmin = lmax/NATIVE_EIG_RATIO;
+}
+
+void Matop::precondition(const scalar* rhs, scalar* out) {
+    // fixed number of chebyshev iterations from a zero guess, a linear
+    // symmetric positive definite operator on rhs as long as lmax bounds
+    // the spectrum
+    scalar theta = (lmax + lmin)/2;
+    scalar delta = (lmax - lmin)/2;
+    scalar sigma = theta/delta;
+    scalar rho = 1./sigma;
+    for (integer i = 0; i < n; i++) {
+        for (integer c = 0; c < nrhs; c++) {
+            integer index = i*nrhs + c;
+            out[index] = invDiag[i]*rhs[index]/theta;
+            d[index] = out[index];
+        }
+    }
+    for (integer k = 1; k < NATIVE_DEGREE; k++) {
+        multiply(out, q.data());
+        scalar rhoNew = 1./(2*sigma - rho);
+        for (integer i = 0; i < n; i++) {
+            for (integer c = 0; c < nrhs; c++) {
+                integer index = i*nrhs + c;
+                d[index] = rhoNew*rho*d[index] + 2*rhoNew/delta*invDiag[i]*(rhs[index] - q[index]);
+                out[index] += d[index];
+            }
+        }
+        rho = rhoNew;
+    }
+}
+
+int Matop::heat_equation(vector<ext_vec*> w, vector<ext_vec*> u, const ext_vec& DTF, const ext_vec& dt_vec, vector<ext_vec*> un, integer column, bool density) {
+    const Mesh& mesh = *meshp;
+    #ifdef NATIVE_DEBUG
+        long long start = current_timestamp();
+    #endif
+
+    updateValues(DTF.data, dt_vec(0));
+    if ((nSolves % NATIVE_REBUILD) == 0) {
+        estimateSpectrum();
+    }
+    nSolves += 1;
+    if (column >= (integer) corrections.size()) {
+        corrections.resize(column+1);
+    }
+    vector<scalar>& correction = corrections[column];
+    if (correction.empty()) {
+        correction.assign(n*nrhs, 0.);
+    }
+
+    // b = V u, x = u + previous correction of the column
+    vector<scalar> b(n*nrhs);
+    for (integer i = 0; i < n; i++) {
+        for (integer c = 0; c < nrhs; c++) {
+            integer index = i*nrhs + c;
+            b[index] = mesh.volumes(i)*u[c]->data[i];
+            x[index] = u[c]->data[i] + correction[index];
+        }
+    }
+    multiply(x.data(), q.data());
+    for (integer i = 0; i < n*nrhs; i++) {
+        r[i] = b[i] - q[i];
+    }
+
+    scalar bnorm[nrhs], rnorm[nrhs], rz[nrhs], rzOld[nrhs], pq[nrhs];
+    dot(b.data(), b.data(), bnorm);
+    precondition(r.data(), z.data());
+    dot(r.data(), z.data(), rz);
+    copy(z.begin(), z.end(), p.begin());
+
+    integer its = 0;
+    bool converged = false;
+    for (; its < NATIVE_MAXIT; its++) {
+        dot(r.data(), r.data(), rnorm);
+        converged = true;
+        for (integer c = 0; c < nrhs; c++) {
+            converged &= rnorm[c] <= NATIVE_RTOL*NATIVE_RTOL*bnorm[c];
+        }
+        if (converged) break;
+
+        multiply(p.data(), q.data());
+        dot(p.data(), q.data(), pq);
+        scalar alpha[nrhs];
+        for (integer c = 0; c < nrhs; c++) {
+            alpha[c] = (pq[c] > 0) ? rz[c]/pq[c] : 0.;
+        }
+        for (integer i = 0; i < n; i++) {
+            for (integer c = 0; c < nrhs; c++) {
+                integer index = i*nrhs + c;
+                x[index] += alpha[c]*p[index];
+                r[index] -= alpha[c]*q[index];
+            }
+        }
+
+        precondition(r.data(), z.data());
+        copy(rz, rz + nrhs, rzOld);
+        dot(r.data(), z.data(), rz);
+        for (integer i = 0; i < n; i++) {
+            for (integer c = 0; c < nrhs; c++) {
+                integer index = i*nrhs + c;
+                scalar beta = (rzOld[c] > 0) ? rz[c]/rzOld[c] : 0.;
+                p[index] = z[index] + beta*p[index];
+            }
+        }
+    }
+
+    for (integer i = 0; i < n; i++) {
+        for (integer c = 0; c < nrhs; c++) {
+            integer index = i*nrhs + c;
+            un[c]->data[i] = x[index];
+            correction[index] = x[index] - u[c]->data[i];
+        }
+    }
+
+    #ifdef NATIVE_DEBUG
+        long long end = current_timestamp();
+        if (mesh.rank == 0) {
+            cout << "matop iterations: " << its << endl;
+            cout << "matop time: " << end-start << endl;
+        }
+    #endif
+    if (!converged) {
+        return 1;
+    }
+    return 0;
+}
@@ -238,6 +238,31 @@ void Function_mpi_allreduce_grad(vector<ext_vec*> vals) {
     }
 }
 
+// global maximum for quantities computed inside the map, such as the
+// time step of sub cycled steps, the maximum is not differentiated
+void Function_mpi_allreduce_max(vector<ext_vec*> vals) {
+    const Mesh& mesh = *meshp;
+    integer n = vals.size()/2;
+    ext_vec in(n, true);
+    for (integer i = 0; i < n; i++) {
+        in.copy(i, &(*vals[i])(0), 1);
+    }
+    if (mesh.nProcs == 1) {
+        for (integer i = 0; i < n; i++) {
+            (*vals[i+n]).copy(0, &in(i), 1);
+        }
+    } else {
+        ext_vec out(n, true);
+        MPI_Allreduce(&in(0), &out(0), n, mpi_type<decltype(vals[0]->type)>(), MPI_MAX, MPI_COMM_WORLD);
+        for (integer i = 0; i < n; i++) {
+            (*vals[i+n]).copy(0, &out(i), 1);
+        }
+    }
+}
+
+void Function_mpi_allreduce_max_grad(vector<ext_vec*> vals) {
+}
+
 void Function_mpi_dummy () {};
 
 void Function_print_info(vector<ext_vec*> res) {
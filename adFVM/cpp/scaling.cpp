@@ -6,6 +6,9 @@
 #ifdef MATOP_CUDA
     #include "matop_cuda.hpp"
 #endif
+#ifdef MATOP_NATIVE
+    #include "matop_native.hpp"
+#endif
 
 #ifdef GPU
 
@@ -137,18 +140,24 @@ void Function_apply_adjoint_viscosity(vector<ext_vec*> phiP) {
     vector<ext_vec*> u, un, w;
     for (int i = 0; i < 5; i++) {
         u.push_back(phiP[i]);
-        un.push_back(phiP[i+10]);
+        un.push_back(phiP[i+11]);
     }
     for (int i = 0; i < 3; i++) {
         w.push_back(phiP[i+5]);
     }
     ext_vec& DT = *phiP[8];
     ext_vec& dt_vec = *phiP[9];
-
-    #if defined(MATOP_CUDA) || defined(MATOP_PETSC)
-        int error = matop->heat_equation(w, u, DT, dt_vec, un);
+    // column of the adjoint batch
+    integer column = (integer) (*phiP[10])(0);
+
+    #if defined(MATOP_CUDA) || defined(MATOP_PETSC) || defined(MATOP_NATIVE)
+        #ifdef MATOP_NATIVE
+            int error = matop->heat_equation(w, u, DT, dt_vec, un, column);
+        #else
+            int error = matop->heat_equation(w, u, DT, dt_vec, un);
+        #endif
         if (error) {
-            cout << "petsc error " << error << endl;
+            cout << "matop error " << error << endl;
             exit(1);
         }
     #else
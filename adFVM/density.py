@@ -9,7 +9,7 @@ from . import postpro
 from . import timestep
 from .mesh import Mesh
 
-from adpy.tensor import Kernel, ExternalFunctionOp
+from adpy.tensor import Tensor, Kernel, ExternalFunctionOp
 from adpy.variable import Variable, Function, Zeros
 
 import numpy as np
@@ -86,6 +86,12 @@ class RCF(Solver):
         self._coupledFlux = Kernel(self.flux)
         self._characteristicFlux = Kernel(self.flux)
         self._boundaryFlux = Kernel(self.boundaryFlux)
+        # flux kernels of only the convective or the viscous terms for imex
+        self.fluxPart = None
+        self._fluxParts = {}
+        if self.imex:
+            for part in ['convective', 'viscous']:
+                self._fluxParts[part] = [Kernel(self.flux), Kernel(self.flux), Kernel(self.flux), Kernel(self.boundaryFlux)]
         mesh = self.mesh.symMesh
         meshArgs = mesh.getTensor() + mesh.getScalar()
         sourceArgs = [x[0] for x in self.sourceTerms]
@@ -99,10 +105,132 @@ class RCF(Solver):
         rho, rhoU, rhoE = Variable((mesh.nInternalCells, 1)), Variable((mesh.nInternalCells, 3)), Variable((mesh.nInternalCells, 1)),
         rhoN, rhoUN, rhoEN = timestep.timeStepper(self.equation, [rho, rhoU, rhoE], self)
         args = [rho, rhoU, rhoE, self.dt] + meshArgs + sourceArgs + BCArgs + extraArgs
-        outputs = [rhoN, rhoUN, rhoEN, self.dtc, self.obj]
+        # objective function can return multiple objectives
+        objectives = self.obj
+        if not isinstance(objectives, (tuple, list)):
+            objectives = [objectives]
+        self.nObjectives = len(objectives)
+        outputs = [rhoN, rhoUN, rhoEN, self.dtc] + list(objectives)
         io_map = {0: 0, 1:1, 2:2}
         #io_map = {}
         self.map = Function('primal', args, outputs, io_map=io_map)
+        # same step with the norms of the right hand side at the inputs
+        if self.residualInterval > 0:
+            self.mapMonitor = Function('primal_monitor', args, outputs + self.residualNorms(), io_map=io_map)
+        # same step with the error estimate of an embedded pair for run
+        if timestep.isEmbedded(self.timeStepCoeff):
+            self.mapEmbedded = Function('primal_embedded', args, outputs + [self.stepError], io_map=io_map)
+        if self.subCycles > 1:
+            outputs = self.subCycle([rhoN, rhoUN, rhoEN], objectives)
+            self.mapSubCycle = Function('primal_subcycle', args, outputs, io_map=io_map)
+        # right hand side, convective limits and objectives at the inputs for
+        # multigrid
+        if self.localTimeStep and self.multigridLevels > 1:
+            self.mapResidual = Function('primal_residual', args, self.residual([rho, rhoU, rhoE]))
+        # explicit convective and source terms and implicit viscous terms
+        # for imex
+        if self.imex:
+            self.mapConvective = Function('primal_convective', args, self.residual([rho, rhoU, rhoE], 'convective'))
+            self.mapViscous = Function('primal_viscous', args, self.residual([rho, rhoU, rhoE], 'viscous'))
+
+    def _nextTimeStep(self, dtc, dt):
+        dtc, dt = dtc.scalar(), dt.scalar()
+        if self.fixedTimeStep:
+            return dt
+        dtN, dtS = 2*self.CFL/dtc, dt*self.stepFactor
+        return Tensor.switch(dtN < dtS, dtN, dtS)
+
+    # subCycles steps in one map call, the time step of every step after the
+    # first is computed from dtc of the previous one as in run, outputs are the
+    # fields, dtc of the last step and the time step and objectives of every step
+    def subCycle(self, fields, objectives):
+        dt0 = dt = self.dt
+        stepOutputs = [dt] + list(objectives)
+        for step in range(1, self.subCycles):
+            (dtc,) = ExternalFunctionOp('mpi_allreduce_max', (self.dtc,), (Zeros((1,1)),)).outputs
+            dt = Kernel(self._nextTimeStep)(1, (Zeros((1,1)),))(dtc, dt)
+            self.dt = dt
+            self.stage = 0
+            fields = timestep.timeStepper(self.equation, list(fields), self)
+            objectives = self.obj
+            if not isinstance(objectives, (tuple, list)):
+                objectives = [objectives]
+            stepOutputs += [dt] + list(objectives)
+        self.dt = dt0
+        return list(fields) + [self.dtc] + stepOutputs
+
+    # volume weighted sum of squares and maximum square of the right hand
+    # side of every field at the input state, reduced over processors
+    def residualNorms(self):
+        mesh = self.mesh.symMesh
+        n = len(self.names)
+        LHS, S = self.applySource(self.residuals)
+        def _squares(*args, **kwargs):
+            nS = kwargs['nS']
+            LHS, S = args[:n], args[n:n+nS]
+            squares = []
+            for index in range(0, n):
+                R = LHS[index]-S[index] if nS > 0 else LHS[index]
+                squares.append(R*R if self.dimensions[index] == (1,) else R.dot(R))
+            return tuple(squares)
+        def _sum(*args):
+            squares, volumes = args[:-1], args[-1]
+            return tuple([(phi*volumes).sum() for phi in squares])
+        def _max(*args):
+            return tuple([phi.reduce_max() for phi in args])
+        squares = Kernel(_squares)(mesh.nInternalCells)(*(list(LHS) + S), nS=len(S))
+        norms = Kernel(_sum)(mesh.nInternalCells, tuple([Zeros((1,1)) for index in range(0, n)]))(*(list(squares) + [mesh.volumes]))
+        norms = ExternalFunctionOp('mpi_allreduce', norms, tuple([Zeros((1,1)) for index in range(0, n)])).outputs
+        maxNorms = Kernel(_max)(mesh.nInternalCells, tuple([Zeros((1,1)) for index in range(0, n)]))(*squares)
+        maxNorms = ExternalFunctionOp('mpi_allreduce_max', maxNorms, tuple([Zeros((1,1)) for index in range(0, n)])).outputs
+        return list(norms) + list(maxNorms)
+
+    # dU/dt of the semi discrete equations, outputs are laid out as in the map
+    # with the convective limit of every cell at the end, the equation outputs
+    # of the time stepper are left unchanged, the convective part includes
+    # the sources and the viscous part is only the right hand side
+    def residual(self, fields, part=None):
+        mesh = self.mesh.symMesh
+        stage, dtc, obj, dtcCells, residuals = self.stage, self.dtc, self.obj, self.dtcCells, self.residuals
+        self.stage = 0
+        self.fluxPart = part
+        LHS = self.equation(*fields)
+        self.fluxPart = None
+        if part == 'viscous':
+            def _negate(*args):
+                return tuple([-phi for phi in args])
+            R = Kernel(_negate)(mesh.nInternalCells)(*LHS)
+            self.stage, self.dtc, self.obj, self.dtcCells, self.residuals = stage, dtc, obj, dtcCells, residuals
+            return list(R)
+        LHS, S = self.applySource(LHS)
+        def _residual(*args, **kwargs):
+            nS = kwargs['nS']
+            n = len(args) - nS
+            LHS, S = args[:n], args[n:]
+            if nS > 0:
+                return tuple([-(LHS[index]-S[index]) for index in range(0, n)])
+            return tuple([-phi for phi in LHS])
+        R = Kernel(_residual)(mesh.nInternalCells)(*(list(LHS) + S), nS=len(S))
+        objectives = self.obj
+        if not isinstance(objectives, (tuple, list)):
+            objectives = [objectives]
+        outputs = list(R) + [self.dtc] + list(objectives) + [self.dtcCells]
+        self.stage, self.dtc, self.obj, self.dtcCells, self.residuals = stage, dtc, obj, dtcCells, residuals
+        return outputs
+
+    # estimate of the largest eigenvalue of the viscous operator in every
+    # cell, diffusivity over the square of the cell size
+    def viscousLimit(self, states):
+        mesh = self.mesh
+        rho, rhoU, rhoE = [phi.astype(np.float64) for phi in states]
+        e = rhoE/rho - 0.5*(rhoU*rhoU).sum(axis=1, keepdims=True)/(rho*rho)
+        T = np.maximum(e/self.Cv, config.VSMALL)
+        nu = (self.mu(T)/rho*max(1., self.gamma/self.Pr)).flatten()
+        n, nInternalFaces, nFaces = mesh.nInternalCells, mesh.nInternalFaces, mesh.nFaces
+        D = (mesh.areas[:nFaces]/mesh.deltas[:nFaces]).flatten()
+        D = np.bincount(mesh.owner[:nFaces], weights=D, minlength=n)[:n] + \
+            np.bincount(mesh.neighbour[:nInternalFaces], weights=D[:nInternalFaces], minlength=n)[:n]
+        return (nu*D/mesh.volumes.flatten()).reshape(-1,1)
     
         
     def getBoundaryTensor(self, index=0):
@@ -143,7 +271,7 @@ class RCF(Solver):
         return self.getFields(newFields, IOField, refFields=fields)
     
     @config.timeFunction('Time for writing fields')
-    def writeFields(self, fields, t):
+    def writeFields(self, fields, t, suffix=''):
         n = len(self.names)
         fields, rest = fields[:n], fields[n:]
         fields = self.initFields(fields)
@@ -153,7 +281,9 @@ class RCF(Solver):
 
         with IOField.handle(t):
             for phi in fields + self.fields + rest:
-                phi.write(skipProcessor=True)
+                name = phi.name
+                phi.write(name + suffix, skipProcessor=True)
+                phi.name = name
             if self.dynamicMesh:
                 self.mesh.write(IOField._handle)
         return
@@ -254,6 +384,7 @@ class RCF(Solver):
         mesh = Mesh.container(mesh)
         neighbour = options.pop('neighbour', True)
         characteristic = options.pop('characteristic', False)
+        part = options.pop('part', None)
         P, N = mesh.owner, mesh.neighbour
 
         ULF = faceInterpolator(U, gradU, mesh, 0)
@@ -266,8 +397,9 @@ class RCF(Solver):
         if characteristic:
             URF, TRF, pRF = UR, TR, p.extract(N)
             rhoRF, rhoURF, rhoERF = self.conservative(URF, TRF, pRF)
-            rhoFlux, rhoUFlux, rhoEFlux = self.boundaryRiemannSolver(self.gamma, pLF, pRF, TLF, TRF, ULF, URF, \
-            rhoLF, rhoRF, rhoULF, rhoURF, rhoELF, rhoERF, mesh.normals)
+            if part != 'viscous':
+                rhoFlux, rhoUFlux, rhoEFlux = self.boundaryRiemannSolver(self.gamma, pLF, pRF, TLF, TRF, ULF, URF, \
+                rhoLF, rhoRF, rhoULF, rhoURF, rhoELF, rhoERF, mesh.normals)
             TF = TR
             UF = UR
             gradTF = gradT.extract(N)
@@ -277,8 +409,9 @@ class RCF(Solver):
             TRF = faceInterpolator(T, gradT,  mesh, 1)
             pRF = faceInterpolator(p, gradp, mesh, 1)
             rhoRF, rhoURF, rhoERF = self.conservative(URF, TRF, pRF)
-            rhoFlux, rhoUFlux, rhoEFlux = self.riemannSolver(self.gamma, pLF, pRF, TLF, TRF, ULF, URF, \
-            rhoLF, rhoRF, rhoULF, rhoURF, rhoELF, rhoERF, mesh.normals)
+            if part != 'viscous':
+                rhoFlux, rhoUFlux, rhoEFlux = self.riemannSolver(self.gamma, pLF, pRF, TLF, TRF, ULF, URF, \
+                rhoLF, rhoRF, rhoULF, rhoURF, rhoELF, rhoERF, mesh.normals)
             # more accurate
             UF = 0.5*(ULF + URF)
             TF = 0.5*(TLF + TRF)
@@ -290,9 +423,12 @@ class RCF(Solver):
             gradTF = 0.5*(gradT.extract(P) + gradT.extract(N))
             gradUF = 0.5*(gradU.extract(P) + gradU.extract(N))
 
-        ret = self.viscousFlux(TL, TR, UL, UR, TF, UF, gradTF, gradUF, mesh)
-        rhoUFlux += ret[0]
-        rhoEFlux += ret[1]
+        if part == 'viscous':
+            rhoFlux, rhoUFlux, rhoEFlux = 0.*rhoLF, 0.*rhoULF, 0.*rhoELF
+        if part != 'convective':
+            ret = self.viscousFlux(TL, TR, UL, UR, TF, UF, gradTF, gradUF, mesh)
+            rhoUFlux += ret[0]
+            rhoEFlux += ret[1]
 
         drho = div(rhoFlux, mesh, neighbour)
         drhoU = div(rhoUFlux, mesh, neighbour)
@@ -304,8 +440,9 @@ class RCF(Solver):
 
         return drho, drhoU, drhoE, dtc
 
-    def boundaryFlux(self, U, T, p, gradU, gradT, gradp, *mesh):
+    def boundaryFlux(self, U, T, p, gradU, gradT, gradp, *mesh, **options):
         mesh = Mesh.container(mesh)
+        part = options.pop('part', None)
         P, N = mesh.owner, mesh.neighbour
 
         # boundary extraction could be done using cellstartface
@@ -316,9 +453,12 @@ class RCF(Solver):
         UL = U.extract(P)
 
         rhoFlux, rhoUFlux, rhoEFlux = self.getFlux(UR, TR, pR, mesh.normals)
-        ret = self.viscousFlux(TL, TR, UL, UR, TR, UR, gradTR, gradUR, mesh)
-        rhoUFlux += ret[0]
-        rhoEFlux += ret[1]
+        if part == 'viscous':
+            rhoFlux, rhoUFlux, rhoEFlux = 0.*rhoFlux, 0.*rhoUFlux, 0.*rhoEFlux
+        if part != 'convective':
+            ret = self.viscousFlux(TL, TR, UL, UR, TR, UR, gradTR, gradUR, mesh)
+            rhoUFlux += ret[0]
+            rhoEFlux += ret[1]
 
         drho = div(rhoFlux, mesh, False)
         drhoU = div(rhoUFlux, mesh, False)
@@ -384,22 +524,27 @@ class RCF(Solver):
         outputs = self.boundaryEnd(*outputs)
         gradU, gradT, gradp = outputs
         
+        part = self.fluxPart
+        if part is None:
+            _flux, _coupledFlux, _characteristicFlux, _boundaryFlux = self._flux, self._coupledFlux, self._characteristicFlux, self._boundaryFlux
+        else:
+            _flux, _coupledFlux, _characteristicFlux, _boundaryFlux = self._fluxParts[part]
         meshArgs = _meshArgs()
         drho, drhoU, drhoE = Zeros((mesh.nInternalCells, 1)), Zeros((mesh.nInternalCells, 3)), Zeros((mesh.nInternalCells, 1))
         dtc = Zeros((mesh.nInternalCells, 1))
-        outputs = self._flux(mesh.nInternalFaces, (drho, drhoU, drhoE, dtc))(U, T, p, gradU, gradT, gradp, *meshArgs)
+        outputs = _flux(mesh.nInternalFaces, (drho, drhoU, drhoE, dtc))(U, T, p, gradU, gradT, gradp, part=part, *meshArgs)
         for patchID in self.mesh.sortedPatches:
             startFace, nFaces = mesh.boundary[patchID]['startFace'], mesh.boundary[patchID]['nFaces']
             patchType = self.mesh.boundary[patchID]['type']
             meshArgs = _meshArgs(startFace)
             if patchType in config.coupledPatches:
-                outputs = self._coupledFlux(nFaces, outputs)(U, T, p, gradU, gradT, gradp, characteristic=False, neighbour=False, *meshArgs)
+                outputs = _coupledFlux(nFaces, outputs)(U, T, p, gradU, gradT, gradp, characteristic=False, neighbour=False, part=part, *meshArgs)
             elif patchType == 'characteristic':
-                outputs = self._characteristicFlux(nFaces, outputs)(U, T, p, gradU, gradT, gradp, characteristic=True, neighbour=False, *meshArgs)
+                outputs = _characteristicFlux(nFaces, outputs)(U, T, p, gradU, gradT, gradp, characteristic=True, neighbour=False, part=part, *meshArgs)
             else:
-                outputs = self._boundaryFlux(nFaces, outputs)(U, T, p, gradU, gradT, gradp, *meshArgs)
+                outputs = _boundaryFlux(nFaces, outputs)(U, T, p, gradU, gradT, gradp, part=part, *meshArgs)
         meshArgs = _meshArgs(mesh.nLocalFaces)
-        outputs = self._coupledFlux(mesh.nRemoteCells, outputs)(U, T, p, gradU, gradT, gradp, characteristic=False, neighbour=False, *meshArgs)
+        outputs = _coupledFlux(mesh.nRemoteCells, outputs)(U, T, p, gradU, gradT, gradp, characteristic=False, neighbour=False, part=part, *meshArgs)
         drho, drhoU, drhoE, dtc = outputs
 
         def _minDtc(dtc):
@@ -409,8 +554,12 @@ class RCF(Solver):
         minDtc = Zeros((1, 1))
         minDtc = Kernel(_minDtc)(mesh.nInternalCells, (minDtc,))(dtc)
 
-        if self.stage == 1:
+        # convective limit, objectives and right hand side at the input
+        # state of the step
+        if self.stage == 0:
             self.dtc, self.obj = minDtc, obj
+            self.dtcCells = dtc
+            self.residuals = (drho, drhoU, drhoE)
         return drho, drhoU, drhoE
 
     def boundary(self, U, T, p):
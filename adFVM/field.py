@@ -120,6 +120,35 @@ class Field(object):
     def __truediv__(self, phi):
         return self.__div__(phi)
 
+# field values only on a subset of the cells, field[i] is the value at indices[i]
+class SparseField(Field):
+    def __init__(self, name, indices, field, dimensions):
+        super(SparseField, self).__init__(name, field, dimensions)
+        self.indices = np.asarray(indices, np.int32).flatten()
+        assert self.field.shape[0] == self.indices.shape[0]
+
+    @classmethod
+    def fromDense(self, name, field, dimensions):
+        field = np.asarray(field)
+        nRows = field.shape[0]
+        indices = np.nonzero((field.reshape(nRows, -1) != 0.).any(axis=1))[0]
+        return self(name, indices, field[indices], dimensions)
+
+    def toDense(self, nRows):
+        field = np.zeros((nRows,) + self.dimensions, self.field.dtype)
+        field[self.indices] = self.field
+        return field
+
+    def copy(self):
+        return self.__class__(self.name, self.indices, self.field.copy(), self.dimensions)
+
+    def __neg__(self):
+        return self.__class__('-{0}'.format(self.name), self.indices, -self.field, self.dimensions)
+
+    def __mul__(self, phi):
+        assert isinstance(phi, Number)
+        return self.__class__('{0}*{1}'.format(self.name, phi), self.indices, self.field * phi, self.dimensions)
+
 class CellField(Field):
     def __init__(self, name, field, dimensions, boundary={}):
         logger.debug('initializing CellField {0}'.format(name))
@@ -0,0 +1,78 @@
+import numpy as np
+
+from . import config, parallel
+
+# vectors are the unknowns local to a processor, inner products are global
+def dot(a, b):
+    return parallel.sum(np.dot(a, b))
+
+def norm(a):
+    return np.sqrt(dot(a, a))
+
+# restarted gmres with right preconditioning from a zero guess, matvec and
+# precondition are only called collectively so every processor takes the
+# same number of iterations, returns the solution, the number of matvecs
+# and the relative residual
+def gmres(matvec, b, precondition=lambda v: v, tolerance=1e-2, restart=20, maxRestarts=2):
+    x = np.zeros_like(b)
+    bNorm = norm(b)
+    if bNorm == 0.:
+        return x, 0, 0.
+    r = b
+    iterations = 0
+    for cycle in range(0, maxRestarts):
+        beta = norm(r)
+        residual = beta/bNorm
+        if residual <= tolerance:
+            break
+        V, Z = [r/beta], []
+        H = np.zeros((restart + 1, restart))
+        g = np.zeros(restart + 1)
+        g[0] = beta
+        for j in range(0, restart):
+            Z.append(precondition(V[j]))
+            w = matvec(Z[j])
+            iterations += 1
+            # modified gram schmidt
+            for i in range(0, j + 1):
+                H[i, j] = dot(w, V[i])
+                w = w - H[i, j]*V[i]
+            H[j + 1, j] = norm(w)
+            y = np.linalg.lstsq(H[:j+2, :j+1], g[:j+2], rcond=None)[0]
+            residual = np.linalg.norm(g[:j+2] - np.dot(H[:j+2, :j+1], y))/bNorm
+            if residual <= tolerance or H[j + 1, j] <= config.VSMALL*beta:
+                break
+            V.append(w/H[j + 1, j])
+        for k in range(0, len(y)):
+            x = x + y[k]*Z[k]
+        if residual <= tolerance or cycle == maxRestarts - 1:
+            break
+        r = b - matvec(x)
+        iterations += 1
+    return x, iterations, residual
+
+# jacobian free newton krylov for function(x) = 0 starting from x, jacobian
+# vector products are forward differences of function with the step size of
+# Solver.getPerturbationSize, stops when the residual norm is reduced by
+# tolerance, returns the solution and the iteration statistics
+def newtonKrylov(function, x, precondition=lambda v: v, tolerance=1e-3, maxIterations=4, \
+                 linearTolerance=1e-2, restart=20, maxRestarts=2):
+    stats = {'newton': 0, 'gmres': 0, 'residual': 0.}
+    F = function(x)
+    FNorm0 = FNorm = norm(F)
+    while stats['newton'] < maxIterations and FNorm > tolerance*FNorm0:
+        xNorm = norm(x)
+        def matvec(v):
+            vNorm = norm(v)
+            if vNorm == 0.:
+                return np.zeros_like(v)
+            eps = np.sqrt(np.finfo(config.precision).eps)*(1 + xNorm)/vNorm
+            return (function(x + eps*v) - F)/eps
+        delta, iterations, _ = gmres(matvec, -F, precondition, linearTolerance, restart, maxRestarts)
+        x = x + delta
+        F = function(x)
+        FNorm = norm(F)
+        stats['newton'] += 1
+        stats['gmres'] += iterations
+    stats['residual'] = FNorm/FNorm0 if FNorm0 > 0. else 0.
+    return x, stats
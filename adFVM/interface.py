@@ -4,6 +4,7 @@ import subprocess
 import numpy as np
 import shutil
 import glob
+import hashlib
 
 from .mesh import Mesh
 import h5py
@@ -15,19 +16,109 @@ def isfloat(s):
     except ValueError:
         return False
 
+# content addressed store of the immutable case files, entries are named
+# by their checksum and linked into the case directories
+class CaseStore(object):
+    def __init__(self, root):
+        self.root = root
+        try:
+            os.makedirs(root)
+        except OSError:
+            assert os.path.isdir(root)
+        self.digests = {}
+        self.verified = set()
+
+    def getFiles(self, path):
+        if not os.path.isdir(path):
+            return [path]
+        files = []
+        for dirPath, dirNames, fileNames in os.walk(path):
+            dirNames.sort()
+            files.extend([os.path.join(dirPath, name) for name in sorted(fileNames)])
+        return files
+
+    def getStat(self, path):
+        stats = []
+        for fileName in self.getFiles(path):
+            stat = os.stat(fileName)
+            stats.append((os.path.relpath(fileName, path), stat.st_size, stat.st_mtime))
+        return tuple(stats)
+
+    def checksum(self, path):
+        sha = hashlib.sha1()
+        for fileName in self.getFiles(path):
+            sha.update(os.path.relpath(fileName, path).encode())
+            with open(fileName, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(chunk)
+        return sha.hexdigest()
+
+    def add(self, path):
+        # sources are hashed again only when they change
+        stat = self.getStat(path)
+        if path in self.digests and self.digests[path][0] == stat:
+            digest = self.digests[path][1]
+        else:
+            digest = self.checksum(path)
+            self.digests[path] = (stat, digest)
+        entry = self.root + digest
+        # entries modified through a link are replaced
+        if os.path.exists(entry) and entry not in self.verified:
+            if self.checksum(entry) != digest:
+                self.remove(entry)
+        if not os.path.exists(entry):
+            tempEntry = '{}.{}.tmp'.format(entry, os.getpid())
+            if os.path.isdir(path):
+                shutil.copytree(path, tempEntry)
+            else:
+                shutil.copy(path, tempEntry)
+            try:
+                os.rename(tempEntry, entry)
+            except OSError:
+                # added concurrently by another case
+                self.remove(tempEntry)
+        self.verified.add(entry)
+        return entry
+
+    def remove(self, path):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+    def link(self, path, target):
+        entry = self.add(path)
+        if not os.path.isdir(entry):
+            try:
+                os.link(entry, target)
+                return
+            except OSError:
+                pass
+        os.symlink(os.path.abspath(entry), target)
+        return
+
 class Runner(object):
     fieldNames = ['rho', 'rhoU', 'rhoE']
     reference = [1., 200., 2e5]
     primalSolver = os.path.expanduser('~') + '/adFVM/apps/problem.py'
     adjointSolver = os.path.expanduser('~') + '/adFVM/apps/adjoint.py'
+    inProcess = False
+    # not modified by the solvers, shared by all cases
+    caseFiles = ['mesh.hdf5', 'gencode']
 
     def __init__(self, *args, **kwargs):
         return
 
+    def getCaseStore(self):
+        if getattr(self, 'caseStore', None) is None:
+            self.caseStore = CaseStore(self.base + 'store/')
+        return self.caseStore
+
     def copyCase(self, case):
         os.makedirs(case)
-        shutil.copy(self.base + 'mesh.hdf5', case)
-        shutil.copytree(self.base + 'gencode', case + 'gencode')
+        store = self.getCaseStore()
+        for name in Runner.caseFiles:
+            store.link(self.base + name, case + name)
         return
 
     def removeCase(self, case):
@@ -64,8 +155,10 @@ class SerialRunner(Runner):
         self.nProcs = nProcs
         self.flags = flags
         self.internalCells = self.getInternalCells(base)
-        self.fieldsShape = len(self.internalCells)*5
+        self.fieldsShape = sum([end-start for start, end in self.internalCells])*5
 
+    # contiguous ranges of the internal cells of every processor in the
+    # field datasets, the gaps hold the ghost and boundary values
     def getInternalCells(self, case):
         internalCells = []
         with h5py.File(case + 'mesh.hdf5', 'r') as mesh:
@@ -75,46 +168,88 @@ class SerialRunner(Runner):
             start = 0
             for i in range(0, self.nProcs):
                 n = nInternalCells[i] 
-                internalCells.append(np.arange(start, start + n))
+                internalCells.append((start, start + n))
                 start += n + nGhostCells[i]
-        return np.concatenate(internalCells)
+        return internalCells
+
+    def getGhostCells(self, size):
+        ends = [end for _, end in self.internalCells]
+        starts = [start for start, _ in self.internalCells[1:]] + [size]
+        return [(end, start) for end, start in zip(ends, starts) if start > end]
+
+    def getFieldName(self, name, adjoint=False, column=0):
+        if adjoint:
+            name = name + 'a'
+        if column > 0:
+            name = '{}_{}'.format(name, column)
+        return name
 
-    def readFields(self, case, time, adjoint=False):
+    def readFields(self, case, time, adjoint=False, column=0):
         fields = []
         with h5py.File(case + Mesh.getTimeString(time) + '.hdf5', 'r') as phi:
             for name in Runner.fieldNames:
-                if adjoint:
-                    name = name + 'a'
-                fields.append(phi[name + '/field'][:][self.internalCells])
+                name = self.getFieldName(name, adjoint, column)
+                data = phi[name + '/field']
+                fields.append(np.concatenate([data[start:end] for start, end in self.internalCells]))
         if adjoint:
             fields = [x*y for x, y in zip(fields, Runner.reference)]
         else:
             fields = [x/y for x, y in zip(fields, Runner.reference)]
         return np.hstack(fields).ravel()
 
-    def writeFields(self, fields, case, time, adjoint=False):
-        fields = fields.reshape((fields.shape[0]/5, 5))
+    # new time file with the layout of the base one, only the ghost
+    # and boundary values of the fields are read from it
+    def createTimeFile(self, timeFile):
+        with h5py.File(self.base + self.stime + '.hdf5', 'r') as template, \
+             h5py.File(timeFile, 'w') as phi:
+            for name, group in template.items():
+                if not isinstance(group, h5py.Group) or 'field' not in group:
+                    template.copy(group, phi, name)
+                    continue
+                newGroup = phi.create_group(name)
+                for key, value in group.attrs.items():
+                    newGroup.attrs[key] = value
+                for key in group:
+                    if key != 'field':
+                        template.copy(group[key], newGroup, key)
+                data = group['field']
+                newData = newGroup.create_dataset('field', data.shape, data.dtype)
+                for start, end in self.getGhostCells(data.shape[0]):
+                    newData[start:end] = data[start:end]
+
+    def writeFields(self, fields, case, time, adjoint=False, column=0, copy=True):
+        fields = fields.reshape((fields.shape[0]//5, 5))
         fields = fields[:,[0]], fields[:,1:4], fields[:,[4]]
         if adjoint:
             fields = [x/y for x, y in zip(fields, Runner.reference)]
         else:
             fields = [x*y for x, y in zip(fields, Runner.reference)]
         timeFile = case + Mesh.getTimeString(time) + '.hdf5' 
-        shutil.copy(self.base + self.stime + '.hdf5', timeFile)
+        if copy:
+            self.createTimeFile(timeFile)
         with h5py.File(timeFile, 'r+') as phi:
             for index, name in enumerate(Runner.fieldNames):
-                if adjoint:
-                    name = name + 'a'
-                field = phi[name + '/field'][:]
-                field[self.internalCells] = fields[index]
-                phi[name + '/field'][:] = field
+                baseName = self.getFieldName(name, adjoint)
+                name = self.getFieldName(name, adjoint, column)
+                # extra adjoint columns start as copies of the first
+                if name not in phi:
+                    phi.copy(baseName, name)
+                data = phi[name + '/field']
+                offset = 0
+                for start, end in self.internalCells:
+                    data[start:end] = fields[index][offset:offset + end-start]
+                    offset += end-start
         return
 
-    def setupPrimal(self, initFields, primalData, case):
-        parameter, nSteps = primalData
+    def setupPrimal(self, initFields, primalData, case, startTime=None):
         # write initial field
-        self.writeFields(initFields, case, self.time)
+        startTime = self.time if startTime is None else startTime
+        self.writeFields(initFields, case, startTime)
+        return self.writeProblem(primalData, case, startTime)
 
+    def writeProblem(self, primalData, case, startTime=None):
+        parameter, nSteps = primalData
+        startTime = self.time if startTime is None else startTime
         # modify problem file
         problemFile = case + os.path.basename(self.problem)
         with open(self.problem, 'r') as f:
@@ -122,24 +257,32 @@ class SerialRunner(Runner):
         with open(problemFile, 'w') as f:
             for line in lines:
                 writeLine = line.replace('NSTEPS', str(nSteps))
-                writeLine = writeLine.replace('STARTTIME', str(self.time))
+                writeLine = writeLine.replace('STARTTIME', str(startTime))
                 writeLine = writeLine.replace('DT', str(self.dt))
                 writeLine = writeLine.replace('PARAMETER', str(parameter))
                 f.write(writeLine)
         return problemFile
 
+    def getTimes(self, case):
+        return sorted([float(x[:-5]) for x in os.listdir(case) if isfloat(x[:-5]) and x.endswith('.hdf5')])
+
     def getFinalTime(self, case):
-        return sorted([float(x[:-5]) for x in os.listdir(case) if isfloat(x[:-5]) and x.endswith('.hdf5')])[-1]
+        return self.getTimes(case)[-1]
 
-    def runPrimal(self, initFields, primalData, case, args=None):
+    # with nLastStates the states of the last steps up to the final
+    # fields are also returned, oldest first, the run starts at startTime
+    # if given instead of the time of the runner
+    def runPrimal(self, initFields, primalData, case, args=None, nLastStates=0, startTime=None):
         print(case)
-        problemFile = self.setupPrimal(initFields, primalData, case) 
+        problemFile = self.setupPrimal(initFields, primalData, case, startTime) 
 
         extraArgs = []
         if self.flags:
             extraArgs.extend(self.flags)
         if args:
-            extraArgs.append(args)
+            extraArgs.extend(args)
+        if nLastStates > 0:
+            extraArgs.extend(['--writeLast', str(nLastStates)])
         with open(case + 'output.log', 'w') as f, open(case + 'error.log', 'w') as fe:
             returncode = self.spawnJob([Runner.primalSolver, problemFile, 'source'] + extraArgs, stdout=f, stderr=fe, cwd=case)
         if returncode:
@@ -150,6 +293,9 @@ class SerialRunner(Runner):
         # read final fields
         finalFields = self.readFields(case, self.getFinalTime(case))
         # read objective values
+        if nLastStates > 0:
+            lastStates = [self.readFields(case, t) for t in self.getTimes(case)[-(nLastStates+1):]]
+            return finalFields, objectiveSeries, lastStates
         return finalFields, objectiveSeries 
 
 
@@ -185,6 +331,173 @@ class SerialRunner(Runner):
 
         return finalFields, dJds
 
+    # all adjoint vectors in one run sharing the primal recomputation,
+    # only the first column is inhomogeneous unless homogeneous
+    def runAdjointBatched(self, initAdjointFields, primalData, initPrimalFields, case, homogeneous=False, interprocess=None, args=None):
+        parameter, nSteps = primalData
+        print(case)
+        assert parameter == 0.0
+        nColumns = len(initAdjointFields)
+        problemFile = self.setupPrimal(initPrimalFields, (1.0, nSteps), case) 
+
+        finalTime = self.time + self.dt*nSteps
+        for column, fields in enumerate(initAdjointFields):
+            self.writeFields(fields, case, finalTime, adjoint=True, column=column, copy=(column == 0))
+
+        # only the first column is seeded with the objective, the compiled
+        # batch is fixed by the problem so the code of the base case is
+        # valid for any nColumns
+        extraArgs = ['--readFields', '--nColumns', str(nColumns), '--inhomogeneousColumns', '1']
+        if self.flags:
+            extraArgs.extend(self.flags)
+        if args:
+            extraArgs.extend(args)
+        if homogeneous:
+            extraArgs.append('--homogeneous')
+        with open(case + 'output.log', 'w') as f, open(case + 'error.log', 'w') as fe:
+            if interprocess:
+                returncode = self.spawnSlurmJob([Runner.adjointSolver, problemFile] + extraArgs, stdout=f, stderr=fe, cwd=case, interprocess=interprocess)
+            else:
+                returncode = self.spawnJob([Runner.adjointSolver, problemFile] + extraArgs, stdout=f, stderr=fe, cwd=case)
+        if returncode:
+            raise Exception('Execution failed, check error log in :', case)
+
+        finalFields = [self.readFields(case, self.time, adjoint=True, column=column) for column in range(0, nColumns)]
+        # rows of the sensitivity series hold the perturbations of every column
+        dJds = np.loadtxt(case + 'sensTimeSeries.txt', ndmin=2)
+        dJds = dJds.reshape(dJds.shape[0], nColumns, -1)
+        dJds = [dJds[:,column].reshape(-1,1).flatten() for column in range(0, nColumns)]
+
+        return finalFields, dJds
+
+class InProcessRunner(SerialRunner):
+    # keeps one primal and adjoint solver alive in this process, compiled
+    # maps stay warm between segments and fields are exchanged as arrays,
+    # so a segment costs only its time steps. Solver flags are those
+    # of the calling process, case directories are not used
+    inProcess = True
+
+    def __init__(self, base, time, dt, problem, nProcs=1, flags=None):
+        assert nProcs == 1
+        super(InProcessRunner, self).__init__(base, time, dt, problem, nProcs=nProcs, flags=flags)
+        self.solvers = None
+
+    def copyCase(self, case):
+        return
+
+    def removeCase(self, case):
+        return
+
+    def getSolvers(self):
+        if self.solvers is not None:
+            return self.solvers
+        from . import config
+        # problem file with a unit parameter, perturbations are scaled
+        problemFile = self.writeProblem((1.0, 1), self.base)
+        config.args = [problemFile]
+        sys.path.insert(0, os.path.dirname(Runner.adjointSolver))
+        cwd = os.getcwd()
+        os.chdir(self.base)
+        try:
+            import adjoint as module
+            primal = module.primal
+            primal.readFields(self.time)
+            adjoint = module.Adjoint(primal)
+            adjoint.compile()
+            adjoint.createFields(primal.nObjectives)
+        finally:
+            os.chdir(cwd)
+        self.solvers = primal, adjoint, module
+        return self.solvers
+
+    def getArrays(self, fields, adjoint=False):
+        from . import config
+        fields = fields.reshape((-1, 5))
+        fields = fields[:,[0]], fields[:,1:4], fields[:,[4]]
+        if adjoint:
+            fields = [x/y for x, y in zip(fields, Runner.reference)]
+        else:
+            fields = [x*y for x, y in zip(fields, Runner.reference)]
+        return [np.ascontiguousarray(x, config.precision) for x in fields]
+
+    def getVector(self, fields, adjoint=False):
+        if adjoint:
+            fields = [x*y for x, y in zip(fields, Runner.reference)]
+        else:
+            fields = [x/y for x, y in zip(fields, Runner.reference)]
+        return np.hstack(fields).ravel()
+
+    def getPerturbation(self, module, parameter):
+        perturb = module.perturb[0]
+        def scaledPerturb(fields, mesh, t):
+            values = perturb(fields, mesh, t)
+            if isinstance(values, (list, tuple)):
+                return [parameter*x for x in values]
+            return parameter*values
+        return module.parameters, scaledPerturb
+
+    def runPrimal(self, initFields, primalData, case, args=None, nLastStates=0, startTime=None):
+        parameter, nSteps = primalData
+        primal, adjoint, module = self.getSolvers()
+        perturbation = None
+        if parameter != 0.0:
+            perturbation = self.getPerturbation(module, parameter)
+        startTime = self.time if startTime is None else startTime
+        fields, objectiveSeries = primal.run(startTime=startTime, dt=self.dt, nSteps=nSteps, 
+                                             mode='segment', source=module.source, perturbation=perturbation,
+                                             reportInterval=module.reportInterval, fields=self.getArrays(initFields),
+                                             nLastStates=nLastStates)
+        objectiveSeries = np.array(objectiveSeries).reshape(-1,1).flatten()
+        objectiveSeries = np.concatenate((objectiveSeries, [objectiveSeries[-1]]))
+
+        finalFields = self.getVector([phi.field for phi in fields])
+        if nLastStates > 0:
+            lastStates = [self.getVector([phi.field for phi in state]) for state in primal.lastStates]
+            return finalFields, objectiveSeries, lastStates
+        return finalFields, objectiveSeries
+
+    def runAdjoint(self, initAdjointFields, primalData, initPrimalFields, case, homogeneous=False, interprocess=None, args=None):
+        primal, adjoint, module = self.getSolvers()
+        nColumns = max(1, primal.nObjectives)
+        initAdjointFields = [initAdjointFields] + [np.zeros_like(initAdjointFields)]*(nColumns-1)
+        finalFields, dJds = self.runAdjointBatched(initAdjointFields, primalData, initPrimalFields, case, homogeneous=homogeneous, inhomogeneousColumns=nColumns)
+        # same layout as the sensitivity series of a single run
+        dJds = np.stack([x.reshape(-1, module.nPerturb) for x in dJds], axis=1).flatten()
+        return finalFields[0], dJds
+
+    # every column is seeded with the objective of the same index up to
+    # inhomogeneousColumns, NILSAS seeds only the first
+    def runAdjointBatched(self, initAdjointFields, primalData, initPrimalFields, case, homogeneous=False, interprocess=None, args=None, inhomogeneousColumns=1):
+        parameter, nSteps = primalData
+        # default parameter is always zero
+        assert parameter == 0.0
+        primal, adjoint, module = self.getSolvers()
+        mesh = primal.mesh
+        nColumns = len(initAdjointFields)
+        if adjoint.nColumns != nColumns:
+            adjoint.createFields(nColumns)
+        adjoint.nSteps = adjoint.writeInterval = nSteps
+        adjoint.homogeneousAdjoint = homogeneous
+        adjoint.inhomogeneousColumns = inhomogeneousColumns
+
+        times = self.time + np.arange(0, nSteps + 1)*self.dt
+        dts = np.ones(nSteps + 1)*self.dt
+        dts[-1] = 0.
+        timeSteps = np.column_stack((times.round(12), dts))
+
+        columns = []
+        for fields, columnFields in zip(initAdjointFields, adjoint.columnFields):
+            fields = [x*mesh.volumes for x in self.getArrays(fields, adjoint=True)]
+            columns.append(adjoint.getFields(fields, module.IOField, refFields=columnFields))
+        result = [0.]*(module.nPerturb*nColumns)
+        columns, sensTimeSeries = adjoint.run((result, 0), (timeSteps,), columns=columns, 
+                                              primalFields=self.getArrays(initPrimalFields), write=False)
+
+        finalFields = [self.getVector([phi.field/mesh.volumes for phi in fields], adjoint=True) for fields in columns]
+        dJds = np.array(sensTimeSeries).reshape(-1, nColumns, module.nPerturb)
+        dJds = [dJds[:,column].reshape(-1,1).flatten() for column in range(0, nColumns)]
+        return finalFields, dJds
+
 #class ParallelRunner(Runner):
     #def __init__(self):
         #raise NotImplemented
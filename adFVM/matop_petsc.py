@@ -1,4 +1,4 @@
-from . import config
+from . import config, parallel
 from .parallel import pprint
 
 from .interp import central
@@ -15,10 +15,36 @@ try:
 except:
     pprint('could not load petsc4py')
 
+def _getKSP(A):
+    ksp = PETSc.KSP()
+    ksp.create(PETSc.COMM_WORLD)
+
+    #ksp.setType('preonly')
+    #pc = ksp.getPC()
+    #pc.setType('lu')
+    #pc.setFactorSolverPackage('mumps')
+    #pc.setFactorSolverPackage('superlu_dist')
+
+    ksp.setType('gmres')
+    #ksp.setType('gcr')
+    #ksp.setType('bcgs')
+    #ksp.setType('tfqmr')
+    #ksp.getPC().setType('jacobi')
+    #ksp.getPC().setType('asm')
+    #ksp.getPC().setType('mg')
+    #ksp.getPC().setType('gamg')
+    # which one is used?
+    ksp.getPC().setType('hypre')
+    ksp.setOperators(A)
+    #ksp.setComputeSingularValues(eigenvalues)
+    ksp.setFromOptions()
+    return ksp
+
 class Matrix(object):
-    def __init__(self, A, b):
+    def __init__(self, A, b, operator=None):
         self.A = A
         self.b = b
+        self.operator = operator
 
     @classmethod
     def create(self, m, n, nnz=(2,1), nrhs=1):
@@ -28,6 +54,11 @@ class Matrix(object):
         A.setType('aij')
         A.setPreallocationNNZ(nnz) 
 
+        b = self.createRHS(m, nrhs)
+        return self(A, b)
+
+    @classmethod
+    def createRHS(self, m, nrhs):
         b = PETSc.Mat()
         b.create(PETSc.COMM_WORLD)
         b.setSizes(((m, PETSc.DECIDE), (PETSc.DECIDE, nrhs)))
@@ -36,7 +67,7 @@ class Matrix(object):
 
         #b = A.createVecLeft()
         #b.set(0)
-        return self(A, b)
+        return b
 
     def __add__(self, b):
         if isinstance(b, Matrix):
@@ -63,29 +94,9 @@ class Matrix(object):
         return self.__class__(b * self.A, b * self.b)
 
     def _getKSP(self, eigenvalues=False):
-        ksp = PETSc.KSP()
-        ksp.create(PETSc.COMM_WORLD)
-
-        #ksp.setType('preonly')
-        #pc = ksp.getPC()
-        #pc.setType('lu')
-        #pc.setFactorSolverPackage('mumps')
-        #pc.setFactorSolverPackage('superlu_dist')
-
-        ksp.setType('gmres')
-        #ksp.setType('gcr')
-        #ksp.setType('bcgs')
-        #ksp.setType('tfqmr')
-        #ksp.getPC().setType('jacobi')
-        #ksp.getPC().setType('asm')
-        #ksp.getPC().setType('mg')
-        #ksp.getPC().setType('gamg')
-        # which one is used?
-        ksp.getPC().setType('hypre')
-        ksp.setOperators(self.A)
-        #ksp.setComputeSingularValues(eigenvalues)
-        ksp.setFromOptions()
-        return ksp
+        if self.operator is not None:
+            return self.operator.getKSP()
+        return _getKSP(self.A)
 
     def eigenvalues(self):
         import slepc4py
@@ -110,85 +121,157 @@ class Matrix(object):
         X = []
 
         start = time.time()
+        iterations = []
         for i in range(0, self.b.getSize()[1]):
             x.set(0)
             b = self.b.getColumnVector(i)
             #ksp.setConvergenceHistory()
             ksp.solve(-b, x)
+            iterations.append(ksp.getIterationNumber())
             #conv = ksp.getConvergenceHistory()
             #pprint('convergence{0}:'.format(i), end='')
             #pprint(' '.join([str(y) for y in conv]))
             X.append(x.getArray().copy().reshape(-1,1))
         end = time.time()
+        if self.operator is not None:
+            self.operator.record(iterations, end-start)
+        pprint('Linear solver iterations:', iterations)
         pprint('Time to solve linear system:', end-start)
         return np.hstack(X)
 
-# cyclic and BC support
-def laplacian(phi, DT, correction=True):
-#def laplacian_new(phi, DT):
-    mesh = phi.mesh
-    nrhs = phi.dimensions[0]
-    n = mesh.nInternalCells
-    m = mesh.nInternalFaces
-    o = mesh.nLocalFaces
-
-    M = Matrix.create(n, n, (7, 6), nrhs)
-    A, b = M.A, M.b
+class Operator(object):
+    # assembled AIJ matrix and KSP for one operator type on a mesh, the
+    # sparsity pattern is built once and only the CSR values are updated
+    # in place every time step
+    _cache = {}
 
-    il, ih = A.getOwnershipRange()
-    jl, jh = A.getOwnershipRangeColumn()
-    #import pdb;pdb.set_trace()
+    @classmethod
+    def get(self, mesh, opType, nrhs):
+        key = (id(mesh), opType, nrhs)
+        if key not in self._cache:
+            self._cache[key] = self(mesh, nrhs)
+        return self._cache[key]
+
+    def __init__(self, mesh, nrhs, rebuildInterval=20):
+        self.mesh = mesh
+        self.nrhs = nrhs
+        self.rebuildInterval = rebuildInterval
+        self.nUpdates = 0
+        self.ksp = None
+        self.iterations = []
+        self.timings = []
+
+        n = mesh.nInternalCells
+        m = mesh.nInternalFaces
+        o = mesh.nLocalFaces
+        if parallel.nProcessors > 1:
+            ranges = np.cumsum([0] + parallel.mpi.allgather(n))
+        else:
+            ranges = np.array([0, n])
+        il = ranges[parallel.rank]
+        N = ranges[-1]
+
+        # every face of a cell contributes -w to the diagonal and +w to the
+        # neighbour column, w = faceData/volume of the row
+        cells = np.arange(0, n, dtype=np.int64)
+        nCellFaces = mesh.cellFaces.shape[1]
+        rows = [np.repeat(cells, nCellFaces)]
+        cellFaces = mesh.cellFaces.flatten()
+        faces = [cellFaces]
+        cols = [il + rows[0]]
+        signs = [-np.ones(len(cellFaces))]
+
+        cellNeighbours = mesh.getCellNeighbours(boundary=False).flatten()
+        internal = cellNeighbours > -1
+        rows.append(rows[0][internal])
+        faces.append(cellFaces[internal])
+        cols.append(il + cellNeighbours[internal])
+        signs.append(np.ones(internal.sum()))
+
+        for patchID in mesh.remotePatches:
+            patch = mesh.boundary[patchID]
+            startFace, endFace, _ = mesh.getPatchFaceRange(patchID)
+            proc = patch['neighbProcNo']
+            patchFaces = np.arange(startFace, endFace)
+            rows.append(mesh.owner[patchFaces])
+            faces.append(patchFaces)
+            cols.append(ranges[proc] + patch['loc_neighbourIndices'])
+            signs.append(np.ones(endFace-startFace))
+
+        # neumann
+        localFaces = np.arange(m, o)
+        rows.append(mesh.owner[localFaces])
+        faces.append(localFaces)
+        cols.append(il + mesh.owner[localFaces])
+        signs.append(np.ones(o-m))
+
+        rows, cols = np.concatenate(rows).astype(np.int64), np.concatenate(cols).astype(np.int64)
+        keys, self.slots = np.unique(rows*N + cols, return_inverse=True)
+        self.nnz = len(keys)
+        self.rows = rows
+        self.faces = np.concatenate(faces)
+        self.signs = np.concatenate(signs)
+        self.indptr = np.searchsorted(keys//N, np.arange(0, n + 1)).astype(PETSc.IntType)
+        self.indices = (keys % N).astype(PETSc.IntType)
+        self.diagonal = np.searchsorted(keys, cells*N + il + cells)
+        self.volumes = mesh.volumes.flatten()
+
+        self.A = PETSc.Mat()
+        self.A.create(PETSc.COMM_WORLD)
+        self.A.setSizes(((n, PETSc.DECIDE), (n, PETSc.DECIDE)))
+        self.A.setType('aij')
+        self.A.setPreallocationCSR((self.indptr, self.indices))
+        self.A.setOption(PETSc.Mat.Option.NEW_NONZERO_ALLOCATION_ERR, True)
+        self.b = Matrix.createRHS(n, nrhs)
+
+    def update(self, faceData, shift=0.):
+        values = self.signs*faceData[self.faces]/self.volumes[self.rows]
+        data = np.bincount(self.slots, weights=values, minlength=self.nnz)
+        data[self.diagonal] += shift
+        self.A.setValuesCSR(self.indptr, self.indices, data.astype(PETSc.ScalarType))
+        self.A.assemble()
+        self.nUpdates += 1
+        return self.A
+
+    def getKSP(self):
+        if self.ksp is None:
+            self.ksp = _getKSP(self.A)
+        # the preconditioner built for an earlier step is reused until
+        # it is rebuilt every rebuildInterval steps
+        rebuild = ((self.nUpdates - 1) % self.rebuildInterval) == 0
+        self.ksp.setReusePreconditioner(not rebuild)
+        return self.ksp
+
+    def record(self, iterations, timing):
+        self.iterations.append(iterations)
+        self.timings.append(timing)
+
+def _getFaceData(phi, DT, correction):
+    mesh = phi.mesh
     faceData = (mesh.areas*DT.field/mesh.deltas).flatten()
+    S, C = None, None
     if correction:
         s = mesh.cellCentres[mesh.neighbour]-mesh.cellCentres[mesh.owner]
         S = Field('S', s/np.linalg.norm(s, axis=1, keepdims=1), (3,))
         C = S.dot(mesh.Normals)
         faceData /= C.field.flatten()
+    return faceData, S, C
 
-    neighbourData = faceData[mesh.cellFaces]
-    neighbourData /= mesh.volumes
-    row = np.arange(0, n, dtype=np.int32).reshape(-1,1)
-    
-    col = mesh.cellNeighboursMatOp.copy()
-    col[col > -1] += jl
-    A.setValuesRCV(il + row, col, neighbourData)
+def _getCorrection(phi, DT, S, C):
+    mesh = phi.mesh
+    gradPhi = central(grad(central(phi, mesh), ghost=True, numpy=True), mesh)
+    return internal_sum_numpy(DT*gradPhi.dot(mesh.Normals-S/C), mesh)
 
-    cellData = -neighbourData.sum(axis=1, keepdims=1)
-    A.setValuesRCV(il + row, jl + row, cellData)
+# cyclic and BC support
+def laplacian(phi, DT, correction=True):
+#def laplacian_new(phi, DT):
+    mesh = phi.mesh
+    nrhs = phi.dimensions[0]
+    n = mesh.nInternalCells
 
-    ranges = A.getOwnershipRangesColumn()
-    for patchID in mesh.remotePatches:
-        patch = mesh.boundary[patchID]
-        startFace, endFace, _ = mesh.getPatchFaceRange(patchID)
-        proc = patch['neighbProcNo']
-        indices = mesh.owner[startFace:endFace]
-        neighbourIndices = patch['loc_neighbourIndices'].reshape(-1,1)
-        data = faceData[startFace:endFace].reshape(-1,1)/mesh.volumes[indices]
-        #print patchID, il, ranges[proc], indices, neighbourIndices
-        A.setValuesRCV(il + indices.reshape(-1,1),
-                       ranges[proc] + neighbourIndices,
-                       data)
-   
-    # dirichlet
-    #indices = mesh.owner[m:o]
-    #data = faceData[m:o].reshape(-1,1)*phi.field[mesh.neighbour[m:o]]/mesh.volumes[indices]
-    #cols = np.arange(0, nrhs).astype(np.int32)
-    #indices, inverse = np.unique(indices, return_inverse=True)
-    #uniqData = np.zeros((indices.shape[0], data.shape[1]))
-    #np.add.at(uniqData, inverse, data)
-    #b.setValues(il + indices, cols, uniqData, addv=PETSc.InsertMode.ADD_VALUES)
-
-    # neumann, how does this affect processor?
-    # cyclic support?
-    if o > m:
-    	indices = mesh.owner[m:o]
-    	data = faceData[m:o].reshape(-1,1)/mesh.volumes[indices]
-    	indices, inverse = np.unique(indices, return_inverse=True)
-    	uniqData = np.zeros((indices.shape[0], 1), config.precision)
-    	np.add.at(uniqData, inverse, data)
-    	indices = indices.reshape(-1,1)
-    	A.assemble()
-    	A.setValuesRCV(il + indices, jl + indices, uniqData, addv=PETSc.InsertMode.ADD_VALUES)
+    operator = Operator.get(mesh, 'laplacian', nrhs)
+    faceData, S, C = _getFaceData(phi, DT, correction)
+    A = operator.update(faceData)
 
     # TESTING
     #indices = np.arange(0, mesh.nInternalCells).astype(np.int32)
@@ -196,15 +279,14 @@ def laplacian(phi, DT, correction=True):
     #data = 1e10*np.ones((mesh.nInternalCells, nrhs), np.int32)
     #b.setValues(il + indices, cols, data, addv=PETSc.InsertMode.ADD_VALUES)
 
+    b = operator.b
+    b.zeroEntries()
     if correction:
-        indices = np.arange(0, mesh.nInternalCells).astype(np.int32)
+        il, ih = A.getOwnershipRange()
+        indices = np.arange(0, n).astype(np.int32)
         cols = np.arange(0, nrhs).astype(np.int32)
-
-        gradPhi = central(grad(central(phi, mesh), ghost=True, numpy=True), mesh)
-        data = internal_sum_numpy(DT*gradPhi.dot(mesh.Normals-S/C), mesh)
+        data = _getCorrection(phi, DT, S, C)
         b.setValues(il + indices, cols, data, addv=PETSc.InsertMode.ADD_VALUES)
-
-    A.assemble()
     b.assemble()
 
     #A.convert("dense")
@@ -212,8 +294,30 @@ def laplacian(phi, DT, correction=True):
     #    np.savetxt('Ab.txt', Ad)
     #    #np.savetxt('Ab.txt', b.getDenseArray())
 
-    return M
+    return Matrix(A, b, operator)
+
+def heat_equation(phi, DT, dt, correction=False):
+    # ddt(phi, dt) - laplacian(phi, DT) assembled in place, the KSP
+    # and preconditioner of the cached operator are reused across steps
+    mesh = phi.mesh
+    nrhs = phi.dimensions[0]
+    n = mesh.nInternalCells
+
+    operator = Operator.get(mesh, 'heat_equation', nrhs)
+    faceData, S, C = _getFaceData(phi, DT, correction)
+    A = operator.update(-faceData, 1./dt)
+
+    il, ih = A.getOwnershipRange()
+    indices = np.arange(0, n).astype(np.int32)
+    cols = np.arange(0, nrhs).astype(np.int32)
+    data = -phi.old[:n]/dt
+    if correction:
+        data = data - _getCorrection(phi, DT, S, C)
+    b = operator.b
+    b.setValues(il + indices, cols, data)
+    b.assemble()
 
+    return Matrix(A, b, operator)
 
 #def laplacian(phi, DT):
 def laplacian_old(phi, DT):
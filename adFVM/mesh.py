@@ -283,7 +283,10 @@ class Mesh(object):
         pprint('Reading hdf5 mesh')
 
         self.case = caseDir 
-        meshFile = h5py.File(self.case + 'mesh.hdf5', 'r', driver='mpio', comm=parallel.mpi)
+        meshFileName = self.case + 'mesh.hdf5'
+        if config.stage:
+            meshFileName = parallel.stage(meshFileName)
+        meshFile = h5py.File(meshFileName, 'r', driver='mpio', comm=parallel.mpi)
         assert meshFile['parallel/start'].shape[0] == parallel.nProcessors
 
         rank = parallel.rank
@@ -0,0 +1,243 @@
+import numpy as np
+import time
+
+from . import config, parallel, timestep
+from .parallel import pprint
+from .field import IOField
+
+logger = config.Logger(__name__)
+
+# neighbours of every cell in compressed rows from the face pairs
+def getAdjacency(nCells, owner, neighbour):
+    rows = np.concatenate((owner, neighbour))
+    columns = np.concatenate((neighbour, owner))
+    order = np.argsort(rows, kind='mergesort')
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=nCells))))
+    return indptr, columns[order]
+
+# greedy agglomeration, a seed cell is grouped with its free neighbours and
+# cells left without free neighbours join the agglomerate of a neighbour
+def agglomerate(nCells, owner, neighbour):
+    indptr, indices = getAdjacency(nCells, owner, neighbour)
+    agglomerates = -np.ones(nCells, np.int32)
+    nCoarse = 0
+    for cell in range(0, nCells):
+        if agglomerates[cell] > -1:
+            continue
+        neighbours = indices[indptr[cell]:indptr[cell+1]]
+        free = neighbours[agglomerates[neighbours] < 0]
+        if len(free) == 0:
+            continue
+        agglomerates[cell] = nCoarse
+        agglomerates[free] = nCoarse
+        nCoarse += 1
+    for cell in np.where(agglomerates < 0)[0]:
+        neighbours = indices[indptr[cell]:indptr[cell+1]]
+        if len(neighbours) > 0:
+            agglomerates[cell] = agglomerates[neighbours[0]]
+        else:
+            agglomerates[cell] = nCoarse
+            nCoarse += 1
+    return agglomerates, nCoarse
+
+def average(index, volumes, phi, nCells):
+    total = np.bincount(index, weights=volumes, minlength=nCells)
+    components = [np.bincount(index, weights=volumes*phi[:,k], minlength=nCells) for k in range(0, phi.shape[1])]
+    return (np.stack(components, axis=1)/total.reshape(-1,1)).astype(phi.dtype)
+
+# cells of a level with the faces between them, S is the area vector of a
+# face from its owner to its neighbour and A the sum of the areas of its
+# fine faces, the boundary faces of a cell are summed in boundaryS and
+# boundaryA
+class Level(object):
+    def __init__(self, cells, parent, nCells, volumes, owner, neighbour, S, A, boundaryS, boundaryA):
+        # finest cell to cell of the level, cell of the finer level to cell
+        self.cells = cells
+        self.parent = parent
+        self.nCells = nCells
+        self.volumes = volumes
+        self.owner = owner
+        self.neighbour = neighbour
+        self.S = S
+        self.A = A
+        self.boundaryS = boundaryS
+        self.boundaryA = boundaryA
+
+def sumCells(index, phi, nCells):
+    if len(phi.shape) == 1:
+        return np.bincount(index, weights=phi, minlength=nCells)
+    return np.stack([np.bincount(index, weights=phi[:,k], minlength=nCells) for k in range(0, phi.shape[1])], axis=1)
+
+# coarse level of the agglomeration parent of a level, the faces between
+# two agglomerates are merged in one face and the faces inside an
+# agglomerate are dropped
+def coarsen(finer, parent, nCoarse):
+    owner, neighbour = parent[finer.owner], parent[finer.neighbour]
+    outside = owner != neighbour
+    owner, neighbour = owner[outside], neighbour[outside]
+    sign = np.where(owner < neighbour, 1., -1.).reshape(-1,1)
+    pairs = np.stack((np.minimum(owner, neighbour), np.maximum(owner, neighbour)), axis=1)
+    pairs, faces = np.unique(pairs, axis=0, return_inverse=True)
+    faces = faces.flatten()
+    nFaces = pairs.shape[0]
+    S = sumCells(faces, sign*finer.S[outside], nFaces)
+    A = np.bincount(faces, weights=finer.A[outside], minlength=nFaces)
+    return Level(parent[finer.cells], parent, nCoarse, np.bincount(parent, weights=finer.volumes, minlength=nCoarse),
+                 pairs[:,0], pairs[:,1], S, A, sumCells(parent, finer.boundaryS, nCoarse), 
+                 np.bincount(parent, weights=finer.boundaryA, minlength=nCoarse))
+
+# first order inviscid residual of the conservative variables of RCF on a
+# coarse level with the rusanov flux, boundary faces take the state of
+# their cell, returns the residual and the convective limit of every cell
+def coarseResidual(level, states, gamma):
+    rho, rhoU, rhoE = [phi.astype(np.float64) for phi in states]
+    U = rhoU/rho
+    p = (gamma-1)*(rhoE - 0.5*rho*(U*U).sum(axis=1, keepdims=True))
+    a = np.sqrt(gamma*np.maximum(p, config.VSMALL)/rho)
+    def flux(index, S):
+        Un = (U[index]*S).sum(axis=1, keepdims=True)
+        return [rho[index]*Un, rhoU[index]*Un + p[index]*S, (rhoE[index] + p[index])*Un]
+    owner, neighbour, S, A = level.owner, level.neighbour, level.S, level.A
+    N = S/np.maximum(np.sqrt((S*S).sum(axis=1, keepdims=True)), config.VSMALL)
+    speed = lambda index: np.abs((U[index]*N).sum(axis=1)) + a[index,0]
+    maxaF = np.maximum(speed(owner), speed(neighbour))
+    boundaryN = level.boundaryS/np.maximum(np.sqrt((level.boundaryS**2).sum(axis=1, keepdims=True)), config.VSMALL)
+    boundarymaxaF = np.abs((U*boundaryN).sum(axis=1)) + a[:,0]
+    cells = np.arange(0, level.nCells)
+    R = []
+    for phi, FL, FR, FB in zip([rho, rhoU, rhoE], flux(owner, S), flux(neighbour, S), flux(cells, level.boundaryS)):
+        F = 0.5*(FL + FR) - 0.5*(maxaF*A).reshape(-1,1)*(phi[neighbour] - phi[owner])
+        divF = sumCells(owner, F, level.nCells) - sumCells(neighbour, F, level.nCells) + FB
+        R.append((-divF/level.volumes.reshape(-1,1)).astype(states[0].dtype))
+    dtc = np.bincount(owner, weights=maxaF*A, minlength=level.nCells) + \
+          np.bincount(neighbour, weights=maxaF*A, minlength=level.nCells) + boundarymaxaF*level.boundaryA
+    return R, (dtc/level.volumes).reshape(-1,1).astype(states[0].dtype)
+
+# full approximation storage multigrid for steady runs of RCF with local
+# time stepping and multigridLevels > 1, the smoother is a step of the
+# configured timeIntegrator with the local time step of every cell of the
+# level, the finest level uses the residual map and the coarse levels are
+# agglomerates of cells with their own first order inviscid operator on
+# the merged faces (the compiled kernels assume six faces per cell and
+# cannot run on agglomerates), so a coarse evaluation costs a fraction of a
+# fine one, the fine viscous and second order terms enter the coarse levels
+# through the forcing only, coarse levels are local to a processor and
+# treat processor and cyclic faces as boundary faces
+class Multigrid(object):
+    def __init__(self, solver, nLevels=1, nSweeps=1, residualSmoothing=0.):
+        self.solver = solver
+        self.mesh = mesh = solver.mesh
+        self.nSweeps = nSweeps
+        self.residualSmoothing = residualSmoothing
+        self.historyFile = mesh.case + 'multigridHistory.txt'
+        self.nCycles = 0
+        self.start = time.time()
+
+        n = mesh.nInternalCells
+        nInternalFaces, nFaces = mesh.nInternalFaces, mesh.nFaces
+        volumes = mesh.volumes.flatten()
+        S = mesh.areas*mesh.normals
+        A = mesh.areas.flatten()
+        owner = mesh.owner[nInternalFaces:nFaces]
+        cells = np.arange(0, n, dtype=np.int32)
+        self.levels = [Level(cells, cells, n, volumes, mesh.owner[:nInternalFaces], mesh.neighbour[:nInternalFaces],
+                             S[:nInternalFaces], A[:nInternalFaces], sumCells(owner, S[nInternalFaces:nFaces], n),
+                             np.bincount(owner, weights=A[nInternalFaces:nFaces], minlength=n))]
+        for index in range(1, nLevels):
+            finer = self.levels[-1]
+            parent, nCoarse = agglomerate(finer.nCells, finer.owner, finer.neighbour)
+            self.levels.append(coarsen(finer, parent, nCoarse))
+        pprint('Multigrid levels:', [parallel.sum(level.nCells) for level in self.levels])
+
+    # residual of a level at its states, the local convective limit and the
+    # outputs of the map on the finest level
+    def residual(self, index, states):
+        solver = self.solver
+        n = len(solver.names)
+        if index > 0:
+            R, dtcCells = coarseResidual(self.levels[index], states, solver.gamma)
+            return R, dtcCells, None
+        fields = solver.getFields(states, IOField)
+        # the time step is not an input of the residual
+        outputs = solver.mapResidual(*solver.getInputs(fields, 1.), **self.options)
+        self.options = dict(self.options, return_reusable=False, replace_reusable=False)
+        outputs = [x.copy() for x in outputs]
+        return outputs[:n], outputs[-1], outputs
+
+    # central implicit residual smoothing, (1 - eps*laplacian) R = R0 by
+    # jacobi sweeps on the cell graph of the level
+    def smoothResidual(self, index, R):
+        eps = self.residualSmoothing
+        if eps == 0.:
+            return R
+        level = self.levels[index]
+        owner, neighbour = level.owner, level.neighbour
+        count = (np.bincount(owner, minlength=level.nCells) + np.bincount(neighbour, minlength=level.nCells)).reshape(-1,1)
+        smoothed = []
+        for phi in R:
+            phiS = phi
+            for sweep in range(0, 2):
+                sums = [np.bincount(owner, weights=phiS[neighbour,k], minlength=level.nCells) + \
+                        np.bincount(neighbour, weights=phiS[owner,k], minlength=level.nCells) for k in range(0, phi.shape[1])]
+                phiS = (phi + eps*np.stack(sums, axis=1))/(1 + eps*count)
+            smoothed.append(phiS.astype(phi.dtype))
+        return smoothed
+
+    # forced and smoothed residual of a level
+    def rate(self, index, R, forcing):
+        if forcing is not None:
+            R = [phi + P for phi, P in zip(R, forcing)]
+        return self.smoothResidual(index, R)
+
+    # steps of the time integrator with the local time step of the first
+    # stage, first is the residual at states if already known
+    def smooth(self, index, states, forcing, first=None):
+        CFL = self.solver.CFL*(1 + 4*self.residualSmoothing)**0.5
+        for sweep in range(0, self.nSweeps):
+            if first is None:
+                first = self.residual(index, states)[:2]
+            R, dtcCells = first
+            dt = 2*CFL/np.maximum(dtcCells, config.VSMALL)
+            stages = [self.rate(index, R, forcing)]
+            def rate(states):
+                if len(stages) > 0:
+                    return stages.pop()
+                return self.rate(index, self.residual(index, states)[0], forcing)
+            states = timestep.explicitStep(self.solver.timeStepCoeff, rate, states, dt)
+            first = None
+        return states
+
+    # fas v cycle, the coarse level is forced with the restricted residual
+    # of the finer level and its correction is injected
+    def vCycle(self, index, states, forcing, first=None):
+        states = self.smooth(index, states, forcing, first)
+        if index == len(self.levels) - 1:
+            return states
+        coarse = self.levels[index + 1]
+        volumes = self.levels[index].volumes
+        R, _, _ = self.residual(index, states)
+        if forcing is not None:
+            R = [phi + P for phi, P in zip(R, forcing)]
+        coarseStates = [average(coarse.parent, volumes, phi, coarse.nCells) for phi in states]
+        coarseR, _, _ = self.residual(index + 1, coarseStates)
+        coarseForcing = [average(coarse.parent, volumes, phi, coarse.nCells) - phiC for phi, phiC in zip(R, coarseR)]
+        newStates = self.vCycle(index + 1, coarseStates, coarseForcing)
+        return [phi + (phiN - phiC)[coarse.parent] for phi, phiN, phiC in zip(states, newStates, coarseStates)]
+
+    # one cycle from fields, returns the new states, the outputs of the map
+    # at fields and the volume weighted rms and the maximum of the residual
+    # of every field
+    def cycle(self, fields, options):
+        self.options = options
+        states = [phi.field for phi in fields]
+        R, dtcCells, outputs = self.residual(0, states)
+        volumes = self.levels[0].volumes.reshape(-1,1)
+        totalVolume = parallel.sum(volumes.sum())
+        norms = [np.sqrt(parallel.sum((volumes*phi**2).sum())/totalVolume) for phi in R] + \
+                [np.sqrt(parallel.max((phi**2).sum(axis=1).max())) for phi in R]
+        states = self.vCycle(0, states, None, (R, dtcCells))
+        self.nCycles += 1
+        if parallel.rank == 0:
+            with open(self.historyFile, 'a') as f:
+                f.write('{} {} {}\n'.format(self.nCycles, time.time()-self.start, ' '.join([str(x) for x in norms])))
+        return states, outputs, norms
@@ -80,7 +80,7 @@ def getWeights(solver):
         nFaces = mesh.boundary[patchID]['nFaces']
         solver.extraArgs.append((tensor.StaticVariable((nFaces, 1)), (weights*1.).astype(config.precision)))
     
-def objective(fields, solver):
+def objectiveTerms(fields, solver):
     U, T, p = fields
     mesh = solver.mesh.symMesh
     def _meshArgs(start=0):
@@ -116,11 +116,6 @@ def objective(fields, solver):
         weight = weights[index]
         ht = _heatTransfer(nFaces, (ht,))(U, T, p, weight, w2, *meshArgs, solver=solver)
 
-    k = solver.mu(300)*solver.Cp/solver.Pr
-    a = 0.4
-    #b = -0.71e-3/(120*k)/2000.
-    b = 0.
-
     # MPI ALLREDUCE
     #if not config.gpu:
     #    inputs = (pl, w, ht, w2)
@@ -129,6 +124,15 @@ def objective(fields, solver):
     inputs = (pl, ht)
     outputs = tuple([tensor.Zeros(x.shape) for x in inputs])
     pl, ht = tensor.ExternalFunctionOp('mpi_allreduce', inputs, outputs).outputs
+    return pl, ht
+
+def objective(fields, solver):
+    pl, ht = objectiveTerms(fields, solver)
+
+    k = solver.mu(300)*solver.Cp/solver.Pr
+    a = 0.4
+    #b = -0.71e-3/(120*k)/2000.
+    b = 0.
 
     # then elemwise
     def _combine(pl, ht):
@@ -139,4 +143,7 @@ def objective(fields, solver):
         return a*obj + b*obj2
     return tensor.Kernel(_combine)(1)(pl, ht)
 
-
+# pressure loss and heat transfer as separate objectives,
+# adjoint computes sensitivities of both in a single backward run
+def objectives(fields, solver):
+    return objectiveTerms(fields, solver)
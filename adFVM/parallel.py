@@ -1,8 +1,9 @@
 from __future__ import print_function
 import numpy as np
-import subprocess
 import time
 import os
+import shutil
+import hashlib
 
 import multiprocessing
 nProcsPerNode = multiprocessing.cpu_count()
@@ -25,6 +26,10 @@ def getLocalRank(mpi, name, rank):
     names = mpi.bcast(names, root=0)
     return names[name].index(rank), len(names[name])
 
+def getNodeComm(mpi, name, rank):
+    names = sorted(set(mpi.allgather(name)))
+    return mpi.Split(names.index(name), rank)
+
 try:
     from mpi4py import MPI
     mpi = MPI.COMM_WORLD
@@ -32,6 +37,7 @@ try:
     name = MPI.Get_processor_name()
     rank = mpi.Get_rank()
     localRank, nRanksPerNode = getLocalRank(mpi, name, rank)
+    nodeMpi = getNodeComm(mpi, name, rank)
     #mpsRank = localRank % 2
     #os.environ['CUDA_MPS_PIPE_DIRECTORY'] = '/tmp/nvidia-pipe-{}'.format(mpsRank)
     #os.environ['CUDA_MPS_LOG_DIRECTORY'] = '/tmp/nvidia-log-{}'.format(mpsRank)
@@ -49,6 +55,7 @@ except:
     mpi.Barrier = lambda : None
     mpi.scatter = lambda x, root: x[0]
     mpi.gather = lambda x, root: [x]
+    nodeMpi = mpi
 
 setNumThreads(nRanksPerNode, nProcsPerNode)
 
@@ -56,23 +63,73 @@ processorDirectory = '/'
 if nProcessors > 1:
     processorDirectory = '/processor{0}/'.format(rank)
 temp = '/tmp'
+stageDirectory = os.environ.get('ADFVM_STAGE_DIR', temp + '/adFVM-stage-{}'.format(os.getuid() if hasattr(os, 'getuid') else 0))
 
 def pprint(*args, **kwargs):
     if rank == 0:
         print(*args, **kwargs)
 pprint('Running on {0} processors'.format(nProcessors))
 
-def copyToTemp(home, coresPerNode):
+def getSignature(path):
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return repr((stat.st_size, stat.st_mtime))
+    signature = []
+    for dirPath, dirNames, fileNames in os.walk(path):
+        dirNames.sort()
+        for fileName in sorted(fileNames):
+            fileName = os.path.join(dirPath, fileName)
+            stat = os.stat(fileName)
+            signature.append((os.path.relpath(fileName, path), stat.st_size, stat.st_mtime))
+    return repr(signature)
+
+# read only inputs are copied once per node to local storage by the first
+# rank on it, the other ranks wait on the node communicator for the outcome
+# of the copy and read it, returns the staged path. The stage directory has
+# to be private to the user, staged libraries are loaded from it
+def stage(path):
     start = time.time()
-    if rank % coresPerNode == 0:
-        dest = temp + '/.theano'
-        subprocess.call(['rm', '-rf', dest])
-        subprocess.call(['cp', '-r', home + '/.theano', dest])
-    mpi.Barrier()
+    path = os.path.realpath(path)
+    key = hashlib.sha1(path.encode('utf-8')).hexdigest()[:16]
+    dest = os.path.join(stageDirectory, key, os.path.basename(path))
+    error = None
+    if localRank == 0:
+        try:
+            copyToStage(path, dest)
+        except Exception as e:
+            error = e.args
+    # every rank on the node fails with the first rank
+    error = nodeMpi.bcast(error, root=0)
+    if error is not None:
+        raise Exception(*error)
     end = time.time()
-    pprint('Time to copy to {0}: '.format(temp), end-start)
-    pprint()
-    return temp
+    pprint('Time to stage {0} to {1}: '.format(path, dest), end-start)
+    return dest
+
+def copyToStage(path, dest):
+    if not os.path.exists(stageDirectory):
+        os.makedirs(stageDirectory, 0o700)
+    stat = os.lstat(stageDirectory)
+    if stat.st_uid != os.getuid() or (stat.st_mode & 0o077):
+        raise Exception('stage directory not private to the user:', stageDirectory)
+    stampFile = dest + '.stamp'
+    signature = getSignature(path)
+    if os.path.exists(dest) and os.path.exists(stampFile):
+        with open(stampFile) as f:
+            if f.read() == signature:
+                return
+    if os.path.isdir(dest):
+        shutil.rmtree(dest)
+    elif os.path.exists(dest):
+        os.remove(dest)
+    if not os.path.exists(os.path.dirname(dest)):
+        os.makedirs(os.path.dirname(dest))
+    if os.path.isdir(path):
+        shutil.copytree(path, dest)
+    else:
+        shutil.copy2(path, dest)
+    with open(stampFile, 'w') as f:
+        f.write(signature)
 
 def reduction(data, op, allreduce):
     if not isinstance(data, list):
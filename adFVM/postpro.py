@@ -1,7 +1,7 @@
 import numpy as np
 
 from . import parallel, config
-from .field import IOField, CellField, Field
+from .field import IOField, CellField, Field, SparseField
 from . import op, interp
 from .compat import intersectPlane
 import time
@@ -139,6 +139,30 @@ def getFieldByVolume(phi):
     phiByV = IOField(phi.name + 'ByV', phiByV, (1,), boundary=mesh.calculatedBoundary)
     return phiByV
 
+# stack perturbations on the union of their support for cmesh.computeSensitivities
+def stackPerturbations(perturbations):
+    indices, values = [], []
+    for delphis in zip(*perturbations):
+        if all([isinstance(delphi, SparseField) for delphi in delphis]):
+            rows = np.unique(np.concatenate([delphi.indices for delphi in delphis])).astype(np.int32)
+            stacked = np.zeros((len(delphis), len(rows), int(np.prod(delphis[0].dimensions))), config.precision)
+            for index, delphi in enumerate(delphis):
+                stacked[index, np.searchsorted(rows, delphi.indices)] = delphi.field.reshape(len(delphi.indices), -1)
+            indices.append(rows)
+            values.append(stacked)
+            continue
+        nRows = max([delphi.indices.max() + 1 if isinstance(delphi, SparseField) else np.asarray(delphi).shape[0] for delphi in delphis])
+        delphis = [delphi.toDense(nRows) if isinstance(delphi, SparseField) else delphi for delphi in delphis]
+        delphis = [np.asarray(delphi, config.precision) for delphi in delphis]
+        delphis = [delphi.reshape(nRows, -1) for delphi in delphis]
+        support = np.zeros(nRows, bool)
+        for delphi in delphis:
+            support |= (delphi != 0.).any(axis=1)
+        rows = np.nonzero(support)[0].astype(np.int32)
+        indices.append(rows)
+        values.append(np.ascontiguousarray(np.stack([delphi[rows] for delphi in delphis])))
+    return indices, values
+
 def getAdjointEnergy(solver, rhoa, rhoUa, rhoEa):
     # J = rhohV*rho/t
     mesh = solver.mesh
@@ -696,7 +720,9 @@ def computeAdjointViscosity(solver, viscosityType, rho, rhoU, rhoE, scaling):
     DT = Kernel(interpolate)(mesh.nFaces, (DT,))(M_2norm, *meshArgs)
     return M_2norm, DT
 
-def viscositySolver(solver, rho, rhoU, rhoE, rhoa, rhoUa, rhoEa, DT):
+# column is the index of the adjoint field in a batch, the native solve
+# keeps a warm start for every column
+def viscositySolver(solver, rho, rhoU, rhoE, rhoa, rhoUa, rhoEa, DT, column=0):
     mesh = solver.mesh.symMesh
     def divideFields(rhoa, rhoUa, rhoEa, volumes):
         return rhoa/volumes, rhoUa[0]/volumes, rhoUa[1]/volumes, rhoUa[2]/volumes, rhoEa/volumes
@@ -706,7 +732,11 @@ def viscositySolver(solver, rho, rhoU, rhoE, rhoa, rhoUa, rhoEa, DT):
         return areas*DT/deltas
     DTF = Kernel(getFaceData)(mesh.nFaces)(DT, mesh.areas, mesh.deltas)
 
-    inputs = fields + (rho, rhoU, rhoE, DTF, solver.dt)
+    def getColumn(dt):
+        return 0*dt.scalar() + column
+    columnIndex = Kernel(getColumn)(1, (Zeros((1,1)),))(solver.dt)
+
+    inputs = fields + (rho, rhoU, rhoE, DTF, solver.dt, columnIndex)
     outputs = tuple([Zeros(x.shape) for x in fields])
     fields = ExternalFunctionOp('apply_adjoint_viscosity', inputs, outputs).outputs
 
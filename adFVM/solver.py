@@ -5,15 +5,18 @@ import os
 import copy
 
 #import adFVMcpp
-from . import config, parallel, timestep
+from . import config, parallel, timestep, implicit
 from .parallel import pprint
 from .memory import printMemUsage
+from .cache import KernelCache, parallelCompile
+from .multigrid import Multigrid
+from .averaging import RunLengthMonitor
 
-from .field import Field, CellField, IOField
+from .field import Field, CellField, IOField, SparseField
 from .mesh import Mesh
 from .mesh import extractField
 
-from adpy.tensor import StaticVariable, ExternalFunctionOp, Function
+from adpy.tensor import Tensor, Kernel, IntegerScalar, StaticVariable, StaticIntegerVariable, ExternalFunctionOp, Function
 
 logger = config.Logger(__name__)
 
@@ -29,7 +32,26 @@ class Solver(object):
                         'stepFactor': 1.0,
                         'postpro': [],
                         'sourceTerms': [],
-                        'timeSeriesAppend': ''
+                        'sparseSource': False,
+                        'timeSeriesAppend': '',
+                        'subCycles': 1,
+                        'relativeTolerance': 1e-3,
+                        'absoluteTolerance': 1e-6,
+                        'imex': False,
+                        'newtonIterations': 4,
+                        'newtonTolerance': 1e-3,
+                        'gmresTolerance': 1e-2,
+                        'gmresRestart': 20,
+                        'multigridLevels': 1,
+                        'multigridSweeps': 1,
+                        'residualSmoothing': 0.,
+                        'residualInterval': 0,
+                        'residualDrop': 0.,
+                        'objectiveWindow': 0,
+                        'objectiveTolerance': 1e-4,
+                        'averageTolerance': 0.,
+                        'averageConfidence': 0.95,
+                        'averageInterval': 100
                     }
 
     def __init__(self, case, **userConfig):
@@ -47,29 +69,154 @@ class Solver(object):
         self.resultFile = self.mesh.case + 'objective.txt'
         self.statusFile = self.mesh.case + 'status.pkl'
         self.timeSeriesFile = self.mesh.case + 'timeSeries{}.txt'.format(self.timeSeriesAppend)
+        self.residualFile = self.mesh.case + 'residuals{}.bin'.format(self.timeSeriesAppend)
         Field.setSolver(self)
         #Field.setMesh(self.mesh)
 
         self.timeStepCoeff = getattr(timestep, self.timeIntegrator)()
-        self.nStages = self.timeStepCoeff[0].shape[0]
+        self.nStages = self.timeStepCoeff[-1].shape[0]
         self.stage = 0
+        self.nObjectives = 1
         self.init = None
         self.firstRun = True
         self.extraArgs = []
         return
 
+    # configuration and field boundary conditions the generated code depends
+    # on, part of the key of the kernel cache
+    def getCodeConfig(self):
+        codeConfig = dict([(key, getattr(self, key)) for key in self.__class__.defaultConfig])
+        fields = getattr(self, 'fields', None) or []
+        codeConfig['fields'] = [(phi.name, dict([(patchID, patch['type']) for patchID, patch in phi.boundary.items()])) for phi in fields]
+        return codeConfig
+
     def compile(self, adjoint=None):
         pprint('Compiling solver', self.__class__.defaultConfig['timeIntegrator'])
         self.compileInit()
         self.compileSolver()
-        Function.createCodeDir(self.mesh.caseDir, replace=config.compile)
+        compiler_args = config.get_compiler_args()
+        replace = config.compile
+        if replace and config.kernel_cache:
+            # identical configurations on other cases are not recompiled
+            cache = KernelCache()
+            key = cache.getKey(self, compiler_args)
+            codeDir = os.path.join(self.mesh.caseDir, 'gencode')
+            if cache.load(key, codeDir):
+                pprint('Using cached kernels', key)
+                replace = False
+        codeCase = self.mesh.caseDir
+        if config.stage and not (config.user.compile or config.user.compile_exit):
+            # nothing is built, the library is loaded from a node local copy
+            codeCase = os.path.join(os.path.dirname(parallel.stage(os.path.join(codeCase, 'gencode'))), '')
+        Function.createCodeDir(codeCase, replace=replace)
         parallel.mpi.Barrier()
-        Function.compile(case=None, init=False, replace=config.compile, compiler_args=config.get_compiler_args())
+        with parallelCompile():
+            Function.compile(case=None, init=False, replace=replace, compiler_args=compiler_args)
+        if replace and config.kernel_cache:
+            cache.store(key, codeDir)
         if config.compile_exit:
             exit(0)
         Function.initialize(parallel.localRank, self.mesh)
         return
         
+    # additive runge kutta step with the imex pair of the order of the
+    # timeIntegrator, the convective and source terms are explicit and the
+    # viscous terms are implicit, every implicit stage is solved by jacobian
+    # free newton krylov on the viscous map with a jacobi estimate of the
+    # viscous operator, returns the states and the outputs of the convective
+    # map at the inputs
+    def imexStep(self, fields, dt, options):
+        n = len(self.names)
+        a, b, ahat, bhat = timestep.imexPair(self.timeStepCoeff)
+        states = [phi.field for phi in fields]
+        shapes = [phi.shape for phi in states]
+        residualOptions = dict(options, return_reusable=False, replace_reusable=False)
+        outputs = [phi.copy() for phi in self.mapConvective(*self.getInputs(fields, dt), **options)]
+        explicitRates = [outputs[:n]]
+        implicitRates = [[phi.copy() for phi in self.mapViscous(*self.getInputs(fields, dt), **residualOptions)]]
+        stats = {'newton': 0, 'gmres': 0, 'residual': 0.}
+
+        def pack(arrays):
+            return np.concatenate([phi.flatten() for phi in arrays])
+        def unpack(x):
+            arrays, offset = [], 0
+            for shape in shapes:
+                size = int(np.prod(shape))
+                arrays.append(x[offset:offset+size].reshape(shape).astype(states[0].dtype))
+                offset += size
+            return arrays
+        def combine(*terms):
+            stageStates = list(states)
+            for coeffs, rates in terms:
+                for j in range(0, len(rates)):
+                    if coeffs[j] != 0:
+                        stageStates = [phi + coeffs[j]*dt*R for phi, R in zip(stageStates, rates[j])]
+            return stageStates
+        viscousLimit = self.viscousLimit(states)
+
+        nStages = b.shape[0]
+        for i in range(1, nStages):
+            known = pack(combine((a[i], explicitRates), (ahat[i], implicitRates)))
+            coeff = ahat[i,i]*dt
+            def function(x):
+                current = self.getFields(unpack(x), IOField, refFields=fields)
+                R = self.mapViscous(*self.getInputs(current, dt), **residualOptions)
+                return x - known - coeff*pack(R)
+            diagonal = pack([(1 + coeff*viscousLimit)*np.ones_like(phi) for phi in states])
+            x, newtonStats = implicit.newtonKrylov(function, known, lambda v: v/diagonal, \
+                                                   self.newtonTolerance, self.newtonIterations, \
+                                                   self.gmresTolerance, self.gmresRestart)
+            stats['newton'] += newtonStats['newton']
+            stats['gmres'] += newtonStats['gmres']
+            stats['residual'] = max(stats['residual'], newtonStats['residual'])
+            # the viscous rate of the stage follows from the solve, the
+            # convective rate is only evaluated if the step uses it
+            implicitRates.append(unpack((x - known)/coeff))
+            if b[i] != 0 or (a[i+1:,i] != 0).any():
+                current = self.getFields(unpack(x), IOField, refFields=fields)
+                R = self.mapConvective(*self.getInputs(current, dt), **residualOptions)[:n]
+                explicitRates.append([phi.copy() for phi in R])
+            else:
+                explicitRates.append([np.zeros_like(phi) for phi in states])
+        newStates = combine((b, explicitRates), (bhat, implicitRates))
+        return newStates, outputs, stats
+
+    # L2 norms normalized by the volume of the domain and Linf norms of the
+    # right hand side of every field from the sums of the monitor map
+    def getResidualNorms(self, sums):
+        n = len(self.names)
+        totalVolume = parallel.sum(self.mesh.volumes.sum())
+        return [np.sqrt(x[0,0]/totalVolume) for x in sums[:n]] + [np.sqrt(x[0,0]) for x in sums[n:]]
+
+    # rows of float64 time index, time and norms appended to the residual file
+    def writeResidualNorms(self, timeIndex, t, norms):
+        if parallel.rank == 0:
+            with open(self.residualFile, 'ab') as f:
+                np.array([timeIndex, t] + list(norms), np.float64).tofile(f)
+
+    # stopping criteria of a run: all L2 norms dropped by residualDrop from
+    # the first monitored step, or the mean objective of the last window of
+    # objectiveWindow steps is within objectiveTolerance of the window before
+    def isConverged(self, norms, initialNorms, objectives):
+        n = len(self.names)
+        if self.residualDrop > 0 and all([norms[index] <= self.residualDrop*initialNorms[index] for index in range(0, n)]):
+            pprint('Converged: residuals dropped by', self.residualDrop)
+            return True
+        window = self.objectiveWindow
+        if window > 0 and len(objectives) >= 2*window:
+            mean, meanPrev = np.mean(objectives[-window:], axis=0), np.mean(objectives[-2*window:-window], axis=0)
+            if np.all(np.abs(mean - meanPrev) <= self.objectiveTolerance*np.maximum(np.abs(mean), config.SMALL)):
+                pprint('Converged: objective stagnated over', window, 'steps')
+                return True
+        return False
+
+    # PI controller on the error of the last two accepted steps
+    def getStepFactor(self, errorPrev, error):
+        k = self.timeStepCoeff[1] + 1
+        error, errorPrev = max(error, 1e-10), max(errorPrev, 1e-10)
+        factor = 0.9*error**(-0.7/k)*errorPrev**(0.4/k)
+        return min(5., max(0.2, factor))
+
     def getFields(self, fields, mod, refFields=None):
         cellFields = []
         if refFields is None:
@@ -115,21 +262,79 @@ class Solver(object):
 
     def initSource(self):
         mesh = self.mesh.symMesh
-        symbolics = [StaticVariable((mesh.nInternalCells,) + dims) for dims in self.dimensions]
-        values = [np.zeros((self.mesh.nInternalCells, dims[0]), config.precision) for dims in self.dimensions]
-        self.sourceTerms = list(zip(symbolics, values))
+        if self.sparseSource:
+            # number of support cells, support cells, values on the support
+            nSupport = IntegerScalar()
+            self.sourceTerms = [(nSupport, 0), (StaticIntegerVariable((nSupport, 1)), np.zeros((0, 1), np.int32))]
+            symbolics = [StaticVariable((nSupport,) + dims) for dims in self.dimensions]
+            values = [np.zeros((0, dims[0]), config.precision) for dims in self.dimensions]
+        else:
+            self.sourceTerms = []
+            symbolics = [StaticVariable((mesh.nInternalCells,) + dims) for dims in self.dimensions]
+            values = [np.zeros((self.mesh.nInternalCells, dims[0]), config.precision) for dims in self.dimensions]
+        self.sourceTerms += list(zip(symbolics, values))
         return
 
+    def getSourceValues(self):
+        if self.sparseSource:
+            return self.sourceTerms[2:]
+        return self.sourceTerms
+
+    # positions of cells in the sparse source support, support is extended if needed
+    def addSourceSupport(self, cells):
+        cells = np.asarray(cells, np.int32).flatten()
+        support = self.sourceTerms[1][1].flatten()
+        newCells = np.setdiff1d(cells, support)
+        if len(newCells) > 0:
+            support = np.concatenate((support, newCells)).astype(np.int32)
+            nSupport, nNew = len(support), len(newCells)
+            self.sourceTerms[0] = (self.sourceTerms[0][0], nSupport)
+            self.sourceTerms[1] = (self.sourceTerms[1][0], support.reshape(-1, 1))
+            for index in range(2, len(self.sourceTerms)):
+                symbolic, value = self.sourceTerms[index]
+                value = np.vstack((value, np.zeros((nNew,) + value.shape[1:], config.precision)))
+                self.sourceTerms[index] = (symbolic, value)
+        order = np.argsort(support)
+        return order[np.searchsorted(support, cells, sorter=order)]
+
+    # LHS with the sparse source scattered, and the dense source terms
+    def applySource(self, LHS):
+        if not self.sparseSource:
+            return LHS, [x[0] for x in self.sourceTerms]
+        nSupport, cells = [x[0] for x in self.sourceTerms[:2]]
+        values = [x[0] for x in self.sourceTerms[2:]]
+        def _sparseSource(*args):
+            values, cells = args[:-1], args[-1]
+            return tuple([Tensor.collate(-phi, cells) for phi in values])
+        LHS = Kernel(_sparseSource)(nSupport, tuple(LHS))(*(values + [cells]))
+        return LHS, []
+
     def updateSource(self, source, perturb=False):
         for index, value in enumerate(source):
             #if index == 1:
             #    phi = IOField.internalField('rhoUS', value, (3,))
             #    with IOField.handle(startTime):
             #        phi.write()
+            if self.sparseSource:
+                if isinstance(value, np.ndarray) and value.shape[0] == self.mesh.nInternalCells:
+                    value = SparseField.fromDense(self.names[index], value, self.dimensions[index])
+                if isinstance(value, SparseField):
+                    positions = self.addSourceSupport(value.indices)
+                    phi = self.sourceTerms[2 + index][1]
+                    if not perturb:
+                        phi[:] = 0.
+                    phi[positions] += value.field
+                    continue
+            elif isinstance(value, SparseField):
+                phi = self.sourceTerms[index][1]
+                if not perturb:
+                    phi[:] = 0.
+                phi[value.indices] += value.field
+                continue
             if perturb:
-                self.sourceTerms[index][1][:] += value
+                self.getSourceValues()[index][1][:] += value
             else:
-                self.sourceTerms[index][1][:] = value
+                self.getSourceValues()[index][1][:] = value
         return
 
     def readFields(self, t):
@@ -170,7 +375,7 @@ class Solver(object):
         newFields = self.init(*[phi.field for phi in fields])
         return self.getFields(newFields, IOField)
 
-    def writeFields(self, fields, t, **kwargs):
+    def writeFields(self, fields, t, suffix='', **kwargs):
         n = len(self.names)
         fields, rest = fields[:n], fields[n:]
         oldFields = fields
@@ -179,7 +384,9 @@ class Solver(object):
             phi.field = phiN.field
         with IOField.handle(t):
             for phi in self.fields + rest:
-                phi.write(**kwargs)
+                name = phi.name
+                phi.write(name + suffix, **kwargs)
+                phi.name = name
         return 
 
     def readStatusFile(self):
@@ -207,14 +414,129 @@ class Solver(object):
     def equation(self, *fields):
         pass
 
+    # inputs of the primal map: fields, dt, mesh, source, BC, extra
+    def getInputs(self, fields, dt):
+        mesh = self.mesh
+        return [phi.field for phi in fields] + \
+               [np.array([[dt]], config.precision)] + \
+               mesh.getTensor() + mesh.getScalar() + \
+               [x[1] for x in self.sourceTerms] + \
+               self.getBoundaryTensor(1) + \
+               [x[1] for x in self.extraArgs]
+
+    def getParameter(self, param):
+        if param == 'source':
+            return [x[0] for x in self.getSourceValues()]
+        elif param == 'mesh':
+            return [getattr(self.mesh.symMesh, attr) for attr in Mesh.gradFields]
+        elif isinstance(param, tuple):
+            assert param[0] == 'BCs'
+            _, phi, patchID, key = param
+            patch = getattr(self, phi).phi.BC[patchID]
+            index = patch.keys.index(key)
+            return [patch.inputs[index][0]]
+        else:
+            raise NotImplementedError
+
+    # positions of the parameter arrays in the primal map inputs
+    def getParameterIndices(self, param):
+        return [self.map._inputs.index(x) for x in self.getParameter(param)]
+
+    def getPerturbationValues(self, parameters, values):
+        if not isinstance(values, list) or (len(parameters) == 1 and len(values) > 1):
+            values = [values]
+        return values
+
+    # perturbation of a parameter as arrays aligned with getParameter,
+    # sparse perturbations of a sparse source are indexed by support position
+    def getParameterValues(self, param, value):
+        if not isinstance(value, (list, tuple)):
+            value = [value]
+        value = list(value)
+        if param == 'source' and self.sparseSource:
+            for index, delphi in enumerate(value):
+                if not isinstance(delphi, SparseField):
+                    delphi = SparseField.fromDense(self.names[index], delphi, self.dimensions[index])
+                positions = self.addSourceSupport(delphi.indices)
+                value[index] = SparseField(delphi.name, positions, delphi.field, delphi.dimensions)
+        return value
+
+    def applyPerturbation(self, parameters, values, revert=False):
+        mesh = self.mesh
+        values = self.getPerturbationValues(parameters, values)
+        for param, value in zip(parameters, values):
+            if param == 'source':
+                if revert:
+                    value = [-x for x in value]
+                value = list(value)
+                pprint('Perturbing source')
+                self.updateSource(value, perturb=True)
+            elif param == 'mesh':
+                pprint('Perturbing mesh')
+                for attr, delta in zip(Mesh.gradFields, value):
+                    if revert:
+                        delta = -delta
+                    field = getattr(mesh, attr)
+                    field += delta
+                    assert field is getattr(mesh, attr)
+            elif isinstance(param, tuple):
+                if revert:
+                    value = -value
+                assert param[0] == 'BCs'
+                pprint('Perturbing', param)
+                _, phi, patchID, key = param
+                patch = getattr(self, phi).phi.BC[patchID]
+                index = patch.keys.index(key)
+                patch.inputs[index][1][:] += value
+            else:
+                raise NotImplementedError
+        return
+
+    # finite difference step size for a directional derivative of the map,
+    # relative to the norm of the perturbed inputs, balances the truncation
+    # and round off errors of forward (sqrt(eps)) or central (cbrt(eps))
+    # differences in the map precision
+    def getPerturbationSize(self, inputs, directions, central=False):
+        def _field(delta):
+            if isinstance(delta, SparseField):
+                return delta.field
+            return delta
+        dirNorm = parallel.sum(sum([(_field(delta)**2).sum() for delta in directions.values()]))**0.5
+        if dirNorm == 0.:
+            return 0.
+        inpNorm = parallel.sum(sum([(np.asarray(inputs[index])**2).sum() for index in directions]))**0.5
+        eps = np.finfo(config.precision).eps
+        h = eps**(1./3) if central else eps**0.5
+        return h*(1 + inpNorm)/dirNorm
+
+    # map evaluated at inputs perturbed along directions, {input index: array}
+    # needs to be called before the unperturbed step overwrites the fields
+    def perturbedMap(self, inputs, directions, eps, **options):
+        n = len(self.names)
+        inputs = list(inputs)
+        for index in range(0, n):
+            inputs[index] = inputs[index].copy()
+        for index, delta in directions.items():
+            if isinstance(delta, SparseField):
+                phi = inputs[index].copy()
+                phi[delta.indices] += eps*delta.field
+                inputs[index] = phi
+            else:
+                inputs[index] = (inputs[index] + eps*delta).astype(config.precision)
+        return self.map(*inputs, **options)
+
     def run(self, endTime=np.inf, writeInterval=config.LARGE, reportInterval=1, startTime=0.0, dt=1e-3, nSteps=config.LARGE, \
-            startIndex=0, result=0., mode='simulation', source=lambda *args: [0.]*len(args[0]), perturbation=None, avgStart=0):
+            startIndex=0, result=0., mode='simulation', source=lambda *args: [0.]*len(args[0]), perturbation=None, avgStart=0, fields=None, nLastStates=0):
 
         logger.info('running solver for {0}'.format(nSteps))
         mesh = self.mesh
         mesh.reset = True
         #initialize
-        fields = self.readFields(startTime)
+        # in memory initial fields skip reading the time directory
+        if fields is None:
+            fields = self.readFields(startTime)
+        else:
+            fields = self.getFields(fields, IOField)
         pprint()
 
         # time management
@@ -229,6 +551,10 @@ class Solver(object):
         # objective is local
         timeSeries = []
         timeSteps = []
+        # states before the end of the run, for time derivatives at the end
+        self.lastStates = []
+        if nSteps - timeIndex <= nLastStates:
+            self.lastStates.append(fields)
 
         # writing and returning local solutions
         if mode == 'forward':
@@ -243,33 +569,7 @@ class Solver(object):
         def doPerturb(revert=False):
             parameters, perturb = perturbation
             values = perturb(fields, mesh, t)
-            if not isinstance(values, list) or (len(parameters) == 1 and len(values) > 1):
-                values = [values]
-            for param, value in zip(parameters, values):
-                if param == 'source':
-                    if revert:
-                        value = [-x for x in value]
-                    pprint('Perturbing source')
-                    self.updateSource(value, perturb=True)
-                elif param == 'mesh':
-                    pprint('Perturbing mesh')
-                    for attr, delta in zip(Mesh.gradFields, value):
-                        if revert:
-                            delta = -delta
-                        field = getattr(mesh, attr)
-                        field += delta
-                        assert field is getattr(mesh, attr)
-                elif isinstance(param, tuple):
-                    if revert:
-                        value = -value
-                    assert param[0] == 'BCs'
-                    pprint('Perturbing', param)
-                    _, phi, patchID, key = param
-                    patch = getattr(self, phi).phi.BC[patchID]
-                    index = patch.keys.index(key)
-                    patch.inputs[index][1][:] += value
-                else:
-                    raise NotImplementedError
+            self.applyPerturbation(parameters, values, revert)
 
         # made static
         self.updateSource(source(fields, mesh, t))
@@ -279,6 +579,63 @@ class Solver(object):
         def iterate(t, timeIndex):
             return t < endTime and timeIndex < nSteps
 
+        # embedded pairs control the temporal error, the accepted steps
+        # are recorded as any other
+        adaptive = timestep.isEmbedded(self.timeStepCoeff) and not self.localTimeStep and \
+                   not self.fixedTimeStep and not isinstance(dts, np.ndarray)
+        errors = [1.]
+
+        # steady runs with coarse levels, a step is a multigrid cycle with the
+        # local time step of every cell
+        multigrid = None
+        if self.localTimeStep and self.multigridLevels > 1:
+            multigrid = Multigrid(self, self.multigridLevels, self.multigridSweeps, self.residualSmoothing)
+
+        # viscous terms are implicit, the time step is the convective limit
+        # of the domain
+        imex = self.imex and not adaptive and not self.localTimeStep and \
+               not isinstance(dts, np.ndarray)
+
+        # steps between report and write steps are marched in one map call,
+        # the last step of a cycle can be reported or written
+        subCycle = self.subCycles > 1 and mode != 'forward' and not self.localTimeStep and \
+                   not self.dynamicMesh and not isinstance(dts, np.ndarray) and endTime == np.inf and \
+                   not adaptive and not imex
+        # residual norms every residualInterval steps and early termination
+        # of simulations, norms come from the map or the multigrid cycle
+        def isMonitored(index):
+            return self.residualInterval > 0 and (index % self.residualInterval) == 0 and \
+                   not adaptive and not imex
+        initialNorms = None
+        objectives = []
+        converged = False
+
+        # time averaged objectives, the run stops when the confidence interval
+        # of the average after the detected transient is within averageTolerance
+        averaging = None
+        if self.averageTolerance > 0 and (mode == 'simulation' or mode == 'orig'):
+            averaging = RunLengthMonitor(self.averageTolerance, self.averageConfidence)
+        # steps and first step of the average of a run stopped by averaging
+        self.runLength = None
+
+        def getCycles(timeIndex):
+            if not subCycle or timeIndex + self.subCycles > nSteps:
+                return 1
+            for index in range(timeIndex + 1, timeIndex + self.subCycles):
+                if (index % reportInterval == 0) or (index % writeInterval == 0) or \
+                   (nSteps - index <= nLastStates):
+                    return 1
+            # norms are not computed by the sub cycled map
+            if any([isMonitored(index) for index in range(timeIndex + 1, timeIndex + self.subCycles + 1)]):
+                return 1
+            return self.subCycles
+        replaced = set()
+
+        def getObjective(objective):
+            if self.nObjectives > 1:
+                return np.array([obj[0,0] for obj in objective])
+            return objective[0][0,0]
+
         def updateTime(t0, dt):
 
             if self.localTimeStep:
@@ -293,37 +650,82 @@ class Solver(object):
             fields[index].info()
         pprint()
 
-        while iterate(t, timeIndex):
+        while iterate(t, timeIndex) and not converged:
             # add reporting interval
             mesh.reset = True
-            report = ((timeIndex + 1) % reportInterval == 0) 
-            write = ((timeIndex + 1) % writeInterval == 0) or not iterate(updateTime(t, dt), timeIndex+1)
-            return_reusable = report or write or (mode == 'forward')
-            replace_reusable = (timeIndex == startIndex)
+            nCycles = getCycles(timeIndex)
+            lastIndex = timeIndex + nCycles - 1
+            report = ((lastIndex + 1) % reportInterval == 0) 
+            write = ((lastIndex + 1) % writeInterval == 0) or not iterate(updateTime(t, dt), lastIndex+1)
+            write = write or (nSteps - (lastIndex + 1) <= nLastStates)
+            monitor = isMonitored(lastIndex + 1)
+            return_reusable = report or write or (mode == 'forward') or monitor
+            key = 'monitor' if monitor and multigrid is None else nCycles
+            replace_reusable = key not in replaced
+            replaced.add(key)
 
             # source term update
             # perturbation
 
-            pprint('Time step', timeIndex + 1)
+            if nCycles > 1:
+                pprint('Time steps', timeIndex + 1, 'to', lastIndex + 1)
+            else:
+                pprint('Time step', timeIndex + 1)
             if report:
                 pprint('Time marching for', ' '.join(self.names))
                 start = time.time()
 
-            inputs = [phi.field for phi in fields] + \
-                     [np.array([[dt]], config.precision)] + \
-                     mesh.getTensor() + mesh.getScalar() + \
-                     [x[1] for x in self.sourceTerms] + \
-                     self.getBoundaryTensor(1) + \
-                     [x[1] for x in self.extraArgs]
+            inputs = self.getInputs(fields, dt)
             options = {'return_reusable': return_reusable,
                        'replace_reusable': replace_reusable
                       }
 
             start2 = time.time()
-            outputs = self.map(*inputs, **options)
+            n = len(self.names)
+            if nCycles > 1:
+                outputs = self.mapSubCycle(*inputs, **options)
+                # time step and objectives of every step of the cycle
+                stepOutputs = outputs[n+1:]
+                m = 1 + self.nObjectives
+                steps = [(stepOutputs[k*m][0,0], getObjective(stepOutputs[k*m+1:(k+1)*m])) for k in range(0, nCycles)]
+            elif multigrid is not None:
+                states, outputs, norms = multigrid.cycle(fields, options)
+                outputs = states + list(outputs[n:])
+                steps = [(1., getObjective(outputs[n+1:n+1+self.nObjectives]))]
+            elif imex:
+                states, outputs, stats = self.imexStep(fields, dt, options)
+                outputs = states + list(outputs[n:])
+                steps = [(dt, getObjective(outputs[n+1:n+1+self.nObjectives]))]
+                pprint('Newton iterations:', stats['newton'], \
+                       'GMRES iterations:', stats['gmres'], 'Newton residual:', stats['residual'])
+            elif adaptive:
+                # rejected steps are repeated with a smaller time step from
+                # the accepted state, the map updates the fields in place
+                initial = [phi.field.copy() for phi in fields]
+                while True:
+                    outputs = self.mapEmbedded(*inputs, **options)
+                    error = np.sqrt(outputs[-1][0,0])
+                    if error <= 1. or dt < config.SMALL:
+                        break
+                    factor = 0.9*error**(-1./(self.timeStepCoeff[1] + 1)) if np.isfinite(error) else 0.2
+                    dt = dt*max(0.2, factor)
+                    pprint('Rejected step, error:', error, 'new time step:', dt)
+                    mesh.reset = True
+                    fields = self.getFields([phi.copy() for phi in initial], IOField, refFields=fields)
+                    inputs = self.getInputs(fields, dt)
+                    options = dict(options, replace_reusable=False)
+                errors.append(error)
+                steps = [(dt, getObjective(outputs[n+1:n+1+self.nObjectives]))]
+            else:
+                if monitor:
+                    outputs = self.mapMonitor(*inputs, **options)
+                    norms = self.getResidualNorms(outputs[-2*n:])
+                    outputs = outputs[:-2*n]
+                else:
+                    outputs = self.map(*inputs, **options)
+                steps = [(dt, getObjective(outputs[n+1:n+1+self.nObjectives]))]
             pprint(time.time()-start2)
-            newFields, dtc, objective = outputs[:3], outputs[3], outputs[4]
-            objective = objective[0,0]
+            newFields, dtc = outputs[:n], outputs[n]
             dtc = dtc[0,0]
             fields = self.getFields(newFields, IOField, refFields=fields)
 
@@ -351,27 +753,55 @@ class Solver(object):
                     pprint('Simulation Time:', t, 'Time step:', dt)
             pprint()
 
-            # time management
-            timeSteps.append([t, dt])
-            timeIndex += 1
-            t = updateTime(t, dt)
+            # time and objective management
+            for dt, objective in steps:
+                timeSteps.append([t, dt])
+                timeIndex += 1
+                t = updateTime(t, dt)
+                if timeIndex > avgStart:
+                    result += objective
+                timeSeries.append(objective)
+                if self.objectiveWindow > 0:
+                    objectives = objectives[-2*self.objectiveWindow+1:] + [objective]
+                if averaging is not None:
+                    averaging.append(objective)
+            if nSteps - timeIndex <= nLastStates:
+                self.lastStates.append(fields)
+
+            if monitor:
+                pprint('Residual norms L2:', norms[:n], 'Linf:', norms[n:])
+                self.writeResidualNorms(timeIndex, t, norms)
+                if initialNorms is None:
+                    initialNorms = norms
+                # written as the last step of the run
+                if mode == 'simulation' and self.isConverged(norms, initialNorms, objectives):
+                    converged = write = True
+
+            # orig runs stop on write steps to keep the checkpoints of the adjoint
+            if averaging is not None and not converged and \
+               (write if mode == 'orig' else (timeIndex - startIndex) % self.averageInterval == 0) and \
+               averaging.update():
+                pprint('Converged: average', averaging.mean, '+-', averaging.halfWidth, \
+                       'after a transient of', averaging.start, 'steps')
+                self.runLength = (timeIndex, startIndex + averaging.start)
+                result = averaging.getSamples().sum(axis=0)
+                if self.nObjectives == 1:
+                    result = result[0]
+                converged = write = True
             
             #print(t)
             if self.localTimeStep:
                 dt = dtc
             elif isinstance(dts, np.ndarray):
                 dt = dts[timeIndex]
+            elif adaptive:
+                dt = min(parallel.min(2*self.CFL/dtc), dt*self.getStepFactor(*errors[-2:]), endTime-t)
             elif not self.fixedTimeStep:
                 dt = min(parallel.min(2*self.CFL/dtc), dt*self.stepFactor, endTime-t)
                 #dt = min(parallel.min(dtc), dt*self.stepFactor, endTime-t)
             if self.dynamicMesh:
                 mesh.update(t, dt)
 
-            # objective management
-            if timeIndex > avgStart:
-                result += objective
-            timeSeries.append(objective)
-
             # write management
             if mode == 'forward':
                 if self.dynamicMesh:
@@ -380,7 +810,7 @@ class Solver(object):
                     solutions.append([instMesh] + fields)
                 else:
                     solutions.append(fields)
-            elif write:
+            elif write and mode != 'segment':
                 # write mesh, fields, status
                 if mode == 'orig' or mode == 'simulation':
                     #if len(dtc.shape) == 0:
@@ -408,5 +838,97 @@ class Solver(object):
 
         if mode == 'forward':
             return solutions
+        # nothing is written, final fields and objectives are returned
+        if mode == 'segment':
+            return fields, timeSeries
         return result
 
+
+    # independent runs on the same mesh in one process, for ensemble
+    # statistics and not for speed: the compiled map has no member dimension
+    # so the members are advanced one after the other with one map call each
+    # per step, a step costs as much as a step of every separate run and
+    # only the compilation, the mesh and the process are shared,
+    # perturbations are optional (parameters, perturb) pairs of every member
+    # applied around its map call, the time step is common to all members
+    # and member fields are written with the suffix _member
+    def runEnsemble(self, members, endTime=np.inf, writeInterval=config.LARGE, reportInterval=1, startTime=0.0, dt=1e-3, nSteps=config.LARGE, \
+                    source=lambda *args: [0.]*len(args[0]), perturbations=None, avgStart=0):
+        mesh = self.mesh
+        n = len(self.names)
+        nMembers = len(members)
+        states = [[np.array(getattr(phi, 'field', phi)) for phi in member[:n]] for member in members]
+        if perturbations is None:
+            perturbations = [None]*nMembers
+        self.ensembleTimeSeriesFile = mesh.case + 'ensembleTimeSeries{}.txt'.format(self.timeSeriesAppend)
+        pprint('Ensemble members:', nMembers)
+
+        def getFields(member):
+            return self.getFields(states[member], IOField)
+
+        t = startTime
+        timeIndex = 0
+        result = 0.
+        timeSeries = []
+        self.updateSource(source(getFields(0), mesh, t))
+        replace_reusable = True
+        while t < endTime and timeIndex < nSteps:
+            report = ((timeIndex + 1) % reportInterval) == 0
+            write = ((timeIndex + 1) % writeInterval) == 0 or (timeIndex + 1) == nSteps
+            options = {'return_reusable': report or write,
+                       'replace_reusable': replace_reusable
+                      }
+            replace_reusable = False
+            pprint('Time step', timeIndex + 1)
+            start = time.time()
+
+            dtcs, objectives = [], []
+            for member in range(0, nMembers):
+                if perturbations[member]:
+                    parameters, perturb = perturbations[member]
+                    values = perturb(getFields(member), mesh, t)
+                    self.applyPerturbation(parameters, values)
+                mesh.reset = True
+                outputs = self.map(*self.getInputs(getFields(member), dt), **options)
+                if perturbations[member]:
+                    self.applyPerturbation(parameters, values, revert=True)
+                # output buffers are reused by the map call of the next member
+                states[member] = [phi.copy() for phi in outputs[:n]]
+                dtcs.append(outputs[n][0,0])
+                objectives.append([obj[0,0] for obj in outputs[n+1:n+1+self.nObjectives]])
+            objectives = np.array(objectives)
+
+            timeIndex += 1
+            t = round(t + dt, 12)
+            if timeIndex > avgStart:
+                result += objectives
+            timeSeries.append(objectives.flatten())
+
+            if report:
+                for member in range(0, nMembers):
+                    pprint('Member', member)
+                    for phi in getFields(member):
+                        phi.info()
+                end = time.time()
+                pprint('Objectives:', objectives.flatten())
+                pprint('Time for ensemble iteration:', end-start)
+                pprint('Time since beginning:', end-config.runtime)
+                pprint('Simulation Time:', t, 'Time step:', dt)
+            pprint()
+
+            if not self.fixedTimeStep:
+                dt = min(parallel.min(2*self.CFL/np.max(dtcs)), dt*self.stepFactor, endTime-t)
+
+            # the written fields of the solver are restored after the members
+            if write:
+                saved = [phi.field for phi in self.fields]
+                for member in range(0, nMembers):
+                    self.writeFields(getFields(member), t, suffix='_{}'.format(member))
+                for phi, field in zip(self.fields, saved):
+                    phi.field = field
+                if parallel.rank == 0:
+                    with open(self.ensembleTimeSeriesFile, 'ab') as f:
+                        np.savetxt(f, timeSeries)
+                timeSeries = []
+
+        return [getFields(member) for member in range(0, nMembers)], result
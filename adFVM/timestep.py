@@ -2,7 +2,8 @@ import numpy as np
 
 from . import config
 from .field import Field
-from adpy.tensor import Kernel
+from adpy.tensor import Tensor, Kernel, ExternalFunctionOp
+from adpy.variable import Zeros
 
 createFields = lambda internalFields, solver : [Field(solver.names[index], phi, solver.dimensions[index]) for index, phi in enumerate(internalFields)]
 
@@ -24,7 +25,183 @@ def SSPRK():
     gamma = np.array([0.,1,0.5], config.precision)
     return [alpha, beta, gamma]
 
+# low storage schemes keep two registers of the state instead of one per
+# stage, the last coefficient is always the stage time
+
+# williamson 2N form, for every stage
+# dU = A[i]*dU + dt*R(U), U = U + B[i]*dU
+def RK3_2N():
+    A = np.array([0., -5./9, -153./128], config.precision)
+    B = np.array([1./3, 15./16, 8./15], config.precision)
+    gamma = np.array([0., 1./3, 3./4], config.precision)
+    return ['2N', A, B, gamma]
+
+# carpenter-kennedy, 5 stages 4th order
+def RK4_2N():
+    A = np.array([0., -567301805773./1357537059087, -2404267990393./2016746695238, 
+                  -3550918686646./2091501179385, -1275806237668./842570457699], config.precision)
+    B = np.array([1432997174477./9575080441755, 5161836677717./13612068292357, 1720146321549./2090206949498, 
+                  3134564353537./4481467310338, 2277821191437./14882151754819], config.precision)
+    gamma = np.array([0., 1432997174477./9575080441755, 2526269341429./6820363962896, 
+                      2006345519317./3224310063776, 2802321613138./2924317926251], config.precision)
+    return ['2N', A, B, gamma]
+
+# ketcheson 2S form with S1 = S2 = u initially, for every stage
+# S2 = a*S2 + b*S1, S1 = c*S2 + d*S1 from mix[i] and then
+# S1 = g1*S1 + g2*S2 + beta*dt*R(S1) from update[i]
+def SSPRK_2S():
+    mix = np.array([[1., 0, 0, 1]]*3, config.precision)
+    update = np.array([[1., 0, 1], [1./4, 3./4, 1./4], [2./3, 1./3, 2./3]], config.precision)
+    gamma = np.array([0., 1, 0.5], config.precision)
+    return ['2S', mix, update, gamma]
+
+# SSPRK(10,4), SSP coefficient 6
+def SSPRK104_2S():
+    mix = np.array([[1., 0, 0, 1]]*10, config.precision)
+    mix[5] = [1./25, 9./25, 15., -5.]
+    update = np.array([[1., 0, 1./6]]*10, config.precision)
+    update[9] = [3./5, 1., 1./10]
+    gamma = np.array([0., 1./6, 1./3, 1./2, 2./3, 1./3, 1./2, 2./3, 5./6, 1.], config.precision)
+    return ['2S', mix, update, gamma]
+
+def lowStorageStepper(equation, initFields, solver):
+    mesh = solver.mesh.symMesh
+    form, coeffs, gamma = solver.timeStepCoeff[0], solver.timeStepCoeff[1:-1], solver.timeStepCoeff[-1]
+    nStages = gamma.shape[0]
+    n = len(initFields)
+    fields = list(initFields)
+    # increment for 2N, S2 for 2S
+    register = [] if form == '2N' else list(initFields)
+
+    def mix(*args, **kwargs):
+        a, b, c, d = coeffs[0][kwargs['i']]
+        fields, register = args[:n], args[n:]
+        register = [a*register[index] + b*fields[index] for index in range(0, n)]
+        fields = [c*register[index] + d*fields[index] for index in range(0, n)]
+        return tuple(fields + register)
+
+    def update(*args, **kwargs):
+        i = kwargs['i']
+        nS = kwargs['nS']
+        nR = kwargs['nR']
+        LHS, S, fields, register, dt = args[:n], args[n:n+nS], args[n+nS:2*n+nS], args[2*n+nS:2*n+nS+nR], args[-1]
+        dt = dt.scalar()
+        currFields, currRegister = [], []
+        for index in range(0, n):
+            if nS > 0:
+                R = -(LHS[index]-S[index])*dt
+            else:
+                R = -LHS[index]*dt
+            if form == '2N':
+                A, B = coeffs
+                if nR > 0:
+                    R = A[i]*register[index] + R
+                currRegister.append(R)
+                currFields.append(fields[index] + B[i]*R)
+            else:
+                g1, g2, beta = coeffs[1][i]
+                currFields.append(g1*fields[index] + g2*register[index] + beta*R)
+        return tuple(currFields + currRegister)
+
+    for i in range(0, nStages):
+        if form == '2S' and not (coeffs[0][i] == [1, 0, 0, 1]).all():
+            outputs = Kernel(mix)(mesh.nInternalCells)(*(fields + register), i=i)
+            fields, register = list(outputs[:n]), list(outputs[n:])
+        LHS = equation(*fields)
+        LHS, S = solver.applySource(LHS)
+        args = list(LHS) + S + fields + register + [solver.dt]
+        outputs = Kernel(update)(mesh.nInternalCells)(*args, i=i, nS=len(S), nR=len(register))
+        solver.stage += 1
+        fields = list(outputs[:n])
+        if form == '2N':
+            register = list(outputs[n:])
+    return fields
+
+# embedded pairs in butcher form, the solution is advanced with b and the
+# error estimated from b - bhat, the second coefficient is the order of bhat
+def SSPRK32():
+    a = np.array([[0, 0, 0], [1., 0, 0], [1./4, 1./4, 0]], config.precision)
+    b = np.array([1./6, 1./6, 2./3], config.precision)
+    bhat = np.array([1./2, 1./2, 0], config.precision)
+    gamma = np.array([0., 1, 0.5], config.precision)
+    return ['embedded', 2, a, b, bhat, gamma]
+
+# bogacki-shampine without first same as last
+def BS32():
+    a = np.array([[0, 0, 0, 0], [1./2, 0, 0, 0], [0, 3./4, 0, 0], [2./9, 1./3, 4./9, 0]], config.precision)
+    b = np.array([2./9, 1./3, 4./9, 0], config.precision)
+    bhat = np.array([7./24, 1./4, 1./3, 1./8], config.precision)
+    gamma = np.array([0., 1./2, 3./4, 1], config.precision)
+    return ['embedded', 2, a, b, bhat, gamma]
+
+def isEmbedded(coeff):
+    return isinstance(coeff[0], str) and coeff[0] == 'embedded'
+
+def embeddedStepper(equation, initFields, solver):
+    mesh = solver.mesh.symMesh
+    _, order, a, b, bhat, gamma = solver.timeStepCoeff
+    nStages = gamma.shape[0]
+    n = len(initFields)
+    rates = []
+    fields = list(initFields)
+
+    def stage(*args, **kwargs):
+        i = kwargs['i']
+        nS = kwargs['nS']
+        LHS, S, initFields, rates, dt = args[:n], args[n:n+nS], args[n+nS:2*n+nS], args[2*n+nS:-1], args[-1]
+        dt = dt.scalar()
+        rates = list(rates)
+        for index in range(0, n):
+            if nS > 0:
+                rates.append(-(LHS[index]-S[index]))
+            else:
+                rates.append(-LHS[index])
+        last = i == nStages-1
+        coeff = b if last else a[i+1]
+        currFields = []
+        for index in range(0, n):
+            phi = initFields[index]
+            for j in range(0, i+1):
+                if coeff[j] != 0:
+                    phi = phi + coeff[j]*dt*rates[j*n+index]
+            currFields.append(phi)
+        if not last:
+            return tuple(currFields + rates[i*n:])
+        # weighted squared error of the worst field in the cell
+        error = 0
+        for index in range(0, n):
+            e, u = 0, initFields[index]
+            for j in range(0, nStages):
+                if b[j] != bhat[j]:
+                    e += (b[j]-bhat[j])*dt*rates[j*n+index]
+            if solver.dimensions[index] == (1,):
+                e, u = e*e, abs(u)
+            else:
+                e, u = e.dot(e), u.dot(u).sqrt()
+            e = e/(solver.absoluteTolerance + solver.relativeTolerance*u)**2
+            error = e if index == 0 else Tensor.switch(e > error, e, error)
+        return tuple(currFields + [error])
+
+    def _maxError(error):
+        return error.reduce_max()
+
+    for i in range(0, nStages):
+        LHS = equation(*fields)
+        LHS, S = solver.applySource(LHS)
+        args = list(LHS) + S + list(initFields) + rates + [solver.dt]
+        outputs = Kernel(stage)(mesh.nInternalCells)(*args, i=i, nS=len(S))
+        solver.stage += 1
+        fields = list(outputs[:n])
+        rates = rates + list(outputs[n:]) if i < nStages-1 else rates
+    error = Kernel(_maxError)(mesh.nInternalCells, (Zeros((1, 1)),))(outputs[n])
+    (solver.stepError,) = ExternalFunctionOp('mpi_allreduce_max', (error,), (Zeros((1,1)),)).outputs
+    return fields
+
 def timeStepper(equation, initFields, solver):
+    if isEmbedded(solver.timeStepCoeff):
+        return embeddedStepper(equation, initFields, solver)
+    if isinstance(solver.timeStepCoeff[0], str):
+        return lowStorageStepper(equation, initFields, solver)
     mesh = solver.mesh.symMesh
     alpha, beta, gamma = solver.timeStepCoeff
     nStages = alpha.shape[0]
@@ -34,23 +211,119 @@ def timeStepper(equation, initFields, solver):
 
     def update(*args, **kwargs):
         i = kwargs['i']
+        nS = kwargs['nS']
         currFields = [0]*n
-        LHS, S, fields, dt = args[:n], args[n:2*n], args[2*n:-1], args[-1]
+        LHS, S, fields, dt = args[:n], args[n:n+nS], args[n+nS:-1], args[-1]
         dt = dt.scalar()
         for j in range(0, i+1):
             for index in range(0, n):
                 currFields[index] += alpha[i,j]*fields[j*n+index]
         for index in range(0, n):
-            currFields[index] += -beta[i,i]*(LHS[index]-S[index])*dt
+            if nS > 0:
+                currFields[index] += -beta[i,i]*(LHS[index]-S[index])*dt
+            else:
+                currFields[index] += -beta[i,i]*LHS[index]*dt
         return tuple(currFields)
 
     for i in range(0, nStages):
         #solver.t = solver.t0 + gamma[i]*solver.dt
         LHS = equation(*fields[i])
-        S = [x[0] for x in solver.sourceTerms]
+        # sparse source is already scattered into LHS
+        LHS, S = solver.applySource(LHS)
         args = list(LHS) + S + sum(fields, []) + [solver.dt]
-        currFields = Kernel(update)(mesh.nInternalCells)(*args, i=i)
+        currFields = Kernel(update)(mesh.nInternalCells)(*args, i=i, nS=len(S))
         solver.stage += 1
         fields.append(list(currFields))
     return fields[-1]
 
+
+# additive runge kutta pairs of ascher, ruuth and spiteri for imex, a and b
+# are the explicit part and ahat and bhat the diagonally implicit part, the
+# first stage is the initial state for both
+def ARS111():
+    a = np.array([[0, 0], [1., 0]])
+    b = np.array([1., 0])
+    ahat = np.array([[0, 0], [0, 1.]])
+    bhat = np.array([0, 1.])
+    return [a, b, ahat, bhat]
+
+def ARS222():
+    g = 1 - 1./np.sqrt(2)
+    d = 1 - 1./(2*g)
+    a = np.array([[0, 0, 0], [g, 0, 0], [d, 1-d, 0]])
+    b = np.array([d, 1-d, 0])
+    ahat = np.array([[0, 0, 0], [0, g, 0], [0, 1-g, g]])
+    bhat = np.array([0, 1-g, g])
+    return [a, b, ahat, bhat]
+
+def ARS443():
+    a = np.array([[0, 0, 0, 0, 0], [1./2, 0, 0, 0, 0], [11./18, 1./18, 0, 0, 0], 
+                  [5./6, -5./6, 1./2, 0, 0], [1./4, 7./4, 3./4, -7./4, 0]])
+    b = np.array([1./4, 7./4, 3./4, -7./4, 0])
+    ahat = np.array([[0, 0, 0, 0, 0], [0, 1./2, 0, 0, 0], [0, 1./6, 1./2, 0, 0], 
+                     [0, -1./2, 1./2, 1./2, 0], [0, 3./2, -3./2, 1./2, 1./2]])
+    bhat = np.array([0, 3./2, -3./2, 1./2, 1./2])
+    return [a, b, ahat, bhat]
+
+# order of an integrator on linear problems, from the coefficients of its
+# stability polynomial
+def getOrder(coeff):
+    nStages = coeff[-1].shape[0]
+    z = np.exp(2j*np.pi*np.arange(0, nStages+1)/(nStages+1))
+    R = explicitStep(coeff, lambda fields: [z*fields[0]], [np.ones_like(z)], 1.)[0]
+    c = np.fft.fft(R).real/(nStages+1)
+    order, factorial = 0, 1.
+    while order < nStages:
+        factorial *= order + 1
+        if abs(c[order+1]*factorial - 1) > 1e-4:
+            break
+        order += 1
+    return order
+
+# imex pair of the order of the integrator, at most third
+def imexPair(coeff):
+    return [ARS111, ARS222, ARS443][min(max(getOrder(coeff), 1), 3)-1]()
+
+# one step of the integrator on numpy states for the multigrid smoother,
+# rate returns the right hand side at the states of a stage and dt can be
+# a local time step for every cell, the first stage is at the initial
+# states for all the integrators
+def explicitStep(coeff, rate, initFields, dt):
+    if isEmbedded(coeff):
+        _, order, a, b, bhat, gamma = coeff
+        rates = []
+        for i in range(0, gamma.shape[0]):
+            fields = list(initFields)
+            for j in range(0, i):
+                if a[i,j] != 0:
+                    fields = [phi + a[i,j]*dt*R for phi, R in zip(fields, rates[j])]
+            rates.append(rate(fields))
+        fields = list(initFields)
+        for j in range(0, len(rates)):
+            if b[j] != 0:
+                fields = [phi + b[j]*dt*R for phi, R in zip(fields, rates[j])]
+        return fields
+    if isinstance(coeff[0], str):
+        form, coeffs, gamma = coeff[0], coeff[1:-1], coeff[-1]
+        fields = list(initFields)
+        register = [np.zeros_like(phi) for phi in fields] if form == '2N' else list(initFields)
+        for i in range(0, gamma.shape[0]):
+            if form == '2N':
+                A, B = coeffs
+                register = [A[i]*dU + dt*R for dU, R in zip(register, rate(fields))]
+                fields = [phi + B[i]*dU for phi, dU in zip(fields, register)]
+            else:
+                a, b, c, d = coeffs[0][i]
+                register = [a*S2 + b*S1 for S1, S2 in zip(fields, register)]
+                fields = [c*S2 + d*S1 for S1, S2 in zip(fields, register)]
+                g1, g2, beta = coeffs[1][i]
+                fields = [g1*S1 + g2*S2 + beta*dt*R for S1, S2, R in zip(fields, register, rate(fields))]
+        return fields
+    alpha, beta, gamma = coeff
+    fields = [list(initFields)]
+    for i in range(0, alpha.shape[0]):
+        currFields = [beta[i,i]*dt*R for R in rate(fields[i])]
+        for j in range(0, i+1):
+            currFields = [phi + alpha[i,j]*phiJ for phi, phiJ in zip(currFields, fields[j])]
+        fields.append(currFields)
+    return fields[-1]
@@ -7,11 +7,12 @@ from adFVM.field import IOField, Field
 from adFVM import interp
 from adFVM.memory import printMemUsage
 #from adFVM.postpro import getAdjointViscosity, getAdjointEnergy, computeSymmetrizedAdjointEnergy, computeAdjointViscosity, viscositySolver
-from adFVM.postpro import getAdjointViscosity, getAdjointEnergy, getSymmetrizedAdjointEnergy, computeAdjointViscosity, viscositySolver
+from adFVM.postpro import getAdjointViscosity, getAdjointEnergy, getSymmetrizedAdjointEnergy, computeAdjointViscosity, viscositySolver, stackPerturbations
 from adFVM.solver import Solver
 from adpy.variable import Variable, Function, Zeros
 from adpy.tensor import Kernel
 from adFVM.mesh import cmesh, Mesh
+from adFVM.averaging import RunLengthMonitor
 
 from problem import primal, nSteps, writeInterval, sampleInterval, reportInterval, viscousInterval, perturb, writeResult, nPerturb, parameters, source, adjParams, avgStart, runCheckpoints, startTime
 from problem import dt as Dt
@@ -39,13 +40,27 @@ class Adjoint(Solver):
         self.sensTimeSeriesFile = self.mesh.case + 'sensTimeSeries.txt'
         self.energyTimeSeriesFile = self.mesh.case + 'energyTimeSeries.txt'
 
+        self.nSteps = nSteps
+        self.writeInterval = writeInterval
         self.nParams = 0
+        self.nColumns = 1
+        # columns advanced by one call of the compiled map, fixed at compile
+        # time to the number of objectives
+        self.nBatch = 1
+        # leading columns seeded with the objective of the same index
+        self.inhomogeneousColumns = 1
+        self.columnFields = None
+        self.sensitivityField = False
+        self.sensitivityFields = None
         self.forceReadFields = False
         self.homoegeneousAdjoint = False
         self.firstRun = True
         self.scaling = adjParams[0]
         self.viscosityType = adjParams[1]
         self.viscosityScaler = adjParams[2]
+        # the run stops when the confidence interval of the averaged
+        # sensitivities is within averageTolerance
+        self.averageTolerance = 0.
 
         self.fields = None
         self.map = None
@@ -65,16 +80,87 @@ class Adjoint(Solver):
         #newFields = self.mapBoundary(*[phi.field for phi in fields] + mesh.getTensor() + mesh.getScalar() + self.getBoundaryTensor(1))
         #return self.getFields(newFields, IOField, refFields=fields)
 
-    def createFields(self):
-        fields = []
-        for name, dims in zip(self.names, self.dimensions):
-            phi = np.zeros((self.mesh.nInternalCells, dims[0]), config.precision)
-            fields.append(IOField(name, phi, dims, self.mesh.defaultBoundary))
-        self.fields = fields
-        for phi in self.fields:
-            phi.completeField()
+    def getColumnNames(self, column):
+        if column == 0:
+            return self.names
+        return ['{}_{}'.format(name, column) for name in self.names]
+
+    # one column of adjoint fields for every objective
+    def createFields(self, nColumns=1):
+        self.nColumns = nColumns
+        self.columnFields = []
+        for column in range(0, nColumns):
+            fields = []
+            for name, dims in zip(self.getColumnNames(column), self.dimensions):
+                phi = np.zeros((self.mesh.nInternalCells, dims[0]), config.precision)
+                fields.append(IOField(name, phi, dims, self.mesh.defaultBoundary))
+            for phi in fields:
+                phi.completeField()
+            self.columnFields.append(fields)
+        self.fields = self.columnFields[0]
         self.firstRun = False
-        return fields
+        return self.columnFields
+
+    def readColumns(self, t):
+        columns = []
+        with IOField.handle(t):
+            for fields in self.columnFields:
+                columns.append([IOField.read(phi.name) for phi in fields])
+        return columns
+
+    def writeColumns(self, columns, t):
+        mesh = self.mesh
+        for fields, columnFields in zip(columns, self.columnFields):
+            self.fields = columnFields
+            fields = [phi.copy() for phi in fields]
+            for phi in fields:
+                phi.field /= mesh.volumes
+            self.writeFields(fields, t, skipProcessor=True)
+        self.fields = self.columnFields[0]
+        return
+
+    # time integrated sensitivity to the source terms
+    def getSensitivityNames(self, column):
+        names = [name + 'Sens' for name in primal.names]
+        if column == 0:
+            return names
+        return ['{}_{}'.format(name, column) for name in names]
+
+    def createSensitivityFields(self, t=None):
+        assert parameters[0] == 'source'
+        assert not primal.sparseSource
+        self.sensitivityFields = []
+        for column in range(0, self.nColumns):
+            fields = [np.zeros((self.mesh.nInternalCells, dims[0]), config.precision) for dims in self.dimensions]
+            if t is not None:
+                with IOField.handle(t):
+                    fields = [IOField.read(name).field for name in self.getSensitivityNames(column)]
+            self.sensitivityFields.append(fields)
+        return
+
+    def writeSensitivityFields(self, t):
+        with IOField.handle(t):
+            for column, fields in enumerate(self.sensitivityFields):
+                for name, phi, dims in zip(self.getSensitivityNames(column), fields, self.dimensions):
+                    IOField.internalField(name, phi.copy(), dims).write()
+        return
+
+    # homogeneous columns and the padding of the last batch have zero seeds
+    def getSeeds(self, column):
+        seeds = [np.zeros((1, 1), config.precision) for index in range(0, primal.nObjectives)]
+        inhomogeneous = min(self.inhomogeneousColumns, primal.nObjectives, self.nColumns)
+        if not self.homogeneousAdjoint and column < inhomogeneous:
+            seeds[column] += 1.
+        return seeds
+
+    # the adjoint has no configuration of its own, its code depends on the
+    # primal and the batch, viscosity and parameter of the adjoint map
+    def getCodeConfig(self):
+        codeConfig = primal.getCodeConfig()
+        codeConfig.update({'nBatch': self.nBatch, 'nObjectives': primal.nObjectives, 
+                           'viscosityType': self.viscosityType, 'matop_python': matop_python,
+                           'write_M_2norm': write_M_2norm, 'parameter': parameters[0]})
+        return codeConfig
 
     def compileInit(self):
         primal.compileInit()
@@ -95,34 +181,27 @@ class Adjoint(Solver):
         primal.compileSolver()
 
         mesh = primal.mesh
-        n = len(self.fields)
+        n = len(self.names)
         scaling = Variable((1, 1))
         # inputs of primal: fields, dt, mesh, source, BC, extra
-        gradOutputs, gradInputs = primal.map.grad()
-        fields = gradInputs[:n]
-
+        # one set of adjoint inputs and outputs for every column of a batch,
+        # the reverse sweeps of all columns share the recomputed primal step
+        self.nBatch = max(1, primal.nObjectives)
         param = parameters[0]
-        if param == 'source':
-            start = n + 1 + len(mesh.getTensor()) + len(mesh.getScalar())
-            end = start + n
-        elif param == 'mesh':
-            start = n + 1
-            end = start + len(Mesh.gradFields)
-        elif isinstance(param, tuple):
-            assert param[0] == 'BCs'
-            _, phi, patchID, key = param
-            patch = getattr(primal, phi).phi.BC[patchID]
-            index = patch.keys.index(key)
-            variable = patch.inputs[index][0]
-            start = primal.map._inputs.index(variable)
-            end = start + 1
-        else:
-            raise NotImplementedError
-        paramGradient = gradInputs[start:end]
-        self.nParams = end-start
-
-        args = list(primal.map._inputs) + gradOutputs + [scaling]
-        outputs = list(fields) + paramGradient
+        paramIndices = primal.getParameterIndices(param)
+        self.nParams = len(paramIndices)
+        args = list(primal.map._inputs)
+        batchFields, batchGradients = [], []
+        for column in range(0, self.nBatch):
+            gradOutputs, gradInputs = primal.map.grad()
+            args.extend(gradOutputs)
+            batchFields.append(list(gradInputs[:n]))
+            batchGradients.append([gradInputs[index] for index in paramIndices])
+        args.append(scaling)
+
+        outputs = []
+        for fields, paramGradient in zip(batchFields, batchGradients):
+            outputs.extend(fields + paramGradient)
         self.map = Function('primal_grad', args, outputs)
         if self.viscosityType and not matop_python:
             primalFields = list(primal.map._inputs[:n])
@@ -135,7 +214,9 @@ class Adjoint(Solver):
             #fields = Kernel(source)(mesh.symMesh.nInternalCells)(*(fields + [M_2norm]))
             #outputs = list(fields) + paramGradient
             # viscous damping
-            outputs = list(viscositySolver(*([primal] + primalFields + fields + [DT]))) + paramGradient
+            outputs = []
+            for column, (fields, paramGradient) in enumerate(zip(batchFields, batchGradients)):
+                outputs.extend(list(viscositySolver(*([primal] + primalFields + fields + [DT]), column=column)) + paramGradient)
             if write_M_2norm:
                 outputs = outputs + [M_2norm]
             self.viscousMap = Function('primal_grad_viscous', args, outputs)
@@ -156,7 +237,7 @@ class Adjoint(Solver):
             pprint('Read status file, checkpoint =', firstCheckpoint)
         else:
             firstCheckpoint = 0
-            result = [0.]*nPerturb
+            result = [0.]*(nPerturb*self.nColumns)
         if parallel.rank == 0:
             if not os.path.exists(primal.timeStepFile):
                 assert primal.fixedTimeStep
@@ -173,24 +254,43 @@ class Adjoint(Solver):
         primalData = (timeSteps,)
         return checkpointData, primalData
     
-    def run(self, checkpointData, primalData):
+    # columns and primalFields are in memory initial adjoint and primal
+    # fields, without write nothing is written to the case directory
+    def run(self, checkpointData, primalData, columns=None, primalFields=None, write=True):
 
         mesh = self.mesh
+        nSteps, writeInterval = self.nSteps, self.writeInterval
         result, firstCheckpoint = checkpointData
         (timeSteps,) = primalData
         sensTimeSeries = []
         energyTimeSeries = []
+        segmentTimeSeries = []
+        assert primalFields is None or nSteps == writeInterval
 
         startTime = timeSteps[nSteps - firstCheckpoint*writeInterval][0]
-        if (firstCheckpoint > 0) or self.forceReadFields:
-            fields = self.readFields(startTime)
-            for phi in fields:
-                phi.field *= mesh.volumes
+        if columns is not None:
+            columns = [[phi.copy() for phi in fields] for fields in columns]
+        elif (firstCheckpoint > 0) or self.forceReadFields:
+            columns = self.readColumns(startTime)
+            for fields in columns:
+                for phi in fields:
+                    phi.field *= mesh.volumes
         else:
-            fields = self.fields
+            columns = [[phi.copy() for phi in fields] for fields in self.columnFields]
+        # sensitivities are only summed on the root, previous runs are read
+        # from the time series
+        averaging = None
+        if self.averageTolerance > 0 and write:
+            averaging = RunLengthMonitor(self.averageTolerance, primal.averageConfidence)
+            if parallel.rank == 0 and firstCheckpoint > 0 and os.path.exists(self.sensTimeSeriesFile):
+                for sensitivities in np.loadtxt(self.sensTimeSeriesFile, ndmin=2):
+                    averaging.append(sensitivities)
+        converged = False
+
         pprint('STARTING ADJOINT')
         pprint('Number of steps:', nSteps)
         pprint('Write interval:', writeInterval)
+        pprint('Number of adjoint columns:', self.nColumns)
         pprint()
 
 
@@ -202,8 +302,17 @@ class Adjoint(Solver):
             if not isinstance(perturbation, list):# or (len(parameters) == 1 and len(perturbation) > 1):
                 perturbation = [perturbation]
                 # complex parameter perturbation not supported
-            perturbations.append(perturbation)
-
+            perturbations.append(primal.getParameterValues(parameters[0], perturbation))
+        # local sensitivities accumulated between samples, one row per column
+        columnSensitivities = np.zeros((self.nColumns, len(perturb)))
+        # perturbations stacked on their support, all sensitivities in one pass
+        if len(perturbations) > 0:
+            perturbIndices, perturbValues = stackPerturbations(perturbations)
+        if self.sensitivityField:
+            if firstCheckpoint > 0:
+                self.createSensitivityFields(startTime)
+            else:
+                self.createSensitivityFields()
 
         totalCheckpoints = nSteps//writeInterval
         nCheckpoints = min(firstCheckpoint + runCheckpoints, totalCheckpoints)
@@ -214,7 +323,7 @@ class Adjoint(Solver):
             t = timeSteps[primalIndex, 0]
             dts = timeSteps[primalIndex:primalIndex+writeInterval+1, 1]
 
-            solutions = primal.run(startTime=t, dt=dts, nSteps=writeInterval, mode='forward', reportInterval=reportInterval)
+            solutions = primal.run(startTime=t, dt=dts, nSteps=writeInterval, mode='forward', reportInterval=reportInterval, fields=primalFields)
 
             pprint('ADJOINT BACKWARD RUN {0}/{1}: {2} Steps\n'.format(checkpoint, totalCheckpoints, writeInterval))
             pprint('Time marching for', ' '.join(self.names))
@@ -227,20 +336,20 @@ class Adjoint(Solver):
                 else:
                     lastSolution = solutions[-1]
 
-                fieldsCopy = [phi.copy() for phi in fields]
-                for phi in fields:
-                    phi.field /= mesh.volumes
-                self.writeFields(fields, t, skipProcessor=True)
-                fields = fieldsCopy
+                if write:
+                    self.writeColumns(columns, t)
 
             primal.updateSource(source(solutions[-1], mesh, 0))
 
             pprint('Time step', writeInterval)
-            for phi in fields:
-                phi.info()
-            #energyTimeSeries.append(getAdjointEnergy(primal, *fields))
-            inputs = [phi.field for phi in fields + solutions[-1]] + mesh.getTensor() + mesh.getScalar()
-            energyTimeSeries.append(self.computeEnergy(*inputs))
+            energies = []
+            for fields in columns:
+                for phi in fields:
+                    phi.info()
+                #energyTimeSeries.append(getAdjointEnergy(primal, *fields))
+                inputs = [phi.field for phi in fields + solutions[-1]] + mesh.getTensor() + mesh.getScalar()
+                energies.append(self.computeEnergy(*inputs))
+            energyTimeSeries.append(energies)
 
             pprint()
 
@@ -248,6 +357,9 @@ class Adjoint(Solver):
                 report = ((step + 1) % reportInterval) == 0
                 sample = ((step + 1) % sampleInterval) == 0
                 viscous = ((step + 1) % viscousInterval) == 0
+                # static parameter gradients are accumulated by the map,
+                # columns in separate batches need them returned every step
+                static = sample or (self.nColumns > self.nBatch)
                 
                 adjointIndex = writeInterval-1 - step
                 t, dt = timeSteps[primalIndex + adjointIndex]
@@ -265,95 +377,100 @@ class Adjoint(Solver):
                 #for index in range(0, n):
                 #    fields[index].field *= mesh.volumes
 
+                # primal recomputation for this step is shared by the columns of
+                # a batch, the last batch is padded with zero columns
+                primalInputs = primal.getInputs(previousSolution, dt)
                 dtca = np.zeros((1, 1)).astype(config.precision)
-                obja = np.ones((1, 1)).astype(config.precision)
-                if self.homogeneousAdjoint:
-                    obja *= 0.
-                inputs = [phi.field for phi in previousSolution] + \
-                     [np.array([[dt]], config.precision)] + \
-                     mesh.getTensor() + mesh.getScalar() + \
-                     [x[1] for x in primal.sourceTerms] + \
-                     primal.getBoundaryTensor(1) + \
-                     [x[1] for x in primal.extraArgs] + \
-                     [phi.field for phi in fields] + \
-                     [dtca, obja] + \
-                     [np.array([[self.scaling]], config.precision)]
-                options = {'return_static': sample,
-                           'zero_static': sample,
-                           'return_reusable': report,
-                           'replace_reusable': False,
-                           }
-
-                start10 = time.time()
-                if self.viscosityType and not matop_python and viscous:
-                    outputs = self.viscousMap(*inputs, **options)
-                else:
-                    outputs = self.map(*inputs, **options)
-                pprint(time.time()-start10)
-
-                #print(sum([(1e-3*phi).sum() for phi in gradient]))
-                #inp1 = inputs[:3] + inputs[-3:-1]
-                #inp2 = [phi + 1e-3 for phi in inputs[:3]] + inputs[-3:-1]
-                #x1 = primal.map(*inp1)[-2]
-                #x2 = primal.map(*inp2)[-2]
-                #print(x1, x2, x1-x2)
-                #import pdb;pdb.set_trace()
-
-                # gradients
-                n = len(fields)
-                gradient = outputs[:n]
-                for index in range(0, n):
-                    fields[index].field = gradient[index]
-                    #fields[index].field = gradient[index]/mesh.volumes
-
-                if matop_python:
-                    stackedFields = np.concatenate([phi.field/mesh.volumes for phi in fields], axis=1)
-                    stackedFields = np.ascontiguousarray(stackedFields)
-
-                    inputs = previousSolution + [self.scaling]
-                    kwargs = {'visc': self.viscosityType, 'scale': self.viscosityScaler, 'report':report}
-                    weight = interp.centralOld(getAdjointViscosity(*inputs, **kwargs), mesh)
-                    stackedPhi = Field('a', stackedFields, (5,))
-                    stackedPhi.old = stackedFields
-                    newStackedFields = (matop_petsc.ddt(stackedPhi, dt) - matop_petsc.laplacian(stackedPhi, weight, correction=False)).solve()
-                        #newStackedFields = stackedFields/(1 + weight*dt)
-
-                    newFields = [newStackedFields[:,[0]], 
-                                 newStackedFields[:,[1,2,3]], 
-                                 newStackedFields[:,[4]]
-                                ]
-                            
-                    fields = self.getFields(newFields, IOField)
-                    for phi in fields:
-                        phi.field = np.ascontiguousarray(phi.field)*mesh.volumes
+                scaling = np.array([[self.scaling]], config.precision)
+                padding = [np.zeros_like(phi.field) for phi in columns[0]]
+                n = len(self.names)
+                nOutputs = n + self.nParams
+
+                for batch in range(0, self.nColumns, self.nBatch):
+                    inputs = list(primalInputs)
+                    for column in range(batch, batch + self.nBatch):
+                        if column < self.nColumns:
+                            inputs.extend([phi.field for phi in columns[column]])
+                        else:
+                            inputs.extend(padding)
+                        inputs.extend([dtca] + self.getSeeds(column))
+                    inputs.append(scaling)
+                    options = {'return_static': static,
+                               'zero_static': static,
+                               'return_reusable': report,
+                               'replace_reusable': False,
+                               }
+
+                    start10 = time.time()
+                    if self.viscosityType and not matop_python and viscous:
+                        outputs = self.viscousMap(*inputs, **options)
+                    else:
+                        outputs = self.map(*inputs, **options)
+                    pprint(time.time()-start10)
+
+                    for column in range(batch, min(batch + self.nBatch, self.nColumns)):
+                        fields = columns[column]
+                        columnOutputs = outputs[(column-batch)*nOutputs:(column-batch+1)*nOutputs]
+                        # gradients, output buffers are reused by the next batch
+                        gradient = columnOutputs[:n]
+                        for index in range(0, n):
+                            fields[index].field = gradient[index].copy() if self.nColumns > self.nBatch else gradient[index]
+                            #fields[index].field = gradient[index]/mesh.volumes
+
+                        if matop_python:
+                            stackedFields = np.concatenate([phi.field/mesh.volumes for phi in fields], axis=1)
+                            stackedFields = np.ascontiguousarray(stackedFields)
+
+                            inputs = previousSolution + [self.scaling]
+                            kwargs = {'visc': self.viscosityType, 'scale': self.viscosityScaler, 'report':report}
+                            weight = interp.centralOld(getAdjointViscosity(*inputs, **kwargs), mesh)
+                            stackedPhi = Field('a', stackedFields, (5,))
+                            stackedPhi.old = stackedFields
+                            newStackedFields = matop_petsc.heat_equation(stackedPhi, weight, dt).solve()
+                                #newStackedFields = stackedFields/(1 + weight*dt)
+
+                            newFields = [newStackedFields[:,[0]], 
+                                         newStackedFields[:,[1,2,3]], 
+                                         newStackedFields[:,[4]]
+                                        ]
+                                    
+                            fields = self.getFields(newFields, IOField, refFields=self.columnFields[column])
+                            for phi in fields:
+                                phi.field = np.ascontiguousarray(phi.field)*mesh.volumes
+                            columns[column] = fields
+
+                        if static:
+                            paramGradient = list(columnOutputs[n:nOutputs])
+
+                            # compute sensitivity using adjoint solution
+                            if len(perturbations) > 0:
+                                #for index, perturbation in enumerate(perturbations):
+                                #    columnSensitivities[column, index] += cmesh.computeSensitivity(paramGradient, perturbation)
+                                columnSensitivities[column] += cmesh.computeSensitivities(paramGradient, perturbIndices, perturbValues)
+                            if self.sensitivityFields is not None:
+                                for phi, derivative in zip(self.sensitivityFields[column], paramGradient):
+                                    phi += derivative
 
                 #print([type(x) for x in outputs])
                 if sample:
-                    paramGradient = list(outputs[n:n + self.nParams])
-
-                    # compute sensitivity using adjoint solution
-                    sensitivities = []
-                    for index, perturbation in enumerate(perturbations):
-                        # make efficient cpu implementation
-                        #sensitivity = 0.
-                        #for derivative, delphi in zip(paramGradient, perturbation):
-                        #    sensitivity += np.sum(derivative * delphi)
-                        sensitivity = cmesh.computeSensitivity(paramGradient, perturbation)
-                        sensitivities.append(sensitivity)
-                    sensitivities = parallel.sum(sensitivities, allreduce=False)
+                    sensitivities = parallel.sum(columnSensitivities.flatten().tolist(), allreduce=False)
+                    columnSensitivities[:] = 0.
                     if (nSteps - (primalIndex + adjointIndex)) > avgStart:
-                        for index in range(0, len(perturb)):
+                        for index in range(0, len(sensitivities)):
                             result[index] += sensitivities[index]
                     sensitivities = [sens/sampleInterval for sens in sensitivities]
                     for i in range(0, sampleInterval):
                         sensTimeSeries.append(sensitivities)
 
                 if report:
-                    for phi in fields:
-                        phi.info()
-                    #energyTimeSeries.append(getAdjointEnergy(primal, *fields))
-                    inputs = [phi.field for phi in fields + previousSolution] + mesh.getTensor() + mesh.getScalar()
-                    energyTimeSeries.append(self.computeEnergy(*inputs))
+                    energies = []
+                    for fields in columns:
+                        for phi in fields:
+                            phi.info()
+                        #energyTimeSeries.append(getAdjointEnergy(primal, *fields))
+                        inputs = [phi.field for phi in fields + previousSolution] + mesh.getTensor() + mesh.getScalar()
+                        energies.append(self.computeEnergy(*inputs))
+                    energyTimeSeries.append(energies)
                     #print(self.computeEnergy(*inputs), getSymmetrizedAdjointEnergy(primal, *inputs[:6]))
                     end = time.time()
                     pprint('Time for adjoint iteration: {0}'.format(end-start))
@@ -362,7 +479,23 @@ class Adjoint(Solver):
                 pprint()
                 #parallel.mpi.Barrier()
 
-            self.writeStatusFile([checkpoint + 1, result])
+            segmentTimeSeries.extend(sensTimeSeries)
+            checkpoint += 1
+            if averaging is not None:
+                if parallel.rank == 0:
+                    for sensitivities in sensTimeSeries:
+                        averaging.append(sensitivities)
+                    converged = averaging.update()
+                converged = parallel.mpi.bcast(converged, root=0)
+                if converged:
+                    pprint('Converged: average', averaging.mean, '+-', averaging.halfWidth, \
+                           'after a transient of', averaging.start, 'steps')
+            if not write:
+                sensTimeSeries = []
+                energyTimeSeries = []
+                continue
+
+            self.writeStatusFile([checkpoint, result])
             #energyTimeSeries = mpi.gather(timeSeries, root=0)
             if parallel.rank == 0:
                 with open(self.sensTimeSeriesFile, 'ab') as f:
@@ -371,15 +504,12 @@ class Adjoint(Solver):
                     np.savetxt(f, energyTimeSeries)
             sensTimeSeries = []
             energyTimeSeries = []
-            checkpoint += 1
 
             #exit(1)
             #print(fields[0].field.max())
-            fieldsCopy = [phi.copy() for phi in fields]
-            for phi in fields:
-                phi.field /= mesh.volumes
-            self.writeFields(fields, t, skipProcessor=True)
-            fields = fieldsCopy
+            self.writeColumns(columns, t)
+            if self.sensitivityFields is not None:
+                self.writeSensitivityFields(t)
 
             # write M_2norm
             if write_M_2norm:
@@ -393,31 +523,47 @@ class Adjoint(Solver):
             #    phi.field *= mesh.volumes
 
             #print(fields[0].field.max())
+            if converged:
+                break
             
         #pprint(checkpoint, totalCheckpoints)
 
-        if checkpoint >= totalCheckpoints:
+        if converged:
+            writeResult('adjoint', list(averaging.mean) if parallel.rank == 0 else [], str(self.scaling), self.sensTimeSeriesFile, nSamples=1)
+            self.removeStatusFile()
+        elif checkpoint >= totalCheckpoints and write:
             writeResult('adjoint', result, str(self.scaling), self.sensTimeSeriesFile)
             #for index in range(0, nPerturb):
             #    writeResult('adjoint', result[index], '{} {}'.format(index, self.scaling))
             self.removeStatusFile()
-        return
+        return columns, segmentTimeSeries
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--readFields', action='store_true')
     parser.add_argument('--homogeneous', action='store_true')
+    parser.add_argument('--sensitivityField', action='store_true')
+    parser.add_argument('--nColumns', type=int, default=1)
+    parser.add_argument('--inhomogeneousColumns', type=int, default=None)
+    parser.add_argument('--averageTolerance', type=float, default=0.)
     user, args = parser.parse_known_args()
 
     adjoint = Adjoint(primal)
 
     primal.readFields(startTime)
-    adjoint.createFields()
+    # the batch of the compiled map is one column for every objective and
+    # does not depend on nColumns, so code compiled for the case is valid
+    # for any number of columns, which are run in batches
     adjoint.compile()
+    # single backward run for all objectives, extra columns are homogeneous
+    adjoint.createFields(max(user.nColumns, primal.nObjectives))
+    adjoint.inhomogeneousColumns = primal.nObjectives if user.inhomogeneousColumns is None else user.inhomogeneousColumns
 
     data = adjoint.initPrimalData()
     adjoint.forceReadFields = user.readFields
     adjoint.homogeneousAdjoint = user.homogeneous
+    adjoint.sensitivityField = user.sensitivityField
+    adjoint.averageTolerance = user.averageTolerance
 
     adjoint.run(*data)
 
@@ -0,0 +1,45 @@
+#!/usr/bin/python -u
+from __future__ import print_function
+
+from adFVM import config, parallel
+from adFVM.parallel import pprint
+
+from problem import primal, nSteps, writeInterval, reportInterval, perturb, parameters, source, avgStart, startTime
+from problem import dt as Dt
+
+import numpy as np
+import argparse
+
+# ensemble of primal runs in one process sharing the mesh and compiled map,
+# the members are advanced one after the other so the run takes as long as
+# the separate runs, members start from copies
+# of the initial fields with random perturbations of relative size eps
+# (butterfly effect) or run the perturbations of the problem file on copies
+# of the same initial fields
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--members', type=int, default=2)
+    parser.add_argument('--eps', type=float, default=1e-6)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--perturb', action='store_true')
+    user, args = parser.parse_known_args()
+
+    fields = primal.readFields(startTime)
+    primal.compile()
+
+    perturbations = None
+    if user.perturb:
+        perturbations = [(parameters, perturbation) for perturbation in perturb]
+        members = [[phi.field.copy() for phi in fields] for perturbation in perturbations]
+    else:
+        np.random.seed(user.seed + parallel.rank)
+        members = [[phi.field.copy() for phi in fields]]
+        for member in range(1, user.members):
+            members.append([phi.field*(1 + user.eps*np.random.randn(*phi.field.shape)).astype(config.precision) for phi in fields])
+
+    members, result = primal.runEnsemble(members, startTime=startTime, dt=Dt, nSteps=nSteps, writeInterval=writeInterval, \
+                                         reportInterval=reportInterval, source=source, perturbations=perturbations, avgStart=avgStart)
+    pprint('Ensemble objectives:', result/(nSteps-avgStart))
+
+if __name__ == '__main__':
+    main()
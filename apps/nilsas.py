@@ -1,6 +1,6 @@
 #!/usr/bin/python
 import numpy as np
-from scipy import sparse
+from scipy import linalg
 import scipy.sparse.linalg as splinalg
 import os
 import re
@@ -9,8 +9,12 @@ import shutil
 import pickle
 from pathos.multiprocessing import Pool
 from pathos.helpers import mp
+try:
+    import h5py
+except ImportError:
+    h5py = None
 
-from adFVM.interface import SerialRunner
+from adFVM.interface import SerialRunner, InProcessRunner
 #class SerialRunner(object):
 class SerialRunnerLorenz(object):
     def __init__(self, base, time, dt, templates, **kwargs):
@@ -30,10 +34,11 @@ class SerialRunnerLorenz(object):
     def removeCase(self, case):
         pass
 
-    def runPrimal(self, fields, primalData, case):
+    def runPrimal(self, fields, primalData, case, nLastStates=0):
         parameter, nSteps = primalData
         print(case)
         rho, beta, sigma = 28. + parameter, 8./3, 10.
+        states = [fields]
         for i in range(0, nSteps):
             x, y, z = fields
             fields = fields + self.dt*np.array([
@@ -41,6 +46,9 @@ class SerialRunnerLorenz(object):
                     x*(rho-z)-y,
                     x*y - beta*z
                 ])
+            states.append(fields)
+        if nLastStates > 0:
+            return fields, 0., states[-(nLastStates+1):]
         return fields, 0.
 
     def runAdjoint(self, fields, primalData, primalFields, case, homogeneous=False, interprocess=None, args=None):
@@ -67,6 +75,121 @@ class SerialRunnerLorenz(object):
             fields = fields + self.dt*ft
         return fields, np.array(vfs)
 
+class SegmentList(object):
+    # per segment tuples of arrays in groups of a checkpoint file, items
+    # are read on access and new ones are written only on flush
+    def __init__(self, handle, name, keys):
+        self.group = handle.require_group(name)
+        self.keys = keys
+        self.pending = []
+
+    def stored(self):
+        return int(self.group.attrs.get('count', 0))
+
+    def __len__(self):
+        return self.stored() + len(self.pending)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not (0 <= index < len(self)):
+            raise IndexError(index)
+        count = self.stored()
+        if index >= count:
+            return self.pending[index-count]
+        group = self.group[str(index)]
+        return tuple([group[key][()] for key in self.keys])
+
+    def append(self, item):
+        self.pending.append(item)
+
+    def extend(self, items):
+        self.pending.extend(items)
+
+    def flush(self):
+        count = self.stored()
+        for item in self.pending:
+            group = self.group.require_group(str(count))
+            for key, value in zip(self.keys, item):
+                if key in group:
+                    del group[key]
+                group.create_dataset(key, data=value)
+            count += 1
+        self.group.attrs['count'] = count
+        self.pending = []
+
+class CheckpointStore(object):
+    # chunked HDF5 checkpoint, primal fields and small segment data are
+    # appended per segment and the adjoint vectors are overwritten in place
+    def __init__(self, fileName):
+        self.handle = h5py.File(fileName, 'a')
+        self.gradientInfo = SegmentList(self.handle, 'gradientInfo', ('R', 'b', 'dw', 'dv'))
+        self.sensitivities = SegmentList(self.handle, 'sensitivities', ('JW', 'Jw'))
+
+    def writeDataset(self, group, key, value):
+        if key in group and group[key].shape == value.shape:
+            group[key][...] = value
+        else:
+            if key in group:
+                del group[key]
+            group.create_dataset(key, data=value, chunks=True)
+
+    def savePrimal(self, index, fields):
+        group = self.handle.require_group('primal/{}'.format(index))
+        self.writeDataset(group, 'fields', np.asarray(fields))
+        self.handle.flush()
+
+    def saveLastStates(self, index, states):
+        group = self.handle.require_group('primal/{}'.format(index))
+        self.writeDataset(group, 'last', np.array(states))
+        self.handle.flush()
+
+    def hasPrimal(self, index, key='fields'):
+        name = 'primal/{}'.format(index)
+        return name in self.handle and key in self.handle[name]
+
+    def loadPrimal(self, index, key='fields'):
+        return self.handle['primal/{}/{}'.format(index, key)][()]
+
+    def primalIndices(self):
+        if 'primal' not in self.handle:
+            return []
+        return [int(index) for index in self.handle['primal'] if 'fields' in self.handle['primal'][index]]
+
+    def saveAdjoint(self, segment, W, w):
+        group = self.handle.require_group('adjoint')
+        self.writeDataset(group, 'W', np.asarray(W))
+        self.writeDataset(group, 'w', np.asarray(w))
+        self.gradientInfo.flush()
+        self.sensitivities.flush()
+        group.attrs['segment'] = segment
+        self.handle.flush()
+
+    def hasAdjoint(self):
+        return 'adjoint' in self.handle and 'segment' in self.handle['adjoint'].attrs
+
+    # datasets are returned unread
+    def loadAdjoint(self):
+        group = self.handle['adjoint']
+        return int(group.attrs['segment']), group['W'], group['w']
+
+def bandedUpper(diagonal, upper, u):
+    # upper band storage of a symmetric block tridiagonal matrix with
+    # diagonal blocks diagonal[k] and blocks upper[k] at (k, k+1)
+    nseg, p, _ = diagonal.shape
+    ab = np.zeros((u + 1, nseg*p))
+    i, j = np.triu_indices(p)
+    k = np.arange(0, nseg).reshape(-1,1)
+    rows, cols = k*p + i, k*p + j
+    ab[u + rows - cols, cols] = diagonal[:, i, j]
+    i, j = np.indices((p, p)).reshape(2, -1)
+    k = np.arange(0, nseg-1).reshape(-1,1)
+    rows, cols = k*p + i, (k+1)*p + j
+    ab[u + rows - cols, cols] = upper[:, i, j]
+    return ab
+
 def compute_dxdt_of_order(u, order):
     assert order >= 1
     A = np.array([np.arange(order + 1) ** i for i in range(order + 1)])
@@ -76,14 +199,14 @@ def compute_dxdt_of_order(u, order):
     return sum([c[i]*u[i] for i in range(0, order+1)])
 
 class NILSAS:
-    def __init__(self, args1, args2, nProcs, flags=None):
+    def __init__(self, args1, args2, nProcs, flags=None, runner=SerialRunner, batched=False, store=True):
         nExponents, nSteps, nSegments, nRuns = args1
         base, time, dt, templates = args2
         self.nExponents = nExponents
         self.nSteps = nSteps
         self.nSegments = nSegments
         self.nRuns = nRuns
-        self.runner = SerialRunner(base, time, dt, templates, nProcs=nProcs, flags=flags)
+        self.runner = runner(base, time, dt, templates, nProcs=nProcs, flags=flags)
         self.prevFields = self.runner.readFields(base, time)
         self.nDOF = self.prevFields.shape[0]
         self.adjointFields = []
@@ -91,6 +214,15 @@ class NILSAS:
         self.sensitivities = []
         self.parameter = 0.0
         self.checkpointInterval = 10
+        self.orderOfAccuracy = 3
+        # all adjoint vectors of a segment as columns of nRuns adjoint runs
+        self.batched = batched
+        # pickle checkpoints without h5py
+        self.store = None
+        if store and h5py is not None:
+            self.store = CheckpointStore(self.runner.base + 'checkpoint.hdf5')
+            self.gradientInfo = self.store.gradientInfo
+            self.sensitivities = self.store.sensitivities
         return
 
     def initRandom(self):
@@ -121,7 +253,14 @@ class NILSAS:
 
     # forward index
     def getNeutralDirection(self, segment):
-        orderOfAccuracy = 3
+        orderOfAccuracy = self.orderOfAccuracy
+        # backward difference from the end of the stored primal segment
+        lastStates = self.loadLastStates(segment + 1)
+        if lastStates is not None and len(lastStates) > orderOfAccuracy:
+            res = lastStates[::-1][:orderOfAccuracy + 1]
+            neutral = -compute_dxdt_of_order(res, orderOfAccuracy)
+            return neutral/np.linalg.norm(neutral)
+
         res = [self.loadPrimal(segment + 1)]
         for nSteps in range(1, orderOfAccuracy + 1):
             case = self.runner.base + 'segment_{}_neutral_{}_nsteps/'.format(segment, nSteps)
@@ -137,24 +276,66 @@ class NILSAS:
         # serial process
         index = 0
         files = glob.glob(self.runner.base + 'checkpoint_primal_*.pkl')
-        if len(files) > 0:
-            index = max([int(re.search(r'\d+', os.path.basename(x)).group()) for x in files])
+        indices = [int(re.search(r'\d+', os.path.basename(x)).group()) for x in files]
+        if self.store is not None:
+            indices += self.store.primalIndices()
+        if len(indices) > 0:
+            index = max(indices)
             self.prevFields = self.loadPrimal(index)
         else:
             self.savePrimal(self.prevFields, index)
         for segment in range(index, self.nSegments):
             case = self.runner.base + 'segment_{}_primal/'.format(segment)
             self.runner.copyCase(case)
-            res = self.runner.runPrimal(self.prevFields, (self.parameter, self.nSteps), case)
+            res = self.runner.runPrimal(self.prevFields, (self.parameter, self.nSteps), case, nLastStates=self.orderOfAccuracy)
             self.runner.removeCase(case)
             self.savePrimal(res[0], segment + 1)
+            self.saveLastStates(res[2], segment + 1)
             self.prevFields = res[0]
         return
 
+    def runCases(self, runCase, cases):
+        # in process runners hold compiled solvers and run one case at a time
+        if getattr(self.runner, 'inProcess', False):
+            return [runCase(*args) for args in cases]
+        pool = Pool(self.nRuns)
+        results = [pool.apply_async(runCase, args) for args in cases]
+        return [res.get() for res in results]
+
+    # forward index
+    def runBatched(self, segment, W, w, primalFields):
+        # the inhomogeneous vector is the first column of the first group,
+        # every group shares one primal recomputation
+        vectors = [w] + list(W)
+        groups = np.array_split(np.arange(0, len(vectors)), min(self.nRuns, len(vectors)))
+        def runCase(runner, fields, primalData, primalFields, case, homogeneous, args):
+            runner.copyCase(case)
+            res = runner.runAdjointBatched(fields, primalData, primalFields, case, homogeneous=homogeneous, args=args)
+            runner.removeCase(case)
+            return res
+
+        cases = []
+        for index, group in enumerate(groups):
+            case = self.runner.base + 'segment_{}_batched_{}/'.format(segment, index)
+            homogeneous = index > 0
+            args = ['-g', str(index%2)] if homogeneous else []
+            cases.append((self.runner, [vectors[i] for i in group], (self.parameter, self.nSteps), primalFields, case, homogeneous, args))
+
+        fields, dJds = [], []
+        for res in self.runCases(runCase, cases):
+            fields.extend(res[0])
+            dJds.extend(res[1])
+        return fields[1:], np.array(dJds[1:]), fields[0], dJds[0]
+
     # forward index
     def runSegment(self, segment, W, w):
         primalFields = self.loadPrimal(segment)
         W, w = self.orthogonalize(segment, W, w)
+        if self.batched:
+            Wn, JW, wn, Jw = self.runBatched(segment, W, w, primalFields)
+            self.sensitivities.append((JW.sum(axis=1)/self.nSteps, Jw.sum()/self.nSteps))
+            return np.array(Wn), wn
+
         Wn = []
         def runCase(runner, fields, primalData, primalFields, case, homogeneous, interprocess, args):
             runner.copyCase(case)
@@ -163,21 +344,22 @@ class NILSAS:
             return res
 
         interprocess = None
-        pool = Pool(self.nRuns)
-        segments = []
+        cases = []
         for i in range(0, self.nExponents):
             case = self.runner.base + 'segment_{}_homogeneous_{}/'.format(segment, i)
-            segments.append(pool.apply_async(runCase, (self.runner, W[i], (self.parameter, self.nSteps), primalFields, case, True, interprocess, ['-g', str(i%2)])))
+            cases.append((self.runner, W[i], (self.parameter, self.nSteps), primalFields, case, True, interprocess, ['-g', str(i%2)]))
         case = self.runner.base + 'segment_{}_inhomogeneous/'.format(segment)
-        segments.append(pool.apply_async(runCase, (self.runner, w, (self.parameter, self.nSteps), primalFields, case, False, interprocess, [])))
+        cases.append((self.runner, w, (self.parameter, self.nSteps), primalFields, case, False, interprocess, []))
+
+        segments = self.runCases(runCase, cases)
 
         JW = []
         for i in range(0, self.nExponents):
-            res = segments[i].get() 
+            res = segments[i]
             Wn.append(res[0])
             JW.append(res[1])
         JW = np.array(JW)
-        wn, Jw = segments[-1].get()
+        wn, Jw = segments[-1]
 
         #JW = []
         #for i in range(0, self.nExponents):
@@ -213,22 +395,25 @@ class NILSAS:
         assert dv.shape == (b.shape[0],)
 
         nseg, subdim = b.shape
-        eyes = np.eye(subdim, subdim) * np.ones([nseg, 1, 1])
-        matrix_shape = (subdim * nseg, subdim * (nseg+1))
-        I = sparse.bsr_matrix((R, np.r_[1:nseg+1], np.r_[:nseg+1]))
-        D = sparse.bsr_matrix((eyes, np.r_[:nseg], np.r_[:nseg+1]), shape=matrix_shape)
-        B = (D - I).toarray()
-        
-        dw = np.concatenate((np.ravel(dw), np.zeros(subdim))).reshape(1,-1)
-        b = np.ravel(b)
-        B = np.vstack((B, dw))
-        b = np.concatenate((b, [-dv.sum()]))
-        Schur = np.dot(B, B.T) 
-        D = np.abs(np.diag(Schur))
-        #eps = 1e-6*np.min(D)
+        # B = [D - I; dw] is block bidiagonal with one dense row, B B^T
+        # without that row is block tridiagonal and factored as a band,
+        # the row is eliminated by bordering
         eps = 1e-6
-        Schur += eps*np.eye(B.shape[0])
-        alpha = np.dot(B.T, np.linalg.solve(Schur, b))
+        d = np.concatenate((dw, np.zeros((1, subdim))))
+        c = d[:-1] - np.einsum('kij,kj->ki', R, d[1:])
+
+        diagonal = (1 + eps)*np.eye(subdim) + np.einsum('kij,klj->kil', R, R)
+        upper = -R[:-1]
+        u = 2*subdim - 1
+        factor = linalg.cholesky_banded(bandedUpper(diagonal, upper, u))
+        y = linalg.cho_solve_banded((factor, False), np.column_stack((np.ravel(b), np.ravel(c))))
+        y1, y2 = y[:,0], y[:,1]
+        x = (-dv.sum() - np.dot(np.ravel(c), y1))/(np.dot(np.ravel(d), np.ravel(d)) + eps - np.dot(np.ravel(c), y2))
+        x1 = (y1 - y2*x).reshape(nseg, subdim)
+
+        alpha = np.concatenate((x1, np.zeros((1, subdim))))
+        alpha[1:] -= np.einsum('kji,kj->ki', R, x1)
+        alpha += d*x
         
         coeff = alpha.reshape([nseg+1,subdim])
         return coeff[::-1]
@@ -264,18 +449,43 @@ class NILSAS:
         return
 
     def savePrimal(self, fields, index):
+        if self.store is not None:
+            return self.store.savePrimal(index, fields)
         checkpointFile = self.runner.base + 'checkpoint_primal_{}.pkl'.format(index)
         with open(checkpointFile, 'wb') as f:
             checkpoint = fields
             pickle.dump(checkpoint, f)
 
     def loadPrimal(self, index):
+        if self.store is not None and self.store.hasPrimal(index):
+            return self.store.loadPrimal(index)
         checkpointFile = self.runner.base + 'checkpoint_primal_{}.pkl'.format(index)
         with open(checkpointFile, 'rb') as f:
             fields = pickle.load(f)
             return fields
 
+    def saveLastStates(self, states, index):
+        if self.store is not None:
+            return self.store.saveLastStates(index, states)
+        checkpointFile = self.runner.base + 'checkpoint_primal_{}_last.pkl'.format(index)
+        with open(checkpointFile, 'wb') as f:
+            pickle.dump(states, f)
+
+    def loadLastStates(self, index):
+        if self.store is not None and self.store.hasPrimal(index, 'last'):
+            return list(self.store.loadPrimal(index, 'last'))
+        checkpointFile = self.runner.base + 'checkpoint_primal_{}_last.pkl'.format(index)
+        if not os.path.exists(checkpointFile):
+            return None
+        with open(checkpointFile, 'rb') as f:
+            return pickle.load(f)
+
     def saveCheckpoint(self):
+        # only the latest adjoint vectors and the new segments are written
+        if self.store is not None:
+            W, w = self.adjointFields[-1]
+            self.store.saveAdjoint(len(self.adjointFields)-1, W, w)
+            return
         checkpointFile = self.runner.base + 'checkpoint_temp.pkl'
         with open(checkpointFile, 'wb') as f:
             checkpoint = (self.adjointFields, self.gradientInfo, self.sensitivities)
@@ -283,12 +493,22 @@ class NILSAS:
         shutil.move(checkpointFile, self.runner.base + 'checkpoint.pkl')
 
     def loadCheckpoint(self):
+        if self.store is not None and self.store.hasAdjoint():
+            segment, W, w = self.store.loadAdjoint()
+            self.adjointFields = [None]*segment + [(W, w)]
+            return
         checkpointFile = self.runner.base + 'checkpoint.pkl'
         if not os.path.exists(checkpointFile):
             return
         with open(checkpointFile, 'rb') as f:
             checkpoint = pickle.load(f, encoding='latin1')
+        if self.store is None:
             self.adjointFields, self.gradientInfo, self.sensitivities = checkpoint
+        else:
+            # pickled checkpoints are moved to the store
+            self.adjointFields = checkpoint[0]
+            self.gradientInfo.extend(checkpoint[1])
+            self.sensitivities.extend(checkpoint[2])
 
     # reverse index
     def run(self):
@@ -298,7 +518,7 @@ class NILSAS:
             self.adjointFields.append((W, w))
             self.saveCheckpoint()
         else:
-            W, w = self.adjointFields[-1]
+            W, w = [np.asarray(x) for x in self.adjointFields[-1]]
         for segment in range(len(self.adjointFields)-1, self.nSegments):
             W, w = self.runSegment(self.nSegments-segment-1, W, w)
             self.adjointFields[-1] = None
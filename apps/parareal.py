@@ -0,0 +1,160 @@
+#!/usr/bin/python
+import numpy as np
+import os
+import time
+import pickle
+import argparse
+from pathos.multiprocessing import Pool
+
+from adFVM import config
+from adFVM.interface import SerialRunner
+
+# parareal in time, the interval is split in nSlices slices propagated by
+# fine runs on separate process groups of nProcs ranks in parallel and
+# corrected serially by a cheap coarse propagator, the coarse runner has a
+# larger time step and can use its own template (a first order integrator)
+# on the same mesh, every slice starts at its own time so sources and
+# perturbations depending on time are applied at the right time
+class Parareal:
+    def __init__(self, args1, args2, coarseArgs, nProcs, flags=None, runner=SerialRunner, tolerance=1e-6):
+        nSlices, nSteps, nRuns, nIterations = args1
+        base, time, dt, template = args2
+        coarseDt, coarseTemplate = coarseArgs
+        self.nSlices = nSlices
+        self.nSteps = nSteps
+        self.nRuns = nRuns
+        self.nIterations = nIterations
+        self.tolerance = tolerance
+        self.fine = runner(base, time, dt, template, nProcs=nProcs, flags=flags)
+        self.coarse = runner(base, time, coarseDt, coarseTemplate, nProcs=nProcs, flags=flags)
+        self.nCoarseSteps = max(1, int(round(nSteps*dt/coarseDt)))
+        self.base = base
+        self.startTimes = [round(time + index*nSteps*dt, 12) for index in range(0, nSlices)]
+        self.parameter = 0.0
+        self.historyFile = base + 'pararealHistory.txt'
+        self.timeSeriesFile = base + 'pararealTimeSeries.txt'
+        self.checkpointFile = base + 'parareal.pkl'
+        # states at the start of every slice and the coarse propagation of
+        # every slice from the previous iteration
+        self.states = [self.fine.readFields(base, time)]
+        self.coarseStates = []
+        # objectives of the last fine propagation of every slice
+        self.series = [None]*nSlices
+        self.iteration = 0
+        # wall time of every fine slice, a serial in time run costs their sum
+        self.sliceTimes = np.zeros(nSlices)
+        return
+
+    def runCoarse(self, fields, index):
+        case = self.base + 'parareal_coarse_{}/'.format(index)
+        self.coarse.copyCase(case)
+        res = self.coarse.runPrimal(fields, (self.parameter, self.nCoarseSteps), case, startTime=self.startTimes[index])
+        self.coarse.removeCase(case)
+        return res[0]
+
+    def runFine(self, slices):
+        def runCase(runner, fields, primalData, case, startTime):
+            start = time.time()
+            runner.copyCase(case)
+            res = runner.runPrimal(fields, primalData, case, startTime=startTime)
+            runner.removeCase(case)
+            return res[0], res[1], time.time()-start
+
+        cases = []
+        for index in slices:
+            case = self.base + 'parareal_{}_fine_{}/'.format(self.iteration, index)
+            cases.append((self.fine, self.states[index], (self.parameter, self.nSteps), case, self.startTimes[index]))
+        # in process runners hold compiled solvers and run one case at a time
+        if getattr(self.fine, 'inProcess', False):
+            return [runCase(*args) for args in cases]
+        with Pool(self.nRuns) as pool:
+            results = [pool.apply_async(runCase, args) for args in cases]
+            return [res.get() for res in results]
+
+    def saveCheckpoint(self):
+        with open(self.checkpointFile, 'wb') as f:
+            pickle.dump((self.iteration, self.states, self.coarseStates, self.series, self.sliceTimes), f)
+
+    def loadCheckpoint(self):
+        if not os.path.exists(self.checkpointFile):
+            return
+        with open(self.checkpointFile, 'rb') as f:
+            self.iteration, self.states, self.coarseStates, self.series, self.sliceTimes = pickle.load(f)
+
+    def writeHistory(self, changes, elapsed):
+        serial = self.sliceTimes.sum()
+        print('parareal iteration', self.iteration, 'change', changes.max(), 'time', elapsed, 'serial estimate', serial)
+        with open(self.historyFile, 'a') as f:
+            f.write('{} {} {} {} {}\n'.format(self.iteration, changes.max(), elapsed, serial, ' '.join([str(x) for x in changes])))
+
+    def run(self):
+        start = time.time()
+        # initial serial coarse sweep
+        if len(self.coarseStates) == 0:
+            for index in range(0, self.nSlices):
+                self.coarseStates.append(self.runCoarse(self.states[index], index))
+                self.states.append(self.coarseStates[index])
+            self.saveCheckpoint()
+
+        while self.iteration < self.nIterations:
+            # slices before the iteration index are exact
+            first = self.iteration
+            slices = list(range(first, self.nSlices))
+            results = self.runFine(slices)
+            for index, res in zip(slices, results):
+                self.series[index] = res[1][:-1]
+                if self.iteration == 0:
+                    self.sliceTimes[index] = res[2]
+
+            # serial correction, U[n+1] = G(U[n]) + F(U[n]) - G_old(U[n])
+            changes = np.zeros(self.nSlices)
+            for index, res in zip(slices, results):
+                fineState = res[0]
+                if index == first:
+                    coarseState = self.coarseStates[index]
+                else:
+                    coarseState = self.runCoarse(self.states[index], index)
+                newState = coarseState + fineState - self.coarseStates[index]
+                self.coarseStates[index] = coarseState
+                changes[index] = np.linalg.norm(newState - self.states[index + 1])/np.linalg.norm(newState)
+                self.states[index + 1] = newState
+            self.iteration += 1
+            self.saveCheckpoint()
+            self.writeHistory(changes, time.time()-start)
+
+            converged = changes.max() <= self.tolerance or self.iteration == self.nSlices
+            if converged or self.iteration == self.nIterations:
+                # objectives of every slice from its last fine propagation, the
+                # slices before the iteration index were not propagated again
+                with open(self.timeSeriesFile, 'w') as f:
+                    np.savetxt(f, np.concatenate(self.series))
+            if converged:
+                break
+        return self.states
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('base')
+    parser.add_argument('time', type=float)
+    parser.add_argument('dt', type=float)
+    parser.add_argument('template')
+    parser.add_argument('--coarseDt', type=float, default=None)
+    parser.add_argument('--coarseTemplate', default=None)
+    parser.add_argument('--nProcs', type=int, default=1)
+    parser.add_argument('--nSlices', type=int, default=16)
+    parser.add_argument('--nSteps', type=int, default=1000)
+    parser.add_argument('--nRuns', type=int, default=16)
+    parser.add_argument('--nIterations', type=int, default=4)
+    parser.add_argument('--tolerance', type=float, default=1e-6)
+    user = parser.parse_args(config.args)
+    # the coarse propagator defaults to the fine template with 10 times the time step
+    coarseDt = user.coarseDt if user.coarseDt is not None else 10*user.dt
+    coarseTemplate = user.coarseTemplate if user.coarseTemplate is not None else user.template
+
+    parareal = Parareal((user.nSlices, user.nSteps, user.nRuns, user.nIterations), (user.base, user.time, user.dt, user.template), \
+                        (coarseDt, coarseTemplate), nProcs=user.nProcs, tolerance=user.tolerance)
+    parareal.loadCheckpoint()
+    parareal.run()
+
+if __name__ == '__main__':
+    main()
@@ -42,11 +42,19 @@ if not isinstance(perturb, list):
 nPerturb = len(perturb)
 
 primal.timeStepFile = primal.mesh.case + '{0}.{1}.txt'.format(nSteps, writeInterval)
+# steps and start of the average of a primal run stopped by its run length
+# monitor, used by the perturbed and adjoint runs
+primal.runLengthFile = primal.mesh.case + 'runLength.txt'
+caseSteps, caseAvgStart = nSteps, avgStart
+if os.path.exists(primal.runLengthFile):
+    nSteps, avgStart = [int(x) for x in open(primal.runLengthFile).read().split()]
 pprint('')
 
-def writeResult(option, result, info='-', timeSeriesFile=None):
+def writeResult(option, result, info='-', timeSeriesFile=None, nSamples=None):
 
-    globalResult = [res/(nSteps-avgStart) for res in result]
+    if nSamples is None:
+        nSamples = nSteps-avgStart
+    globalResult = [res/nSamples for res in result]
     resultFile = primal.resultFile
     if parallel.rank == 0:
         noise = 0
@@ -71,6 +79,8 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument('option', nargs='?', default='orig')
+    # also write the states of the last steps before nSteps
+    parser.add_argument('--writeLast', type=int, default=0)
     user = parser.parse_args(args)
 
     if parallel.mpi.bcast(os.path.exists(primal.statusFile), root=0):
@@ -81,6 +91,10 @@ if __name__ == "__main__":
         initResult = 0.
     
     if user.option == 'orig' or user.option == 'source':
+        if startIndex == 0:
+            nSteps, avgStart = caseSteps, caseAvgStart
+            if parallel.rank == 0 and os.path.exists(primal.runLengthFile):
+                os.remove(primal.runLengthFile)
         dts = dt
         nSims = 1
         mode = 'orig'
@@ -117,8 +131,14 @@ if __name__ == "__main__":
             perturbation = None
         result = primal.run(result=initResult, startTime=startTime, dt=dts, nSteps=nSteps, 
                             writeInterval=writeInterval, reportInterval=reportInterval, 
-                            mode=mode, startIndex=startIndex, source=source, perturbation=perturbation, avgStart=avgStart)
-        writeResult(user.option, [result], '{}'.format(sim), primal.timeSeriesFile)
+                            mode=mode, startIndex=startIndex, source=source, perturbation=perturbation, avgStart=avgStart,
+                            nLastStates=user.writeLast)
+        if primal.runLength is not None:
+            nSteps, avgStart = primal.runLength
+            if parallel.rank == 0:
+                with open(primal.runLengthFile, 'w') as f:
+                    f.write('{} {}\n'.format(nSteps, avgStart))
+        writeResult(user.option, list(np.atleast_1d(result)), '{}'.format(sim), primal.timeSeriesFile)
         primal.removeStatusFile()
         # if running multiple sims reset starting index and result
         startIndex = 0
@@ -0,0 +1,165 @@
+#!/usr/bin/python -u
+from __future__ import print_function
+
+from adFVM import config, parallel
+from adFVM.parallel import pprint
+from adFVM.field import IOField, SparseField
+
+from problem import primal, nSteps, writeInterval, reportInterval, perturb, writeResult, nPerturb, parameters, source, avgStart, startTime
+from problem import dt as Dt
+
+import numpy as np
+import time
+import os
+import argparse
+
+# tangent linear solver: perturbations are propagated forward with the primal
+# using directional derivatives of the compiled primal map, cost is one
+# extra map evaluation per perturbation (two if central, the default in
+# single precision where forward differences lose half the digits)
+class Tangent(object):
+    def __init__(self, primal, central=False):
+        self.primal = primal
+        self.mesh = primal.mesh
+        self.names = [name + 't' for name in primal.names]
+        self.central = central
+        self.tangentTimeSeriesFile = self.mesh.case + 'tangentTimeSeries.txt'
+        return
+
+    def getTimeSteps(self):
+        primal = self.primal
+        if parallel.rank == 0:
+            if not os.path.exists(primal.timeStepFile):
+                assert primal.fixedTimeStep
+                dts = np.ones(nSteps)*Dt
+            else:
+                dts = np.loadtxt(primal.timeStepFile, ndmin=2)[:,1]
+            assert dts.shape == (nSteps,)
+        else:
+            dts = np.zeros(nSteps)
+        parallel.mpi.Bcast(dts, root=0)
+        return dts
+
+    def getDirections(self, fields):
+        primal = self.primal
+        mesh = self.mesh
+        directions = []
+        for index in range(0, nPerturb):
+            values = primal.getPerturbationValues(parameters, perturb[index](fields, mesh, startTime))
+            direction = {}
+            for param, value in zip(parameters, values):
+                value = primal.getParameterValues(param, value)
+                for inputIndex, delta in zip(primal.getParameterIndices(param), value):
+                    if not isinstance(delta, SparseField):
+                        delta = np.asarray(delta, config.precision)
+                    direction[inputIndex] = delta
+            directions.append(direction)
+        return directions
+
+    def run(self):
+        primal = self.primal
+        mesh = self.mesh
+        n = len(primal.names)
+        nObjectives = primal.nObjectives
+
+        fields = primal.readFields(startTime)
+        primal.updateSource(source(fields, mesh, startTime))
+        dts = self.getTimeSteps()
+        directions = self.getDirections(fields)
+        tangents = [[np.zeros_like(phi.field) for phi in fields] for index in range(0, nPerturb)]
+
+        result = np.zeros((nPerturb, nObjectives))
+        tangentTimeSeries = []
+        pprint('STARTING TANGENT')
+        pprint('Number of steps:', nSteps)
+        pprint('Number of perturbations:', nPerturb)
+        pprint()
+
+        t = startTime
+        for timeIndex in range(0, nSteps):
+            report = ((timeIndex + 1) % reportInterval) == 0
+            dt = dts[timeIndex]
+            pprint('Time step', timeIndex + 1)
+            if report:
+                start = time.time()
+
+            inputs = primal.getInputs(fields, dt)
+            options = {'return_reusable': False,
+                       'replace_reusable': timeIndex == 0
+                      }
+
+            # linearized step for every perturbation, before the primal step
+            perturbed = []
+            for index in range(0, nPerturb):
+                direction = dict(directions[index])
+                for field in range(0, n):
+                    direction[field] = tangents[index][field]
+                eps = primal.getPerturbationSize(inputs, direction, self.central)
+                # output buffers are reused by the next map call
+                outputsP = [x.copy() for x in primal.perturbedMap(inputs, direction, eps, **options)]
+                if self.central:
+                    outputsM = [x.copy() for x in primal.perturbedMap(inputs, direction, -eps, **options)]
+                else:
+                    outputsM = None
+                perturbed.append((eps, outputsP, outputsM))
+
+            outputs = [x.copy() for x in primal.map(*inputs, **options)]
+            objectives = [obj[0,0] for obj in outputs[n+1:n+1+nObjectives]]
+
+            derivatives = np.zeros((nPerturb, nObjectives))
+            for index, (eps, outputsP, outputsM) in enumerate(perturbed):
+                if outputsM is None:
+                    outputsM, scale = outputs, eps
+                else:
+                    scale = 2*eps
+                # differences in double precision
+                for field in range(0, n):
+                    difference = outputsP[field].astype(np.float64)-outputsM[field]
+                    tangents[index][field] = (difference/scale).astype(config.precision)
+                for obj in range(0, nObjectives):
+                    derivatives[index, obj] = (np.float64(outputsP[n+1+obj][0,0])-outputsM[n+1+obj][0,0])/scale
+            fields = primal.getFields(outputs[:n], IOField, refFields=fields)
+
+            t = round(t + dt, 12)
+            if (timeIndex + 1) > avgStart:
+                result += derivatives
+            tangentTimeSeries.append(derivatives.flatten())
+
+            if report:
+                for index in range(0, nPerturb):
+                    tangentFields = primal.getFields(tangents[index], IOField, refFields=fields)
+                    for phi, name in zip(tangentFields, self.names):
+                        phi.name = '{}_{}'.format(name, index)
+                        phi.info()
+                end = time.time()
+                pprint('Objectives:', objectives)
+                pprint('Objective derivatives:', derivatives.flatten())
+                pprint('Time for tangent iteration:', end-start)
+                pprint('Time since beginning:', end-config.runtime)
+                pprint('Simulation Time:', t, 'Time step:', dt)
+            pprint()
+
+            if ((timeIndex + 1) % writeInterval) == 0:
+                if parallel.rank == 0:
+                    with open(self.tangentTimeSeriesFile, 'ab') as f:
+                        np.savetxt(f, tangentTimeSeries)
+                tangentTimeSeries = []
+
+        writeResult('tangent', result.flatten().tolist(), '-', self.tangentTimeSeriesFile)
+        return
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--central', action='store_true')
+    user, args = parser.parse_known_args()
+
+    central = user.central or (config.precision == np.float32)
+    tangent = Tangent(primal, central=central)
+
+    primal.readFields(startTime)
+    primal.compile()
+
+    tangent.run()
+
+if __name__ == '__main__':
+    main()
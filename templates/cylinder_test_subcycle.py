@@ -0,0 +1,15 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from cylinder_test import *
+
+# same run with five time steps per map call
+primal = RCF('../cases/cylinder/',
+             mu=lambda T: 2.5e-5,
+             boundaryRiemannSolver='eulerLaxFriedrichs',
+             objective = objective,
+             fixedTimeStep = True,
+             subCycles = 5,
+)
+
+reportInterval = writeInterval
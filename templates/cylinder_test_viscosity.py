@@ -0,0 +1,7 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from cylinder_test import *
+
+# adjoint viscosity in every step, for comparing the matop solvers
+adjParams = [1e-3, 'turkel', None]
@@ -4,6 +4,7 @@ import os
 from adFVM import config
 from adFVM.compat import intersectPlane
 from adFVM.density import RCF 
+from adFVM.field import SparseField
 from adpy import tensor
 from adFVM.mesh import Mesh
 
@@ -15,21 +16,33 @@ case = os.path.expanduser('~') + '/adFVM/cases/vane/laminar/'
 
 # create and initialize the folder (read mesh and setup boundary conditions)
 primal = RCF(case, objective=objective, fixedTimeStep=True)
+# source terms stored only on the support of the perturbations
+#primal = RCF(case, objective=objective, fixedTimeStep=True, sparseSource=True)
+# pressure loss and heat transfer sensitivities in a single adjoint run
+#from adFVM.objectives.vane import objectives
+#primal = RCF(case, objective=objectives, fixedTimeStep=True)
 getPlane(primal)
 getWeights(primal)
 
 # define perturbations for computing sensitivities of the design objective
-def makePerturb(mid, eps):
+def makePerturb(mid, eps, cutoff=1e-12):
     def perturb(fields, mesh, t):
-        G = eps*np.exp(-3e3*np.linalg.norm(mid-mesh.cellCentres[:mesh.nInternalCells], axis=1, keepdims=1)**2)
-        #rho
-	Uref = 100.
-	pref = 101325.
-        rho = G
-        rhoU = np.zeros((mesh.nInternalCells, 3), config.precision)
-        rhoU[:, 0] = G.flatten()*Uref
-        rhoE = G*(Uref*Uref/2 + pref/(primal.gamma-1))
-        return rho, rhoU, rhoE
+        # gaussian bump is stored on its support only, computed once
+        if not hasattr(perturb, 'perturbation'):
+            G = np.exp(-3e3*np.linalg.norm(mid-mesh.cellCentres[:mesh.nInternalCells], axis=1, keepdims=1)**2)
+            cells = np.nonzero(G[:,0] > cutoff)[0]
+            G = eps*G[cells]
+            #rho
+            Uref = 100.
+            pref = 101325.
+            rho = G
+            rhoU = np.zeros((len(cells), 3), config.precision)
+            rhoU[:, 0] = G.flatten()*Uref
+            rhoE = G*(Uref*Uref/2 + pref/(primal.gamma-1))
+            perturb.perturbation = (SparseField('rho', cells, rho, (1,)),
+                                    SparseField('rhoU', cells, rhoU, (3,)),
+                                    SparseField('rhoE', cells, rhoE, (1,)))
+        return perturb.perturbation
     return perturb
 perturb = [makePerturb(np.array([-0.02, 0.01, 0.005], config.precision), 1e-1)]
 # perturbation type: source terms for the compressible Navier-Stokes equations
@@ -0,0 +1,34 @@
+import os
+import glob
+import shutil
+import numpy as np
+
+from adFVM.density import RCF
+
+# a step rejected by the embedded error estimate is repeated from the
+# accepted state, so it gives the step of the reduced time step
+def test_rejectedStep():
+    case = '../cases/cylinder/'
+    solver = RCF(case, mu=lambda T: 2.5e-5, boundaryRiemannSolver='eulerLaxFriedrichs', \
+                 timeIntegrator='BS32', relativeTolerance=1e-10, absoluteTolerance=1e-10)
+    fields = solver.readFields(0.0)
+    initial = [phi.field.copy() for phi in fields]
+    solver.compile()
+    dt = 8e-9
+
+    try:
+        solver.run(startTime=0.0, dt=dt, nSteps=1, writeInterval=1, mode='orig', \
+                   fields=[x.copy() for x in initial], nLastStates=1)
+        final = [phi.field.copy() for phi in solver.lastStates[-1]]
+        t, acceptedDt = np.loadtxt(solver.timeStepFile, ndmin=2)[0]
+        assert acceptedDt < dt
+
+        # single step with the time steps of the run
+        fields, _ = solver.run(startTime=0.0, dt=np.array([acceptedDt, 0.]), nSteps=1, mode='segment', \
+                               fields=[x.copy() for x in initial])
+        for phi, phiF in zip(fields, final):
+            assert np.allclose(phi.field, phiF, rtol=1e-10, atol=0.)
+    finally:
+        solver.removeStatusFile()
+        list(map(shutil.rmtree, glob.glob(os.path.join(case, '0.0*'))))
+        list(map(os.remove, glob.glob(os.path.join(case, '*.txt'))))
@@ -0,0 +1,51 @@
+import numpy as np
+
+from adFVM.averaging import mser, meanVariance, RunLengthMonitor
+
+def ar1(n, phi, seed=0):
+    np.random.seed(seed)
+    noise = np.random.randn(n)
+    x = np.zeros(n)
+    for index in range(1, n):
+        x[index] = phi*x[index-1] + noise[index]
+    return x
+
+def test_mser():
+    x = ar1(4000, 0.5)
+    x[:500] += np.linspace(20., 0., 500)
+    start = mser(x)
+    assert 300 <= start <= 1000
+
+def test_meanVariance():
+    n, phi = 20000, 0.8
+    x = ar1(n, phi)
+    # variance of the mean of an AR(1) process with unit innovations
+    exact = 1./(n*(1-phi)**2)
+    assert abs(meanVariance(x)/exact - 1) < 0.3
+
+def test_RunLengthMonitor():
+    monitor = RunLengthMonitor(0.1)
+    x = ar1(20000, 0.5) + 1.
+    converged = False
+    for index, value in enumerate(x):
+        monitor.append(value)
+        if (index + 1) % 500 == 0 and monitor.update():
+            converged = True
+            break
+    assert converged
+    assert abs(monitor.mean[0] - 1.) < 3*monitor.halfWidth[0]
+
+def test_RunLengthMonitor_incremental():
+    # the running sums give the estimate of a refit on the stored series
+    x = np.stack((ar1(3000, 0.7) + 1e3, ar1(3000, 0.3, seed=1)), axis=1)
+    x[:300,0] += np.linspace(10., 0., 300)
+    monitor = RunLengthMonitor(1e-6)
+    for value in x:
+        monitor.append(value)
+    assert not monitor.update()
+    start = mser(x)
+    assert monitor.start == start
+    samples = x[start:]
+    assert np.allclose(monitor.mean, samples.mean(axis=0))
+    variance = [meanVariance(samples[:,index]) for index in range(0, 2)]
+    assert np.allclose(monitor.variance, variance, rtol=1e-6)
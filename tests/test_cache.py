@@ -0,0 +1,97 @@
+import subprocess
+import os
+import sys
+import shutil
+import glob
+python = sys.executable
+
+from adFVM.cache import KernelCache
+
+cases_path = '../cases/'
+apps_path = '../apps/'
+
+def writeCode(codeDir):
+    os.makedirs(os.path.join(codeDir, 'build'))
+    with open(os.path.join(codeDir, 'code.cpp'), 'w') as f:
+        f.write('int main() { return 0; }\n')
+    with open(os.path.join(codeDir, 'build', 'code.o'), 'w') as f:
+        f.write('object')
+
+def test_KernelCache(tmpdir):
+    cache = KernelCache(str(tmpdir.join('cache')))
+    assert oct(os.stat(cache.root).st_mode & 0o777) == oct(0o700)
+    codeDir = str(tmpdir.join('case', 'gencode'))
+    writeCode(codeDir)
+    cache.store('key', codeDir)
+
+    newDir = str(tmpdir.join('other', 'gencode'))
+    assert cache.load('key', newDir)
+    with open(os.path.join(newDir, 'code.cpp')) as f:
+        assert f.read() == 'int main() { return 0; }\n'
+    assert not os.path.exists(os.path.join(newDir, 'build'))
+    assert not cache.load('missing', newDir)
+
+def test_KernelCache_invalid(tmpdir):
+    cache = KernelCache(str(tmpdir.join('cache')))
+    codeDir = str(tmpdir.join('case', 'gencode'))
+    writeCode(codeDir)
+    cache.store('key', codeDir)
+    entry = cache.getEntry('key')
+    newDir = str(tmpdir.join('other', 'gencode'))
+
+    # entries writable by others are not loaded
+    os.chmod(entry, 0o777)
+    assert not cache.load('key', newDir)
+    os.chmod(entry, 0o700)
+    assert cache.load('key', newDir)
+
+    # modified sources do not match the manifest
+    with open(os.path.join(entry, 'code.cpp'), 'a') as f:
+        f.write('// changed\n')
+    assert not cache.load('key', str(tmpdir.join('third', 'gencode')))
+
+class Mesh(object):
+    boundary = {'left': {'type': 'cyclic'}, 'right': {'type': 'cyclic'}}
+
+# the key depends on the code configuration of the solver only
+class CodeSolver(object):
+    def __init__(self, **codeConfig):
+        self.mesh = Mesh()
+        self.codeConfig = codeConfig
+
+    def getCodeConfig(self):
+        return self.codeConfig
+
+def test_KernelCache_key(tmpdir):
+    cache = KernelCache(str(tmpdir.join('cache')))
+    compiler_args = {'compiler': 'mpicc', 'extra_compile_args': ['-O3']}
+    key = cache.getKey(CodeSolver(nBatch=1, viscosityType='turkel'), compiler_args)
+    assert key == cache.getKey(CodeSolver(nBatch=1, viscosityType='turkel'), compiler_args)
+    assert key != cache.getKey(CodeSolver(nBatch=2, viscosityType='turkel'), compiler_args)
+    assert key != cache.getKey(CodeSolver(nBatch=1, viscosityType=None), compiler_args)
+
+# an adjoint compiled through the cache and rebuilt from the cached entry
+# gives the same sensitivity
+def test_adjoint_cache(tmpdir):
+    case_path = os.path.join(cases_path, 'cylinder')
+    problem = os.path.join('../templates/', 'cylinder_test')
+    primal = os.path.join(apps_path, 'problem.py')
+    adjoint = os.path.join(apps_path, 'adjoint.py')
+    env = dict(os.environ, ADFVM_KERNEL_CACHE=str(tmpdir.join('cache')))
+
+    try:
+        subprocess.check_output([python, primal, problem, '-c'], env=env)
+        output = subprocess.check_output([python, adjoint, problem, '-c'], env=env)
+        assert b'Using cached kernels' not in output
+        output = subprocess.check_output([python, adjoint, problem, '-c'], env=env)
+        assert b'Using cached kernels' in output
+
+        with open(os.path.join(case_path, 'objective.txt')) as f:
+            data = f.readlines()
+        adjSens = float(data[1].split(' ')[-2])
+        cachedSens = float(data[2].split(' ')[-2])
+        assert adjSens == cachedSens
+    finally:
+        list(map(shutil.rmtree, glob.glob(os.path.join(case_path, '1.*'))))
+        list(map(os.remove, glob.glob(os.path.join(case_path, '*.txt'))))
+        list(map(os.remove, glob.glob(os.path.join(case_path, '*.pkl'))))
@@ -10,7 +10,7 @@ import pytest
 python = sys.executable
 
 from adFVM import config
-from adFVM.field import Field, CellField, IOField
+from adFVM.field import Field, CellField, IOField, SparseField
 from adFVM.mesh import Mesh
 from deep_eq import deep_eq
 
@@ -30,6 +30,16 @@ def test_field():
     W = (U + V/U)*V**0.5
     assert np.allclose(W.field, Wr)
 
+def test_sparse_field():
+    n = 100
+    Ur = np.zeros((n, 3))
+    cells = np.random.choice(n, 10, replace=False)
+    Ur[cells] = np.random.rand(10, 3) + 1
+
+    U = SparseField.fromDense('U', Ur, (3,))
+    assert np.array_equal(np.sort(U.indices), np.sort(cells))
+    assert np.allclose(U.toDense(n), Ur)
+    assert np.allclose((-U*2.).toDense(n), -2*Ur)
 
 @pytest.mark.skip
 def test_field_io(case, hdf5):
@@ -0,0 +1,74 @@
+import numpy as np
+
+from adFVM import timestep
+from adFVM.implicit import gmres, newtonKrylov
+
+def test_gmres():
+    np.random.seed(0)
+    n = 30
+    A = np.eye(n)*4 + np.random.rand(n, n)*0.1
+    b = np.random.rand(n)
+    x, iterations, residual = gmres(lambda v: np.dot(A, v), b, tolerance=1e-10, restart=n)
+    assert residual <= 1e-10
+    assert np.allclose(np.dot(A, x), b)
+
+def test_newtonKrylov():
+    # backward euler step of du/dt = -u**3
+    u0, dt = np.linspace(1., 2., 10), 10.
+    function = lambda u: u - u0 + dt*u**3
+    u, stats = newtonKrylov(function, u0.copy(), tolerance=1e-8, maxIterations=20, linearTolerance=1e-6)
+    assert stats['residual'] <= 1e-8
+    assert np.abs(function(u)).max() < 1e-6
+
+def test_gmres_restarted():
+    # preconditioned and restarted solves match the dense solution
+    np.random.seed(1)
+    n = 40
+    A = np.diag(np.linspace(1., 10., n)) + np.random.rand(n, n)*0.05
+    b = np.random.rand(n)
+    reference = np.linalg.solve(A, b)
+    diagonal = np.diag(A)
+    x, iterations, residual = gmres(lambda v: np.dot(A, v), b, lambda v: v/diagonal, \
+                                    tolerance=1e-12, restart=5, maxRestarts=50)
+    assert residual <= 1e-12
+    assert np.allclose(x, reference, rtol=1e-10, atol=1e-12)
+    x, iterations, residual = gmres(lambda v: np.dot(A, v), np.zeros(n))
+    assert iterations == 0 and not x.any()
+
+def test_newtonKrylov_roots():
+    # the backward euler step of du/dt = -u**3 has a single real root
+    u0, dt = np.linspace(1., 2., 10), 10.
+    function = lambda u: u - u0 + dt*u**3
+    u, stats = newtonKrylov(function, u0.copy(), tolerance=1e-12, maxIterations=50, linearTolerance=1e-10)
+    reference = []
+    for c in u0:
+        roots = np.roots([dt, 0., 1., -c])
+        reference.append(roots[np.abs(roots.imag) < 1e-12].real[0])
+    assert np.allclose(u, reference, rtol=1e-8)
+
+def test_imexPair():
+    # du/dt = -u + iu with the oscillation implicit, the implicit stages of
+    # the linear problem are solved exactly
+    def step(pair, u, dt):
+        a, b, ahat, bhat = pair
+        E, I = [-u], [1j*u]
+        for i in range(1, b.shape[0]):
+            known = u + dt*sum([a[i,j]*E[j] + ahat[i,j]*I[j] for j in range(0, i)])
+            v = known/(1 - ahat[i,i]*dt*1j)
+            E.append(-v)
+            I.append(1j*v)
+        return u + dt*sum([b[j]*E[j] + bhat[j]*I[j] for j in range(0, b.shape[0])])
+    for pair, order in [(timestep.ARS111(), 1), (timestep.ARS222(), 2), (timestep.ARS443(), 3)]:
+        errors = []
+        for nSteps in [20, 40]:
+            u, dt = 1., 1./nSteps
+            for index in range(0, nSteps):
+                u = step(pair, u, dt)
+            errors.append(abs(u - np.exp(-1 + 1j)))
+        assert abs(np.log2(errors[0]/errors[1]) - order) < 0.3
+
+def test_imexPair_order():
+    for integrator, order in [('euler', 1), ('SSPRK', 3), ('RK4_2N', 4), ('SSPRK104_2S', 4), ('BS32', 3)]:
+        assert timestep.getOrder(getattr(timestep, integrator)()) == order
+    assert timestep.imexPair(timestep.euler())[0].shape == (2, 2)
+    assert timestep.imexPair(timestep.RK4_2N())[0].shape == (5, 5)
@@ -0,0 +1,38 @@
+import subprocess
+import os
+import sys
+import shutil
+import glob
+python = sys.executable
+
+cases_path = '../cases/'
+apps_path = '../apps/'
+
+# the native chebyshev jacobi conjugate gradient solve of the adjoint
+# viscosity gives the sensitivity of the petsc solve
+def test_matop_native():
+    case_path = os.path.join(cases_path, 'cylinder')
+    problem = os.path.join('../templates/', 'cylinder_test_viscosity')
+    primal = os.path.join(apps_path, 'problem.py')
+    adjoint = os.path.join(apps_path, 'adjoint.py')
+
+    try:
+        subprocess.check_output([python, primal, problem, '-c'])
+
+        subprocess.check_output([python, adjoint, problem, '-c', '--matop_petsc'])
+        subprocess.check_output([python, adjoint, problem, '-c', '--matop_native'])
+
+        with open(os.path.join(case_path, 'objective.txt')) as f:
+            data = f.readlines()
+        petscSens = float(data[1].split(' ')[-2])
+        nativeSens = float(data[2].split(' ')[-2])
+        diff = abs(petscSens-nativeSens)/abs(petscSens)
+
+        assert diff < 1e-3
+    finally:
+        list(map(shutil.rmtree, glob.glob(os.path.join(case_path, '1.*'))))
+        list(map(os.remove, glob.glob(os.path.join(case_path, '*.txt'))))
+        list(map(os.remove, glob.glob(os.path.join(case_path, '*.pkl'))))
+
+if __name__ == '__main__':
+    test_matop_native()
@@ -0,0 +1,90 @@
+import numpy as np
+
+from adFVM import timestep
+from adFVM.multigrid import agglomerate, average, coarsen, coarseResidual, Level
+
+def test_agglomerate():
+    # 4x4 grid of cells
+    n = 4
+    cells = np.arange(0, n*n).reshape(n, n)
+    owner = np.concatenate((cells[:-1,:].flatten(), cells[:,:-1].flatten()))
+    neighbour = np.concatenate((cells[1:,:].flatten(), cells[:,1:].flatten()))
+    agglomerates, nCoarse = agglomerate(n*n, owner, neighbour)
+    assert (agglomerates >= 0).all()
+    assert nCoarse == len(np.unique(agglomerates))
+    assert 1 < nCoarse < n*n
+    # agglomerates are connected
+    for index in range(0, nCoarse):
+        members = np.where(agglomerates == index)[0]
+        if len(members) > 1:
+            links = np.isin(owner, members) & np.isin(neighbour, members)
+            assert links.sum() >= len(members) - 1
+
+def test_average():
+    index = np.array([0, 0, 1, 1, 1])
+    volumes = np.array([1., 3., 1., 1., 2.])
+    phi = np.arange(0, 5.).reshape(-1, 1)
+    phiC = average(index, volumes, phi, 2)
+    assert np.allclose(phiC.flatten(), [0.75, (2. + 3. + 8.)/4])
+
+def test_explicitStep():
+    # du/dt = -u with a local time step for every cell
+    dt = np.array([[0.2], [0.1]])
+    u0 = np.ones((2, 3))
+    for integrator, order in [('euler', 1), ('SSPRK', 3), ('RK3_2N', 3), ('RK4_2N', 4), \
+                              ('SSPRK_2S', 3), ('SSPRK104_2S', 4), ('SSPRK32', 3), ('BS32', 3)]:
+        coeff = getattr(timestep, integrator)()
+        u, = timestep.explicitStep(coeff, lambda fields: [-fields[0]], [u0], dt)
+        assert u.shape == u0.shape
+        assert (np.abs(u - np.exp(-dt)) <= dt**(order + 1)).all(), integrator
+
+# n x n grid of unit cells in the xy plane with unit depth
+def getGrid(n):
+    cells = np.arange(0, n*n).reshape(n, n)
+    owner = np.concatenate((cells[:-1,:].flatten(), cells[:,:-1].flatten()))
+    neighbour = np.concatenate((cells[1:,:].flatten(), cells[:,1:].flatten()))
+    nx, ny = n*(n-1), n*(n-1)
+    S = np.concatenate((np.tile([1., 0, 0], (nx, 1)), np.tile([0, 1., 0], (ny, 1))))
+    A = np.ones(nx + ny)
+    # outward area vectors of the boundary faces of every cell
+    boundaryS = np.zeros((n*n, 3))
+    boundaryS[cells[0,:], 0] -= 1
+    boundaryS[cells[-1,:], 0] += 1
+    boundaryS[cells[:,0], 1] -= 1
+    boundaryS[cells[:,-1], 1] += 1
+    boundaryA = 2 + np.abs(boundaryS).sum(axis=1)
+    index = np.arange(0, n*n)
+    return Level(index, index, n*n, np.ones(n*n), owner, neighbour, S, A, boundaryS, boundaryA)
+
+def getStates(nCells, gamma=1.4):
+    np.random.seed(0)
+    rho = 1 + np.random.rand(nCells, 1)
+    U = np.random.rand(nCells, 3)
+    p = 1e5*(1 + np.random.rand(nCells, 1))
+    return [rho, rho*U, p/(gamma-1) + 0.5*rho*(U*U).sum(axis=1, keepdims=True)]
+
+def test_coarseResidual_uniform():
+    fine = getGrid(6)
+    parent, nCoarse = agglomerate(fine.nCells, fine.owner, fine.neighbour)
+    coarse = coarsen(fine, parent, nCoarse)
+    assert np.allclose(coarse.volumes.sum(), fine.volumes.sum())
+    for level in [fine, coarse]:
+        states = [phi[:1].repeat(level.nCells, axis=0) for phi in getStates(1)]
+        R, dtc = coarseResidual(level, states, 1.4)
+        for phi, phiR in zip(states, R):
+            assert np.abs(phiR).max() <= 1e-10*np.abs(phi).max()
+        assert (dtc > 0).all()
+
+def test_coarseResidual_agglomerated():
+    # at rest the fluxes of the merged faces are the sums of the fine ones,
+    # so the coarse residual is the restriction of the fine residual at the
+    # prolongated states
+    fine = getGrid(6)
+    parent, nCoarse = agglomerate(fine.nCells, fine.owner, fine.neighbour)
+    coarse = coarsen(fine, parent, nCoarse)
+    states = getStates(nCoarse)
+    states[1] = np.zeros_like(states[1])
+    R, _ = coarseResidual(coarse, states, 1.4)
+    fineR, _ = coarseResidual(fine, [phi[parent] for phi in states], 1.4)
+    for phi, phiF in zip(R, fineR):
+        assert np.allclose(phi, average(parent, fine.volumes, phiF, nCoarse))
@@ -0,0 +1,84 @@
+import sys
+import numpy as np
+
+sys.path.insert(0, '../apps/')
+from nilsas import NILSAS, CheckpointStore
+
+def getGradientInfo(nSegments, nExponents, seed=0):
+    np.random.seed(seed)
+    gradientInfo = []
+    for segment in range(0, nSegments + 1):
+        R = np.triu(np.random.rand(nExponents, nExponents)) + np.eye(nExponents)
+        b = np.random.rand(nExponents)
+        dw = np.random.rand(nExponents)
+        dv = np.random.rand()
+        gradientInfo.append((R, b, dw, dv))
+    return gradientInfo
+
+def getNILSAS(gradientInfo, nExponents):
+    nilsas = NILSAS.__new__(NILSAS)
+    nilsas.nExponents = nExponents
+    nilsas.nSteps = 10
+    nilsas.gradientInfo = gradientInfo
+    return nilsas
+
+# dense normal equations of the bordered least squares problem
+def denseLSS(gradientInfo):
+    info = gradientInfo[-1:0:-1]
+    R = np.array([x[0] for x in info])
+    b = np.array([x[1] for x in info])
+    dw = np.array([x[2] for x in info])
+    dv = np.array([x[3] for x in info])
+    nseg, subdim = b.shape
+    B = np.zeros((nseg*subdim, (nseg + 1)*subdim))
+    for k in range(0, nseg):
+        B[k*subdim:(k+1)*subdim, k*subdim:(k+1)*subdim] = np.eye(subdim)
+        B[k*subdim:(k+1)*subdim, (k+1)*subdim:(k+2)*subdim] = -R[k]
+    B = np.vstack((B, np.concatenate((np.ravel(dw), np.zeros(subdim))).reshape(1,-1)))
+    b = np.concatenate((np.ravel(b), [-dv.sum()]))
+    Schur = np.dot(B, B.T) + 1e-6*np.eye(B.shape[0])
+    alpha = np.dot(B.T, np.linalg.solve(Schur, b))
+    return alpha.reshape([nseg + 1, subdim])[::-1]
+
+def test_solveLSS():
+    nSegments, nExponents = 12, 3
+    gradientInfo = getGradientInfo(nSegments, nExponents)
+    coeff = getNILSAS(gradientInfo, nExponents).solveLSS()
+    assert coeff.shape == (nSegments + 1, nExponents)
+    assert np.allclose(coeff, denseLSS(gradientInfo), rtol=1e-8, atol=1e-10)
+
+def test_SegmentList(tmpdir):
+    nSegments, nExponents = 8, 3
+    gradientInfo = getGradientInfo(nSegments, nExponents)
+    np.random.seed(1)
+    sensitivities = [(np.random.rand(nExponents), np.random.rand()) for segment in range(0, nSegments + 1)]
+    coeff = getNILSAS(gradientInfo, nExponents).solveLSS()
+    reference = getNILSAS(gradientInfo, nExponents)
+    reference.sensitivities = sensitivities
+    gradient = reference.computeGradient(coeff)
+
+    # part of the segments flushed, the rest pending
+    fileName = str(tmpdir.join('checkpoint.hdf5'))
+    store = CheckpointStore(fileName)
+    store.gradientInfo.extend(gradientInfo[:5])
+    store.sensitivities.extend(sensitivities[:5])
+    store.gradientInfo.flush()
+    store.sensitivities.flush()
+    store.gradientInfo.extend(gradientInfo[5:])
+    store.sensitivities.extend(sensitivities[5:])
+    nilsas = getNILSAS(store.gradientInfo, nExponents)
+    nilsas.sensitivities = store.sensitivities
+    assert len(nilsas.gradientInfo) == nSegments + 1
+    assert np.allclose(nilsas.solveLSS(), coeff)
+    assert np.allclose(nilsas.computeGradient(coeff), gradient)
+
+    # everything read back from the file
+    store.gradientInfo.flush()
+    store.sensitivities.flush()
+    store.handle.close()
+    store = CheckpointStore(fileName)
+    nilsas = getNILSAS(store.gradientInfo, nExponents)
+    nilsas.sensitivities = store.sensitivities
+    assert np.allclose(nilsas.solveLSS(), coeff)
+    assert np.allclose(nilsas.computeGradient(coeff), gradient)
+    store.handle.close()
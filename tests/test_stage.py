@@ -0,0 +1,63 @@
+import os
+import pytest
+
+from adFVM import parallel
+
+def test_stage(tmpdir, monkeypatch):
+    monkeypatch.setattr(parallel, 'stageDirectory', str(tmpdir.join('stage')))
+    source = tmpdir.mkdir('case')
+    source.join('mesh.hdf5').write('mesh')
+    source.mkdir('gencode').join('code.cpp').write('code')
+
+    dest = parallel.stage(str(source.join('mesh.hdf5')))
+    assert dest != str(source.join('mesh.hdf5'))
+    with open(dest) as f:
+        assert f.read() == 'mesh'
+    assert oct(os.stat(parallel.stageDirectory).st_mode & 0o777) == oct(0o700)
+
+    codeDir = parallel.stage(str(source.join('gencode')))
+    with open(os.path.join(codeDir, 'code.cpp')) as f:
+        assert f.read() == 'code'
+
+    # unchanged inputs are not copied again
+    with open(os.path.join(codeDir, 'marker'), 'w') as f:
+        f.write('')
+    assert parallel.stage(str(source.join('gencode'))) == codeDir
+    assert os.path.exists(os.path.join(codeDir, 'marker'))
+
+    # changed inputs are staged again
+    source.join('gencode', 'code.cpp').write('new code')
+    os.utime(str(source.join('gencode', 'code.cpp')), (0, 0))
+    assert parallel.stage(str(source.join('gencode'))) == codeDir
+    assert not os.path.exists(os.path.join(codeDir, 'marker'))
+    with open(os.path.join(codeDir, 'code.cpp')) as f:
+        assert f.read() == 'new code'
+
+def test_stage_shared(tmpdir, monkeypatch):
+    stageDirectory = tmpdir.mkdir('stage')
+    os.chmod(str(stageDirectory), 0o777)
+    monkeypatch.setattr(parallel, 'stageDirectory', str(stageDirectory))
+    source = tmpdir.join('mesh.hdf5')
+    source.write('mesh')
+    with pytest.raises(Exception, match='not private'):
+        parallel.stage(str(source))
+
+def test_stage_failure(tmpdir, monkeypatch):
+    # the failure of the first rank is broadcast to the node
+    stageDirectory = tmpdir.mkdir('stage')
+    os.chmod(str(stageDirectory), 0o777)
+    monkeypatch.setattr(parallel, 'stageDirectory', str(stageDirectory))
+    broadcasts = []
+    class NodeComm(object):
+        def bcast(self, data, root):
+            broadcasts.append(data)
+            return data
+    monkeypatch.setattr(parallel, 'nodeMpi', NodeComm())
+    source = tmpdir.join('mesh.hdf5')
+    source.write('mesh')
+    with pytest.raises(Exception, match='not private'):
+        parallel.stage(str(source))
+    assert len(broadcasts) == 1 and broadcasts[0] is not None
+    os.chmod(str(stageDirectory), 0o700)
+    parallel.stage(str(source))
+    assert broadcasts[1] is None
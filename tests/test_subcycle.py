@@ -0,0 +1,33 @@
+import subprocess
+import os
+import sys
+import shutil
+import glob
+python = sys.executable
+
+cases_path = '../cases/'
+apps_path = '../apps/'
+
+# steps marched inside one map call give the objective of single steps
+def test_subcycle():
+    case_path = os.path.join(cases_path, 'cylinder')
+    primal = os.path.join(apps_path, 'problem.py')
+
+    try:
+        subprocess.check_output([python, primal, os.path.join('../templates/', 'cylinder_test'), '-c'])
+        subprocess.check_output([python, primal, os.path.join('../templates/', 'cylinder_test_subcycle'), '-c'])
+
+        with open(os.path.join(case_path, 'objective.txt')) as f:
+            data = f.readlines()
+        objective = float(data[0].split(' ')[-2])
+        subCycleObjective = float(data[1].split(' ')[-2])
+        diff = abs(objective-subCycleObjective)/abs(objective)
+
+        assert diff < 1e-8
+    finally:
+        list(map(shutil.rmtree, glob.glob(os.path.join(case_path, '1.*'))))
+        list(map(os.remove, glob.glob(os.path.join(case_path, '*.txt'))))
+        list(map(os.remove, glob.glob(os.path.join(case_path, '*.pkl'))))
+
+if __name__ == '__main__':
+    test_subcycle()
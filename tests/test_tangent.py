@@ -0,0 +1,36 @@
+import subprocess
+import os
+import sys
+import shutil
+import glob
+python = sys.executable
+
+cases_path = '../cases/'
+apps_path = '../apps/'
+
+def test_tangent():
+    case_path = os.path.join(cases_path, 'cylinder')
+    problem = os.path.join('../templates/', 'cylinder_test')
+    primal = os.path.join(apps_path, 'problem.py')
+    tangent = os.path.join(apps_path, 'tangent.py')
+
+    try:
+        subprocess.check_output([python, primal, problem, '-c'])
+        subprocess.check_output([python, primal, problem, 'perturb'])
+
+        subprocess.check_output([python, tangent, problem, '--central'])
+
+        with open(os.path.join(case_path, 'objective.txt')) as f:
+            data = f.readlines()
+        fdSens = float(data[1].split(' ')[-2])
+        tanSens = float(data[2].split(' ')[-2])
+        diff = abs(fdSens-tanSens)/abs(fdSens)
+
+        assert diff < 1e-3
+    finally:
+        list(map(shutil.rmtree, glob.glob(os.path.join(case_path, '1.*'))))
+        list(map(os.remove, glob.glob(os.path.join(case_path, '*.txt'))))
+        list(map(os.remove, glob.glob(os.path.join(case_path, '*.pkl'))))
+
+if __name__ == '__main__':
+    test_tangent()